@@ -0,0 +1,188 @@
+"""
+Adaptive procedures for the switch (prep) time of adaptive switch trials.
+
+TwoChoice calls `propose(trial_index)` when an adaptive switch trial starts (the returned
+switch time is used for that trial) and `observe(...)` once every trial after it has been
+scored. `save` writes the per-trial log next to the summary file.
+
+    python adaptive.py  # time one Quest update + proposal
+"""
+import time
+
+import numpy as np
+
+
+class AdaptiveProcedure(object):
+    def __init__(self, bounds=(0.05, 0.6)):
+        self.bounds = bounds
+        self.log = []
+
+    def propose(self, trial_index):
+        raise NotImplementedError
+
+    def observe(self, trial_index, is_switch, switch_time, prep_time, correct):
+        pass
+
+    def clip(self, prep_time):
+        return max(self.bounds[0], min(self.bounds[1], prep_time))
+
+    def save(self, file_name):
+        if self.log:
+            names = self.log[0].keys()
+            np.savez(file_name, **{k: np.array([entry[k] for entry in self.log]) for k in names})
+
+
+def staircase_step(trial_index, last_correct, frames, switches, prev_sign, first_steps, step,
+                   frame_period, frame_bounds):
+    """
+    The staircase rule (see Staircase): the switch time, in frames, proposed at trial
+    `trial_index` given whether the last trial was correct. Works on one observer
+    (scalars) or many in lockstep (arrays of `last_correct`, `frames`, `switches` and
+    `prev_sign`; `trial_index` is shared). Returns the new (frames, switches, prev_sign).
+    """
+    if trial_index == 0:
+        return frames, switches, prev_sign  # initial point
+    sign = np.where(last_correct, -1, 1)  # shrink if right, grow if wrong
+    if trial_index > 1:
+        switches = switches + (sign != prev_sign)
+    if trial_index <= 2:
+        size = first_steps[trial_index - 1]
+        prev_sign = sign
+    else:
+        # `step`, halved with every change of direction, in whole frames (at least one)
+        size = np.maximum(1, np.rint(step / 2.0 ** switches / frame_period)).astype(int)
+    frames = np.clip(frames + size * sign, frame_bounds[0], frame_bounds[1])
+    return frames, switches, prev_sign
+
+
+class Staircase(AdaptiveProcedure):
+    """
+    The original hand-rolled staircase: start at 500 ms, shrink after a correct trial and
+    grow after an error by 16/60 s, then 8/60 s, then 2 ** (3 - n) / 60 s (at least one
+    frame), where n counts changes of direction.
+
+    It runs in whole frames of `frame_period`: the start, steps and bounds are rounded to
+    frames once, so at 60 Hz the steps are 16, 8, 4, 2, 1 frames, and on faster displays
+    the same durations in more (smaller) frames.
+
+    As before, the direction is taken from the most recent trial (switch or not), and
+    `prev_sign` is only updated on trials 1 and 2. The rule itself is `staircase_step`,
+    which staircase_sim.py runs for many simulated observers at once.
+    """
+
+    def __init__(self, start=0.5, bounds=(0.05, 0.6), frame_period=1/60,
+                 first_steps=(16/60, 8/60), step=8/60):
+        super(Staircase, self).__init__(bounds)
+        self.frame_period = frame_period
+        self.frames = self.to_frames(start)
+        self.frame_bounds = (self.to_frames(bounds[0]), self.to_frames(bounds[1]))
+        self.first_steps = tuple(self.to_frames(s) for s in first_steps)
+        self.step = step
+        self.last_correct = False
+        self.sign_switch_count = 0  # number of times the correctness switched
+        self.prev_sign = 0
+
+    def to_frames(self, seconds):
+        return max(1, int(round(seconds / self.frame_period)))
+
+    @property
+    def prep_time(self):
+        return self.frames * self.frame_period
+
+    def observe(self, trial_index, is_switch, switch_time, prep_time, correct):
+        self.last_correct = correct
+
+    def propose(self, trial_index):
+        frames, switches, prev_sign = staircase_step(
+            trial_index, self.last_correct, self.frames, self.sign_switch_count, self.prev_sign,
+            self.first_steps, self.step, self.frame_period, self.frame_bounds)
+        self.frames, self.sign_switch_count, self.prev_sign = int(frames), int(switches), int(prev_sign)
+        self.log.append({'trial': trial_index, 'prep_time': self.prep_time, 'frames': self.frames,
+                         'sign_switch_count': self.sign_switch_count})
+        return self.prep_time
+
+
+class Quest(AdaptiveProcedure):
+    """
+    QUEST-style Bayesian procedure. The posterior over the threshold and slope of
+
+        p(correct | prep) = guess + (1 - guess - lapse) / (1 + exp(-(prep - threshold) / slope))
+
+    is kept (in log form) on a `thresholds` x `slopes` grid. Every scored switch trial with a
+    response updates it with the realized prep time; the next switch time is the posterior
+    mean threshold, rounded to whole frames and clipped to `bounds`. Both steps are a few
+    vectorized passes over the grid (well under a millisecond for 100 x 100).
+    """
+
+    def __init__(self, guess=0.5, lapse=0.02, thresholds=None, slopes=None,
+                 bounds=(0.05, 0.6), frame_period=1/60, start=0.5):
+        super(Quest, self).__init__(bounds)
+        self.guess = guess
+        self.lapse = lapse
+        self.frame_period = frame_period
+        self.thresholds = np.linspace(0.0, 0.7, 100) if thresholds is None else np.asarray(thresholds)
+        self.slopes = np.geomspace(0.005, 0.2, 100) if slopes is None else np.asarray(slopes)
+        self._threshold = self.thresholds[:, None]
+        self._inv_slope = 1.0 / self.slopes[None, :]
+        self.log_posterior = np.zeros((self.thresholds.size, self.slopes.size))  # flat prior
+        self.prep_time = start
+        self.n_updates = 0
+
+    def p_correct(self, prep_time):
+        return self.guess + (1 - self.guess - self.lapse) / \
+            (1 + np.exp((self._threshold - prep_time) * self._inv_slope))
+
+    def observe(self, trial_index, is_switch, switch_time, prep_time, correct):
+        if not is_switch or not np.isfinite(prep_time):
+            return
+        p = self.p_correct(prep_time)
+        self.log_posterior += np.log(p if correct else 1 - p)
+        self.log_posterior -= self.log_posterior.max()
+        self.n_updates += 1
+
+    def posterior(self):
+        post = np.exp(self.log_posterior)
+        return post / post.sum()
+
+    def propose(self, trial_index):
+        post = self.posterior()
+        marginal = post.sum(axis=1)
+        mean = marginal.dot(self.thresholds)
+        sd = np.sqrt(marginal.dot((self.thresholds - mean) ** 2))
+        if self.n_updates:
+            self.prep_time = self.clip(round(mean / self.frame_period) * self.frame_period)
+        self.log.append({'trial': trial_index, 'prep_time': self.prep_time,
+                         'threshold_mean': mean, 'threshold_sd': sd,
+                         'slope_mean': post.sum(axis=0).dot(self.slopes),
+                         'threshold_marginal': marginal.astype(np.float32)})
+        return self.prep_time
+
+    def save(self, file_name):
+        if self.log:
+            names = self.log[0].keys()
+            np.savez(file_name, thresholds=self.thresholds, slopes=self.slopes,
+                     final_log_posterior=self.log_posterior,
+                     **{k: np.array([entry[k] for entry in self.log]) for k in names})
+
+
+procedures = {'staircase': Staircase, 'quest': Quest}
+
+
+def make_procedure(name, n_choices=2, frame_period=1/60):
+    if name == 'quest':
+        return Quest(guess=1.0 / n_choices, frame_period=frame_period)
+    return procedures[name](frame_period=frame_period)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    quest = Quest()
+    times = []
+    for i in range(200):
+        t0 = time.perf_counter()
+        x = quest.propose(i)
+        correct = rng.random() < 0.5 + 0.48 / (1 + np.exp(-(x - 0.25) / 0.03))
+        quest.observe(i, True, x, x + rng.normal(0, 0.03), correct)
+        times.append(time.perf_counter() - t0)
+    print('%d x %d grid: %.3f ms per trial (median), estimate %.3f s (true 0.25)' %
+          (quest.thresholds.size, quest.slopes.size, np.median(times) * 1000, quest.log[-1]['threshold_mean']))
@@ -0,0 +1,211 @@
+"""
+Consolidate every `data/<subject>/id_*.csv` summary file into one columnar store.
+
+    python aggregate.py            # scan data/, ingest new/changed files into data/_store/
+
+Only files whose size/mtime (then hash) changed since the last run are parsed. Rows of a
+file that changed or disappeared are marked invalid rather than rewritten. Each column is
+a flat binary file with a compact dtype, so `load_store` memory-maps them. A file's rows
+count once the manifest is saved after them; anything past the manifest's row count
+(from an ingest that crashed part way) is cut off before the next one appends.
+
+    store = load_store()
+    switch = store['valid'] & (store['first_target'] != store['second_target'])
+    prep, correct = store['prep_time'][switch], store['correct'][switch]
+
+Missing values are NaN in float columns and -1 in integer ones. `subject`, `block`,
+`condition` (fixed/adaptive) and `task` (two/multi) are categorical codes; the labels
+are in `store['categories']`.
+"""
+import hashlib
+import json
+import os
+import os.path as op
+import re
+import sys
+
+import numpy as np
+
+columns = [('valid', 'i1'), ('subject', 'i2'), ('session', 'i4'), ('block', 'i2'),
+           ('condition', 'i1'), ('task', 'i1'), ('index', 'i2'),
+           ('first_target', 'i1'), ('second_target', 'i1'), ('real_switch_time', 'f4'),
+           ('first_press', 'i1'), ('first_press_time', 'f4'), ('correct', 'i1'),
+           ('prep_time', 'f4')]
+summary_columns = ['index', 'first_target', 'second_target', 'real_switch_time',
+                   'first_press', 'first_press_time', 'correct', 'prep_time']
+# <subject>/id_<subject>_<table>[_adapt]_<HHMMSS>.csv (the trial table copy and sidecars
+# don't match); the part after the prefix, as subjects may contain underscores
+file_pattern = re.compile(r'^(?P<block>.+?)(?P<adapt>_adapt)?_\d{6}\.csv$')
+
+
+def _match_file(subject, name):
+    prefix = 'id_' + subject + '_'
+    if not name.startswith(prefix):
+        return None
+    return file_pattern.match(name[len(prefix):])
+
+
+def _hash(file_name):
+    with open(file_name, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _code(categories, kind, label):
+    labels = categories.setdefault(kind, [])
+    if label not in labels:
+        labels.append(label)
+    return labels.index(label)
+
+
+def _read_summary(file_name):
+    with open(file_name, 'r') as f:
+        lines = [l.rstrip('\n').split(',') for l in f if l.strip()]
+    header, rows = lines[0], lines[1:]
+    out = {}
+    for name in summary_columns:
+        if name in header:
+            i = header.index(name)
+            out[name] = np.array([float(r[i]) if r[i] not in ('', 'None') else np.nan for r in rows])
+        else:
+            out[name] = np.full(len(rows), np.nan)
+    return out
+
+
+def _empty_manifest():
+    return {'rows': 0, 'files': {}, 'sessions': 0,
+            'columns': dict(columns),
+            'categories': {'condition': ['fixed', 'adaptive'], 'task': ['two', 'multi']}}
+
+
+def _load_manifest(store_dir):
+    path = op.join(store_dir, 'manifest.json')
+    if not op.exists(path):
+        return _empty_manifest()
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _save_manifest(store_dir, manifest):
+    path = op.join(store_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _invalidate(store_dir, manifest, entry):
+    if entry['stop'] > entry['start']:
+        valid = np.memmap(op.join(store_dir, 'valid.bin'), dtype='i1', mode='r+',
+                          shape=(manifest['rows'],))
+        valid[entry['start']:entry['stop']] = 0
+        valid.flush()
+        del valid
+
+
+def _truncate(store_dir, manifest):
+    # drop column rows past manifest['rows'], so every column appends at the same row
+    for col, dtype in manifest['columns'].items():
+        path = op.join(store_dir, col + '.bin')
+        size = manifest['rows'] * np.dtype(dtype).itemsize
+        if op.exists(path) and op.getsize(path) > size:
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+
+
+def update_store(data_dir='data', store_dir=None, verbose=False):
+    """Ingest new/changed summary files. Returns (added, replaced, removed) file counts."""
+    store_dir = store_dir or op.join(data_dir, '_store')
+    if not op.exists(store_dir):
+        os.makedirs(store_dir)
+    manifest = _load_manifest(store_dir)
+    _truncate(store_dir, manifest)
+    categories = manifest['categories']
+    seen = set()
+    added = replaced = 0
+
+    for subject_dir in sorted(os.listdir(data_dir)):
+        path = op.join(data_dir, subject_dir)
+        if subject_dir.startswith('_') or not op.isdir(path):
+            continue
+        for name in sorted(os.listdir(path)):
+            match = _match_file(subject_dir, name)
+            if not match:
+                continue
+            file_name = op.join(path, name)
+            key = subject_dir + '/' + name
+            seen.add(key)
+            st = os.stat(file_name)
+            old = manifest['files'].get(key)
+            if old is not None and old['size'] == st.st_size and old['mtime'] == st.st_mtime_ns:
+                continue
+            digest = _hash(file_name)
+            if old is not None and old['sha1'] == digest:
+                old['mtime'] = st.st_mtime_ns
+                continue
+
+            data = _read_summary(file_name)
+            n = len(data['index'])
+            targets = np.concatenate((data['first_target'], data['second_target']))
+            n_targets = np.unique(targets[~np.isnan(targets)]).size
+            const = {'valid': 1,
+                     'subject': _code(categories, 'subject', subject_dir),
+                     'session': manifest['sessions'],
+                     'block': _code(categories, 'block', match.group('block')),
+                     'condition': 1 if match.group('adapt') else 0,
+                     'task': 1 if n_targets > 2 else 0}
+            for col, dtype in columns:
+                if col in const:
+                    values = np.full(n, const[col], dtype=dtype)
+                elif np.dtype(dtype).kind == 'i':
+                    values = np.nan_to_num(data[col], nan=-1).astype(dtype)
+                else:
+                    values = data[col].astype(dtype)
+                with open(op.join(store_dir, col + '.bin'), 'ab') as f:
+                    f.write(values.tobytes())
+
+            if old is not None:
+                _invalidate(store_dir, manifest, old)
+                replaced += 1
+            else:
+                added += 1
+            manifest['files'][key] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha1': digest,
+                                      'session': manifest['sessions'],
+                                      'start': manifest['rows'], 'stop': manifest['rows'] + n}
+            manifest['rows'] += n
+            manifest['sessions'] += 1
+            _save_manifest(store_dir, manifest)
+            if verbose:
+                print('ingested %s (%d rows)' % (key, n))
+
+    removed = 0
+    for key in [k for k in manifest['files'] if k not in seen]:
+        _invalidate(store_dir, manifest, manifest['files'].pop(key))
+        removed += 1
+    _save_manifest(store_dir, manifest)
+    return added, replaced, removed
+
+
+def load_store(store_dir='data/_store'):
+    """Memory-mapped columns (read-only), plus 'categories' and 'files' from the manifest."""
+    manifest = _load_manifest(store_dir)
+    n = manifest['rows']
+    store = {'categories': manifest['categories'], 'files': manifest['files']}
+    for col, dtype in manifest['columns'].items():
+        if n:
+            store[col] = np.memmap(op.join(store_dir, col + '.bin'), dtype=dtype, mode='r', shape=(n,))
+        else:
+            store[col] = np.zeros(0, dtype=dtype)
+    store['valid'] = store['valid'].astype(bool)
+    return store
+
+
+def code(store, kind, label):
+    # categorical code for a label, e.g. code(store, 'subject', '001')
+    return store['categories'][kind].index(label)
+
+
+if __name__ == '__main__':
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else 'data'
+    added, replaced, removed = update_store(data_dir, verbose=True)
+    store = load_store(op.join(data_dir, '_store'))
+    print('%d new, %d changed, %d removed files; %d valid rows from %d subjects' %
+          (added, replaced, removed, store['valid'].sum(), len(store['categories'].get('subject', []))))
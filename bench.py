@@ -0,0 +1,183 @@
+"""
+Per-frame CPU budget of the exp.py main loop, per state, under synthetic load.
+
+Each scenario runs a whole session on the headless backends (see headless.py) through
+the same loop as exp.py (input, draw_input, step, mouse.getPressed, flip), with
+FrameProfiler timing every phase (and the callOnFlip work inside the flip). Per state,
+the p50/p90/p99/max CPU time of each phase and of the whole frame is reported, along
+with the share of the frame budget used.
+
+    python bench.py                               # run everything, print the table
+    python bench.py --save bench_baseline.json    # store a baseline
+    python bench.py --compare bench_baseline.json --threshold 0.25
+
+`--compare` flags every (scenario, state, phase, percentile) that got slower than the
+baseline by more than `--threshold` (relative) and `--min-ms` (absolute), and exits
+with status 1 if there are any. Only p50 and p90 are compared unless `--percentiles`
+says otherwise.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os.path as op
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from frame_profiler import FrameProfiler
+from headless import (BurstResponder, HeadlessMultiChoice, HeadlessTwoChoice, SimulatedForces,
+                      StochasticResponder)
+
+
+class FakeMouse(object):
+    def getPressed(self):
+        return [0, 0, 0]
+
+
+# name: (settings, responder factory)
+scenarios = {
+    'keys': ({}, lambda seed: StochasticResponder(seed=seed)),
+    'keys_staircase': ({'adaptive': True}, lambda seed: StochasticResponder(seed=seed)),
+    'keys_quest': ({'adaptive': True, 'procedure': 'quest'}, lambda seed: StochasticResponder(seed=seed)),
+    'key_bursts': ({}, lambda seed: BurstResponder(seed=seed)),
+    'force_1khz': ({'forceboard': True}, lambda seed: SimulatedForces(rate=1000.0, seed=seed)),
+    'force_4khz': ({'forceboard': True}, lambda seed: SimulatedForces(rate=4000.0, seed=seed)),
+    'multi': ({'twochoice': False, 'trial_table': 'tables/test_multi.csv'},
+              lambda seed: StochasticResponder(seed=seed)),
+    'multi_force_1khz': ({'twochoice': False, 'trial_table': 'tables/test_multi.csv', 'forceboard': True},
+                         lambda seed: SimulatedForces(rate=1000.0, seed=seed)),
+}
+
+default_settings = {'subject': 'bench', 'fullscreen': False, 'forceboard': False, 'twochoice': True,
+                    'trial_table': 'tables/test_long.csv', 'adaptive': False, 'stream': True}
+
+
+def run_scenario(name, refresh_rate=60.0, seed=0, data_dir='data_bench'):
+    overrides, make_responder = scenarios[name]
+    settings = dict(default_settings, **overrides)
+    settings.update(refresh_rate=refresh_rate, seed=seed, responder=make_responder(seed),
+                    data_dir=data_dir)
+    cls = HeadlessTwoChoice if settings['twochoice'] else HeadlessMultiChoice
+    experiment = cls(settings=settings)
+    profiler = FrameProfiler(experiment, frames=200000)
+    profiler.install()
+    mouse = FakeMouse()
+    profiler.install_mouse(mouse)
+
+    # exp.py's loop (quietly, the adaptive procedures print every trial)
+    with experiment.device, contextlib.redirect_stdout(io.StringIO()):
+        while experiment.state != 'cleanup':
+            experiment.input()
+            experiment.draw_input()
+            experiment.step()
+            if mouse.getPressed()[0]:
+                experiment.to_cleanup()
+            experiment.win.flip()
+    return profiler.report(experiment.frame_period)
+
+
+def run_suite(names=None, refresh_rates=(60.0, 120.0), repeats=3, seed=0):
+    """
+    {scenario@rate: {state: {phase_ms: [p50, p90, p99, max]}}}, each number the
+    minimum over `repeats` runs (the least disturbed by the rest of the machine).
+    """
+    names = names or list(scenarios)
+    results = {}
+    data_dir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        for name in names:
+            for rate in refresh_rates:
+                reports = [run_scenario(name, rate, seed, data_dir) for _ in range(repeats)]
+                key = '%s@%g' % (name, rate)
+                states = {}
+                for state in reports[0]['states']:
+                    entry = {'frames': reports[0]['states'][state]['frames']}
+                    for phase in ('total_ms',) + tuple(p + '_ms' for p in FrameProfiler.phases):
+                        values = [r['states'][state][phase] for r in reports if state in r['states']]
+                        entry[phase] = np.min(values, axis=0).tolist()
+                    states[state] = entry
+                results[key] = {'refresh_rate': rate, 'budget_ms': 1000.0 / rate, 'states': states}
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold=0.25, min_ms=0.02, percentiles=(50, 90)):
+    # [(scenario, state, phase, percentile, baseline ms, now ms)] for every regression
+    # (p99/max of states with few frames are too noisy to compare by default)
+    regressions = []
+    for key, entry in results.items():
+        old = baseline.get('results', {}).get(key)
+        if old is None:
+            continue
+        for state, phases in entry['states'].items():
+            old_phases = old['states'].get(state)
+            if old_phases is None:
+                continue
+            for phase, values in phases.items():
+                if not phase.endswith('_ms') or phase not in old_phases:
+                    continue
+                for pct, now, before in zip(baseline['percentiles'], values, old_phases[phase]):
+                    if pct not in percentiles:
+                        continue
+                    if now > before * (1 + threshold) and now - before > min_ms:
+                        regressions.append((key, state, phase, pct, before, now))
+    return regressions
+
+
+def format_results(results):
+    lines = []
+    for key, entry in results.items():
+        lines.append('%s (budget %.2f ms)' % (key, entry['budget_ms']))
+        lines.append('  %-14s %7s  %-28s %-18s %-18s %-18s %s' %
+                     ('state', 'frames', 'total ms p50/p90/p99/max', 'input ms p50/p99',
+                      'flip ms p50/p99', 'on_flip ms p50/p99', 'p99 budget'))
+        for state, s in entry['states'].items():
+            lines.append('  %-14s %7d  %-28s %-18s %-18s %-18s %5.1f%%' %
+                         (state, s['frames'], '/'.join('%.3f' % x for x in s['total_ms']),
+                          '%.3f/%.3f' % (s['input_ms'][0], s['input_ms'][2]),
+                          '%.3f/%.3f' % (s['flip_ms'][0], s['flip_ms'][2]),
+                          '%.3f/%.3f' % (s['on_flip_ms'][0], s['on_flip_ms'][2]),
+                          100 * s['total_ms'][2] / entry['budget_ms']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-frame budget of the main loop.')
+    parser.add_argument('scenarios', nargs='*', help='default: all of %s' % ', '.join(scenarios))
+    parser.add_argument('--rates', type=float, nargs='+', default=[60.0, 120.0])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--save', default=None, help='write the results as a baseline')
+    parser.add_argument('--compare', default=None, help='baseline to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25)
+    parser.add_argument('--min-ms', type=float, default=0.02)
+    parser.add_argument('--percentiles', type=int, nargs='+', default=[50, 90],
+                        help='which percentiles --compare looks at')
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    results = run_suite(args.scenarios or None, args.rates, args.repeats)
+    print(format_results(results))
+    print('(%.1f s)' % (time.perf_counter() - t0))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'percentiles': [50, 90, 99, 100], 'python': sys.version.split()[0],
+                       'numpy': np.__version__, 'machine': platform.node(),
+                       'results': results}, f, indent=1)
+    if args.compare:
+        if not op.exists(args.compare):
+            sys.exit('no baseline at %s' % args.compare)
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_ms, args.percentiles)
+        for key, state, phase, pct, before, now in regressions:
+            print('REGRESSION %s %s %s p%d: %.3f -> %.3f ms' % (key, state, phase, pct, before, now))
+        print('%d regressions (threshold %.0f%%, %.3f ms)' % (len(regressions), args.threshold * 100, args.min_ms))
+        if regressions:
+            sys.exit(1)
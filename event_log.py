@@ -0,0 +1,245 @@
+"""
+A binary log of what happened when in a block: trial starts, state changes, stimuli on
+and off (timed by the flip that shows them) and input events, one fixed-size record each.
+
+    <base>_log.bin    records: time, trial, code, state, arg, value (see RECORD)
+    <base>_log.json   layout, record count, and the names of codes, states and stimuli
+
+Appending a record is a few item assignments into a preallocated array on the render
+thread, with no text formatting; the records of a trial are written to disk in bulk
+between trials. Offline, `load_log` reads them and `decode_log` gives rows with names:
+
+    python event_log.py data/001/id_001_block1_120000_log.bin  # -> ..._log.csv
+    python event_log.py                                        # self-check
+"""
+import csv
+import json
+import os.path as op
+import sys
+import tempfile
+
+import numpy as np
+
+RECORD = np.dtype([('time', 'f8'), ('trial', 'i4'), ('code', 'i2'), ('state', 'i2'),
+                   ('arg', 'i4'), ('value', 'f8')])
+
+# event codes; `arg` is the stimulus for STIM_*, the key (finger) for PRESS/RELEASE
+TRIAL_START = 0
+STATE = 1
+STIM_ON = 2
+STIM_OFF = 3
+PRESS = 4
+RELEASE = 5
+CODES = {TRIAL_START: 'trial_start', STATE: 'state', STIM_ON: 'stim_on', STIM_OFF: 'stim_off',
+         PRESS: 'press', RELEASE: 'release'}
+
+
+class EventLog(object):
+    """
+    Records of one block, see the module docstring. `trial` and `state` are stamped on
+    every record; the experiment keeps them current. `on_flip` records an event whose
+    time is that of the next flip of `win` (one callOnFlip per frame, however many
+    events). `take` hands over the records so far (a copy) for `write`, so the write
+    can happen on another thread.
+    """
+
+    def __init__(self, base_name, win, state_names=(), capacity=4096):
+        self.file_name = base_name + '_log.bin'
+        self.layout_name = base_name + '_log.json'
+        self.win = win
+        self.state_names = list(state_names)
+        self.stim_names = []
+        self._stim_ids = {}
+        self.records = np.zeros(capacity, dtype=RECORD)
+        self.count = 0
+        self.written = 0
+        self.waiting = -1  # first record waiting for the next flip's time (time nan), if any
+        self.trial = 0
+        self.state = -1
+        self.closed = False
+        self._file = open(self.file_name, 'wb')
+        self._write_layout()
+
+    def stim_id(self, name):
+        # stimuli are numbered in the order they are first logged
+        i = self._stim_ids.get(name)
+        if i is None:
+            i = self._stim_ids[name] = len(self.stim_names)
+            self.stim_names.append(name)
+        return i
+
+    def append(self, time, code, arg=0, value=np.nan):
+        if self.count == self.records.shape[0]:
+            self._grow(self.count + 1)
+        self.records[self.count] = (time, self.trial, code, self.state, arg, value)
+        self.count += 1
+
+    def extend(self, times, codes, args):
+        # several events at once (e.g. one device read; keyboard reads are (n, 1))
+        times = np.asarray(times, dtype=np.float64).reshape(-1)
+        n = times.shape[0]
+        if self.count + n > self.records.shape[0]:
+            self._grow(self.count + n)
+        rows = self.records[self.count:self.count + n]
+        rows['time'] = times
+        rows['trial'] = self.trial
+        rows['code'] = np.asarray(codes).reshape(-1)
+        rows['state'] = self.state
+        rows['arg'] = np.asarray(args).reshape(-1)
+        rows['value'] = np.nan
+        self.count += n
+
+    def start_trial(self, time):
+        self.append(time, TRIAL_START)
+
+    def enter_state(self, time, trial, state):
+        self.trial = trial
+        self.state = state
+        self.append(time, STATE, state)
+
+    def inputs(self, times, states, keys):
+        self.extend(times, np.where(states, PRESS, RELEASE), keys)
+
+    def on_flip(self, code, arg=0, value=np.nan):
+        if self.waiting < 0:
+            self.waiting = self.count
+            self.win.callOnFlip(self._stamp)
+        self.append(np.nan, code, arg, value)
+
+    def stim(self, name, on, value=np.nan):
+        self.on_flip(STIM_ON if on else STIM_OFF, self.stim_id(name), value)
+
+    def _stamp(self):
+        # (other records since may have their own time)
+        if self.waiting < 0:
+            return
+        times = self.records['time'][self.waiting:self.count]
+        times[np.isnan(times)] = self.win.lastFrameT
+        self.waiting = -1
+
+    def _grow(self, n):
+        size = self.records.shape[0]
+        while size < n:
+            size *= 2
+        records = np.zeros(size, dtype=RECORD)
+        records[:self.count] = self.records[:self.count]
+        self.records = records
+
+    def take(self):
+        # the records up to the first one waiting for a flip; the rest stay
+        n = self.count if self.waiting < 0 else self.waiting
+        rows = self.records[:n].copy()
+        rest = self.count - n
+        self.records[:rest] = self.records[n:self.count]
+        self.count = rest
+        if self.waiting >= 0:
+            self.waiting = 0
+        return rows
+
+    def write(self, rows):
+        rows.tofile(self._file)
+        self._file.flush()
+        self.written += rows.shape[0]
+
+    def flush(self):
+        self.write(self.take())
+
+    def close(self):
+        # records still waiting for a flip are written with time nan
+        if self.closed:
+            return
+        self.closed = True
+        self.waiting = -1
+        self.flush()
+        self._file.close()
+        self._write_layout()
+
+    def _write_layout(self):
+        layout = {'records': RECORD.descr, 'count': self.written,
+                  'codes': {str(k): v for k, v in CODES.items()},
+                  'states': self.state_names, 'stims': self.stim_names}
+        with open(self.layout_name, 'w') as f:
+            json.dump(layout, f, indent=1)
+
+
+def load_log(file_name):
+    # `file_name` is the .bin, the .json, or the base name; returns (records, layout)
+    for suffix in ('_log.bin', '_log.json'):
+        if file_name.endswith(suffix):
+            file_name = file_name[:-len(suffix)]
+    with open(file_name + '_log.json', 'r') as f:
+        layout = json.load(f)
+    records = np.fromfile(file_name + '_log.bin', dtype=np.dtype([tuple(d) for d in layout['records']]))
+    return records, layout
+
+
+def decode_log(file_name):
+    # rows of (time, trial, event, state, what, value) in time order, with names for codes,
+    # states and stimuli
+    records, layout = load_log(file_name)
+    # records are in the order they were made; stimulus events get their (flip) time later
+    records = records[np.argsort(records['time'], kind='stable')]
+    codes = {int(k): v for k, v in layout['codes'].items()}
+    states, stims = layout['states'], layout['stims']
+    rows = []
+    for r in records.tolist():
+        time, trial, code, state, arg, value = r
+        if code in (STIM_ON, STIM_OFF):
+            what = stims[arg]
+        elif code in (PRESS, RELEASE):
+            what = arg
+        else:
+            what = ''
+        rows.append((time, trial, codes.get(code, code), states[state] if 0 <= state < len(states) else '',
+                     what, value))
+    return rows
+
+
+def log_to_csv(file_name, out_name=None):
+    rows = decode_log(file_name)
+    if out_name is None:
+        out_name = file_name.rsplit('.', 1)[0] + '.csv'
+    with open(out_name, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['time', 'trial', 'event', 'state', 'what', 'value'])
+        writer.writerows(rows)
+    return out_name
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        for name in sys.argv[1:]:
+            print(log_to_csv(name))
+    else:
+        from headless import BurstResponder, NullWindow, VirtualClock, simulate_session
+        data_dir = tempfile.mkdtemp(prefix='event_log_')
+        # a keyboard read of several events ((n, 1) states and keys), and flip-timed stimuli
+        win = NullWindow(VirtualClock())
+        log = EventLog(op.join(data_dir, 'check'), win, ['a', 'b'])
+        log.enter_state(0.0, 0, 1)
+        log.inputs(np.array([0.1, 0.2, 0.3]), np.array([[1], [0], [1]], dtype=bool), np.array([[2], [2], [5]]))
+        log.stim('target', True)
+        rows = log.take()  # stops at the record waiting for the flip
+        win.flip()
+        log.stim('target', False)
+        log.write(rows)
+        log.close()
+        records, layout = load_log(log.file_name)
+        assert layout['count'] == records.shape[0] == 6
+        assert records['code'].tolist() == [STATE, PRESS, RELEASE, PRESS, STIM_ON, STIM_OFF]
+        assert records['arg'][1:4].tolist() == [2, 2, 5]
+        assert records['time'][4] == win.lastFrameT and np.isnan(records['time'][5])
+
+        # every press/release of a session with bursts of keys (several per read) is logged,
+        # as many as in its _events.csv
+        settings = {'subject': 'check', 'fullscreen': False, 'forceboard': False, 'twochoice': True,
+                    'trial_table': 'tables/test_long.csv', 'adaptive': False, 'data_dir': data_dir}
+        session = simulate_session(settings, BurstResponder(seed=0))
+        for summary in session['summary_file_names']:
+            base = op.splitext(summary)[0]
+            records, _ = load_log(base)
+            logged = int(np.isin(records['code'], (PRESS, RELEASE)).sum())
+            with open(base + '_events.csv', 'r') as f:
+                written = sum(1 for _ in f) - 1
+            assert logged == written, '%d input events in the log, %d in _events.csv' % (logged, written)
+            print('event log ok (%d input events in %d records)' % (logged, records.shape[0]))
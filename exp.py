@@ -1,37 +1,70 @@
-from two_choice_imp import TwoChoice
-from multi_choice_imp import MultiChoice
-from psychopy import core, gui
-from psychopy.event import Mouse
+import sys
+
+from startup import profile
 
 if __name__ == '__main__':
+    if '--profile-startup' in sys.argv:
+        profile.enable()  # report where launch time goes
+
+    with profile.phase('import psychopy.gui'):
+        from psychopy import core, gui
+        from psychopy.event import Mouse
+
     settings = {'subject': '001',
                 'fullscreen': False,
                 'forceboard': False,
+                'hub': False,  # forces and keyboard together (input_hub.py), overrides forceboard
                 'twochoice': True,
-                'trial_table': 'tables/test.csv',
-                'adaptive': False}  # NB: ignored in the MultiChoice example
+                'trial_table': 'tables/test.csv',  # several, separated by commas, run as one session
+                'adaptive': False,  # NB: ignored in the MultiChoice example
+                'procedure': ['staircase', 'quest'],  # adaptive procedure (see adaptive.py)
+                'profile': False,  # per-frame timing report at the end
+                'record': False,  # keep every device read, see replay.py
+                'realtime': False}  # no GC mid-trial, pinned cores, priority, see realtime.py
 
     dialog = gui.DlgFromDict(dictionary=settings, title='Replanning')
 
     if not dialog.OK:
         core.quit()
 
+    # several tables are blocks of one session (see session.py)
+    from session import BlockQueue, split_tables
+    tables = split_tables(settings['trial_table'])
+    settings['trial_table'] = tables[0]
+
     # could have a second menu, depending on the experiment
-    if settings['twochoice']:
-        experiment = TwoChoice(settings=settings)
-    else:
-        experiment = MultiChoice(settings=settings)
+    with profile.phase('experiment'):
+        if settings['twochoice']:
+            from two_choice_imp import TwoChoice
+            experiment = TwoChoice(settings=settings)
+        else:
+            from multi_choice_imp import MultiChoice
+            experiment = MultiChoice(settings=settings)
 
+    blocks = BlockQueue(experiment, tables[1:])
     mouse = Mouse(visible=False, win=experiment.win)
+    if experiment.profiler is not None:
+        experiment.profiler.install_mouse(mouse)
+    if profile.enabled:
+        print(profile.report())
     experiment.coin.play()
     with experiment.device:
-        while experiment.state is not 'cleanup':
-            experiment.input()  # collect input
-            experiment.draw_input()  # draw the input
-            experiment.step()  # evaluate any transitions
-            if any(mouse.getPressed()):
-                experiment.to_cleanup()
-            experiment.win.flip()  # flip frame buffer
+        if experiment.realtime is not None:
+            print('realtime: %s' % experiment.realtime.pin_device())  # the device's process exists now
+        aborted = False
+        while True:
+            while experiment.state is not 'cleanup':
+                experiment.input()  # collect input
+                experiment.draw_input()  # draw the input
+                experiment.step()  # evaluate any transitions
+                if any(mouse.getPressed()):
+                    experiment.to_cleanup()
+                    aborted = True
+                experiment.win.flip()  # flip frame buffer
+            # on to the next block (prepared in the background), unless that was the last or aborted
+            if aborted or not blocks.advance():
+                break
+    blocks.close()
     experiment.win.close()
-    # experiment.win.saveFrameIntervals() # for debugging
+    # experiment.win.saveFrameIntervals() # for debugging (or see settings['profile'])
     core.quit()
@@ -0,0 +1,172 @@
+"""
+Online press detection for the force transducers.
+
+Each read (a few samples x 10 channels) goes through, for all channels at once:
+
+    causal median filter (`median` samples) -> low-pass Butterworth (`cutoff` Hz)
+    -> minus a per-channel baseline -> hysteresis (on above `on`, off below `off`)
+
+Filter state is carried across reads, so how a trace is split into reads only matters
+through the baseline updates (once per read). Onset times are interpolated between samples to where the signal
+crossed `on`. The baseline follows the filtered signal (time constant `baseline_tau`)
+only while a channel is released.
+
+    python force_onset.py data/001/id_001_block1_120000  # re-run over a recorded stream
+"""
+import sys
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+class OnsetDetector(object):
+
+    def __init__(self, channels=10, rate=1000.0, median=5, cutoff=30.0, order=2,
+                 on=2.0, off=1.0, baseline_tau=2.0):
+        from scipy import signal
+        self._lfilter = signal.lfilter
+        self.channels = channels
+        self.rate = rate
+        self.median = median
+        self.on = on
+        self.off = off
+        self.baseline_tau = baseline_tau
+        self.b, self.a = signal.butter(order, cutoff / (rate / 2.0))
+        self._zi_unit = signal.lfilter_zi(self.b, self.a)[:, None]
+        self.reset()
+
+    def reset(self):
+        # forget everything; the next read initialises the filters and baseline
+        self.zi = None
+        self.history = None  # last `median - 1` raw samples
+        self.baseline = np.zeros(self.channels)
+        self.active = np.zeros(self.channels, dtype=bool)
+        self.last_time = np.nan
+        self.last_value = np.zeros(self.channels)  # last baseline-corrected sample
+
+    def _start(self, first):
+        self.history = np.repeat(first[None], self.median - 1, axis=0)
+        self.zi = self._zi_unit * first[None]  # as if `first` had always been there
+        self.baseline = first.astype(np.float64)
+        self.last_value = np.zeros(self.channels)
+
+    def _median(self, data):
+        x = np.concatenate((self.history, data), axis=0)
+        n = data.shape[0]
+        s0, s1 = x.strides
+        windows = as_strided(x, shape=(n, self.median, self.channels), strides=(s0, s0, s1))
+        self.history = x[n:]
+        return np.sort(windows, axis=1)[:, self.median // 2]
+
+    def update(self, timestamps, data):
+        """
+        Feed one read. Returns (channels, times, onsets) for every state change in it,
+        ordered by time (`onsets` is True for presses, False for releases).
+        `self.active` is the state after the read.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64).reshape(-1)
+        data = np.asarray(data, dtype=np.float64).reshape(-1, self.channels)
+        n = data.shape[0]
+        if self.history is None:
+            self._start(data[0])
+        filtered, self.zi = self._lfilter(self.b, self.a, self._median(data), axis=0, zi=self.zi)
+        x = filtered - self.baseline
+        above = x >= self.on
+        below = x <= self.off
+
+        if (above & ~self.active).any() or (below & self.active).any():
+            changes, state = self._changes(timestamps, x, above, below)
+        else:
+            # nothing crossed (most reads)
+            changes, state = self._no_changes, None
+
+        # the baseline only tracks channels that are (and stayed) released
+        released = ~self.active if state is None else ~state.any(axis=0) & ~self.active
+        alpha = 1.0 - np.exp(-n / (self.rate * self.baseline_tau))
+        self.baseline[released] += alpha * (filtered[:, released].mean(axis=0) - self.baseline[released])
+
+        if state is not None:
+            self.active = state[-1]
+        self.last_value = x[-1]
+        self.last_time = timestamps[-1]
+        return changes
+
+    _no_changes = (np.zeros(0, dtype=np.intp), np.zeros(0), np.zeros(0, dtype=bool))
+
+    def _changes(self, timestamps, x, above, below):
+        # hysteresis: the state at each sample is whichever threshold was crossed last
+        idx = np.arange(x.shape[0])[:, None]
+        last_on = np.maximum.accumulate(np.where(above, idx, -2), axis=0)
+        last_off = np.maximum.accumulate(np.where(below, idx, -2), axis=0)
+        start = np.where(self.active, -1, -3)[None]  # -1 beats -2, -3 doesn't
+        state = np.maximum(last_on, start) > np.maximum(last_off, -2)
+        prev = np.concatenate((self.active[None], state[:-1]), axis=0)
+        rows, cols = np.nonzero(state != prev)
+
+        # interpolate each change to where the signal crossed its threshold
+        prev_x = np.concatenate((self.last_value[None], x[:-1]), axis=0)
+        prev_t = np.concatenate(([self.last_time], timestamps[:-1]))
+        onset = state[rows, cols]
+        level = np.where(onset, self.on, self.off)
+        x1, x0 = x[rows, cols], prev_x[rows, cols]
+        frac = np.clip((level - x0) / np.where(x1 != x0, x1 - x0, 1.0), 0.0, 1.0)
+        t0 = prev_t[rows]
+        times = np.where(np.isnan(t0), timestamps[rows], t0 + frac * (timestamps[rows] - t0))
+        order = np.argsort(times, kind='stable')
+        return (cols[order], times[order], onset[order]), state
+
+
+def detect_onsets(timestamps, data, read_size=17, **kwargs):
+    """
+    Offline: run an OnsetDetector over a whole trace, in pieces of `read_size` samples
+    (about one frame at 1 kHz / 60 Hz, like online; None for one piece).
+    Returns a structured array of (time, channel, onset).
+    """
+    detector = OnsetDetector(channels=data.shape[1], **kwargs)
+    n = data.shape[0]
+    step = read_size or max(n, 1)
+    out = [detector.update(timestamps[i:i + step], data[i:i + step]) for i in range(0, n, step)]
+    events = np.zeros(sum(o[0].size for o in out),
+                      dtype=[('time', 'f8'), ('channel', 'i1'), ('onset', '?')])
+    if out:
+        events['channel'] = np.concatenate([o[0] for o in out])
+        events['time'] = np.concatenate([o[1] for o in out])
+        events['onset'] = np.concatenate([o[2] for o in out])
+    return events
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # first press of every trial in a recorded session (see input_stream.py)
+        from input_stream import load_stream, trial_bounds
+        stream = load_stream(sys.argv[1])
+        samples = stream['samples']
+        events = detect_onsets(samples['time'], samples['data'])
+        presses = events[events['onset']]
+        for trial, t0, start, stop in trial_bounds(stream):
+            t1 = samples['time'][stop - 1] if stop > start else t0
+            hit = presses[(presses['time'] >= t0) & (presses['time'] <= t1)]
+            if hit.size:
+                print('trial %d: channel %d at %.4f s' % (trial, hit[0]['channel'], hit[0]['time'] - t0))
+            else:
+                print('trial %d: no press' % trial)
+    else:
+        # per-read cost at 1 kHz / 60 Hz, and pieces vs whole
+        rng = np.random.default_rng(0)
+        t = np.arange(20000) / 1000.0
+        x = rng.normal(0, 0.1, (t.size, 10)) + 5.0
+        x[8000:9000, 3] += 6.0 * np.minimum(1, np.arange(1000) / 50.0)
+        whole = detect_onsets(t, x, read_size=None)
+        pieces = detect_onsets(t, x, read_size=17)
+        assert np.array_equal(whole['channel'], pieces['channel'])
+        assert np.allclose(whole['time'], pieces['time'])
+        print('events:', whole)
+        detector = OnsetDetector()
+        costs = []
+        for i in range(0, t.size, 17):
+            t0 = time.perf_counter()
+            detector.update(t[i:i + 17], x[i:i + 17])
+            costs.append(time.perf_counter() - t0)
+        print('per read (17 samples x 10 channels): median %.1f us, max %.1f us' %
+              (np.median(costs) * 1e6, np.max(costs) * 1e6))
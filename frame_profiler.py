@@ -0,0 +1,224 @@
+import json
+import time
+
+import numpy as np
+
+
+class FrameProfiler(object):
+    """
+    Per-frame timing of the main loop, tied to states and callbacks.
+
+    `install` wraps the experiment's `input`, `draw_input` and `step`, every `after`
+    callback in the transition table, `win.flip` and the functions given to
+    `win.callOnFlip` (`on_flip`, which run inside the flip); `install_mouse` wraps the
+    main loop's `mouse.getPressed`. Timings go into preallocated arrays (one row per
+    frame, one per callback call) that grow by `chunk` rows when full, and each frame is tagged with the state and trial it started in. `report`
+    summarises per-state latency, dropped frames (relative to `frame_period`) and the
+    callbacks that ran in the frames that were dropped.
+
+    A frame's total is every phase but `flip`: on a display, most of a flip is waiting
+    for the vertical blank, and the work done in it is `on_flip`.
+    """
+    phases = ('input', 'draw_input', 'step', 'mouse', 'flip', 'on_flip')
+    busy_phases = ('input', 'draw_input', 'step', 'mouse', 'on_flip')
+
+    def __init__(self, experiment, frames=60 * 60 * 5, calls=10000, chunk=60 * 60 * 5):
+        self.experiment = experiment
+        self.state_names = list(experiment.states)
+        self.state_codes = {s: i for i, s in enumerate(self.state_names)}
+        self.callback_names = []
+        self.chunk = chunk
+
+        self.phase_time = np.zeros((frames, len(self.phases)))
+        self.flip_time = np.full(frames, np.nan)
+        self.state = np.zeros(frames, dtype=np.int8)
+        self.trial = np.zeros(frames, dtype=np.int32)
+        self.call_frame = np.zeros(calls, dtype=np.int32)
+        self.call_id = np.zeros(calls, dtype=np.int16)
+        self.call_time = np.zeros(calls)
+        self.frame = 0
+        self.n_calls = 0
+
+    def install(self):
+        exp = self.experiment
+        for name in self.phases[:3]:
+            setattr(exp, name, self._wrap_phase(getattr(exp, name), self.phases.index(name)))
+        for trans in exp.transition_table:
+            after = trans.get('after', [])
+            for name in [after] if isinstance(after, str) else after:
+                if name not in self.callback_names:
+                    self.callback_names.append(name)
+                    setattr(exp, name, self._wrap_callback(getattr(exp, name),
+                                                           len(self.callback_names) - 1))
+        exp.win.flip = self._wrap_flip(exp.win.flip)
+        exp.win.callOnFlip = self._wrap_call_on_flip(exp.win.callOnFlip)
+        exp.compile()  # the state machine binds callbacks up front
+        self._tag()
+
+    def install_mouse(self, mouse):
+        mouse.getPressed = self._wrap_phase(mouse.getPressed, self.phases.index('mouse'))
+
+    def reset(self):
+        # start over (e.g. at the next block), keeping what install wrapped (and the room)
+        self.phase_time[:self.frame + 1] = 0
+        self.flip_time[:self.frame + 1] = np.nan
+        self.frame = 0
+        self.n_calls = 0
+        self._tag()
+
+    @staticmethod
+    def _grown(array, rows, fill=0):
+        out = np.full((rows,) + array.shape[1:], fill, dtype=array.dtype)
+        out[:array.shape[0]] = array
+        return out
+
+    def _grow_frames(self):
+        rows = self.phase_time.shape[0] + self.chunk
+        self.phase_time = self._grown(self.phase_time, rows)
+        self.flip_time = self._grown(self.flip_time, rows, np.nan)
+        self.state = self._grown(self.state, rows)
+        self.trial = self._grown(self.trial, rows)
+
+    def _grow_calls(self):
+        rows = self.call_time.shape[0] + self.chunk
+        self.call_frame = self._grown(self.call_frame, rows)
+        self.call_id = self._grown(self.call_id, rows)
+        self.call_time = self._grown(self.call_time, rows)
+
+    def _tag(self):
+        self.state[self.frame] = self.state_codes.get(self.experiment.state, -1)
+        self.trial[self.frame] = self.experiment.trial_counter
+
+    def _wrap_phase(self, func, column):
+        clock = time.perf_counter
+
+        def wrapped(*args, **kwargs):
+            t0 = clock()
+            out = func(*args, **kwargs)
+            self.phase_time[self.frame, column] += clock() - t0
+            return out
+        return wrapped
+
+    def _wrap_callback(self, func, call_id):
+        clock = time.perf_counter
+
+        def wrapped(*args, **kwargs):
+            t0 = clock()
+            out = func(*args, **kwargs)
+            i = self.n_calls
+            if i == self.call_time.shape[0]:
+                self._grow_calls()
+            self.call_time[i] = clock() - t0
+            self.call_frame[i] = self.frame
+            self.call_id[i] = call_id
+            self.n_calls = i + 1
+            return out
+        return wrapped
+
+    def _wrap_flip(self, flip):
+        win = self.experiment.win
+        clock = time.perf_counter
+        column = self.phases.index('flip')
+
+        def wrapped(*args, **kwargs):
+            t0 = clock()
+            out = flip(*args, **kwargs)
+            self.phase_time[self.frame, column] += clock() - t0
+            self.flip_time[self.frame] = win.lastFrameT
+            self.frame += 1
+            if self.frame == self.phase_time.shape[0]:
+                self._grow_frames()
+            self._tag()
+            return out
+        return wrapped
+
+    def _wrap_call_on_flip(self, call_on_flip):
+        # (functions scheduled for the flip are timed when they run)
+        timed = self._wrap_phase
+        column = self.phases.index('on_flip')
+
+        def wrapped(function, *args, **kwargs):
+            call_on_flip(timed(function, column), *args, **kwargs)
+        return wrapped
+
+    def report(self, frame_period):
+        n = self.frame
+        phase_time = self.phase_time[:n]
+        cpu = phase_time[:, [self.phases.index(p) for p in self.busy_phases]].sum(axis=1)
+        interval = np.diff(self.flip_time[:n], prepend=np.nan)
+        missed = np.nan_to_num(np.round(interval / frame_period) - 1).clip(0).astype(int)
+        state = self.state[:n]
+        call_frame = self.call_frame[:self.n_calls]
+        call_id = self.call_id[:self.n_calls]
+        call_time = self.call_time[:self.n_calls]
+        pct = [50, 90, 99, 100]
+
+        states = {}
+        for code, name in enumerate(self.state_names):
+            mask = state == code
+            if not mask.any():
+                continue
+            entry = {'frames': int(mask.sum()),
+                     'dropped': int(missed[mask].sum()),
+                     'total_ms': (np.percentile(cpu[mask], pct) * 1000).tolist()}
+            for column, phase in enumerate(self.phases):
+                entry[phase + '_ms'] = (np.percentile(phase_time[mask, column], pct) * 1000).tolist()
+            states[name] = entry
+
+        callbacks = {}
+        for cid, name in enumerate(self.callback_names):
+            times = call_time[call_id == cid]
+            if times.size:
+                callbacks[name] = {'calls': int(times.size),
+                                   'ms': (np.percentile(times, pct) * 1000).tolist()}
+
+        dropped = []
+        for k in np.flatnonzero(missed):
+            in_frame = call_frame == k
+            calls = sorted(zip(call_time[in_frame].tolist(), call_id[in_frame].tolist()), reverse=True)
+            dropped.append({'frame': int(k),
+                            'state': self.state_names[state[k]],
+                            'trial': int(self.trial[k]),
+                            'missed': int(missed[k]),
+                            'interval_ms': float(interval[k] * 1000),
+                            'cpu_ms': float(cpu[k] * 1000),
+                            'callbacks': [(self.callback_names[c], t * 1000) for t, c in calls]})
+
+        return {'frame_period_ms': frame_period * 1000,
+                'frames': int(n),
+                'dropped_frames': int(missed.sum()),
+                'percentiles': pct,
+                'states': states,
+                'callbacks': callbacks,
+                'dropped': dropped}
+
+    def save(self, base_name, frame_period):
+        # `<base_name>_frames.json` (report) and `<base_name>_frames.npz` (raw per-frame data)
+        report = self.report(frame_period)
+        with open(base_name + '_frames.json', 'w') as f:
+            json.dump(report, f, indent=1)
+        n = self.frame
+        np.savez(base_name + '_frames.npz', phases=np.array(self.phases),
+                 phase_time=self.phase_time[:n], flip_time=self.flip_time[:n],
+                 state=self.state[:n], trial=self.trial[:n], state_names=np.array(self.state_names),
+                 call_frame=self.call_frame[:self.n_calls], call_id=self.call_id[:self.n_calls],
+                 call_time=self.call_time[:self.n_calls],
+                 callback_names=np.array(self.callback_names))
+        return report
+
+
+def format_report(report, max_dropped=20):
+    lines = ['%d frames, %d dropped (frame period %.2f ms)' %
+             (report['frames'], report['dropped_frames'], report['frame_period_ms'])]
+    lines.append('%-14s %7s %7s  total ms p50/p90/p99/max' % ('state', 'frames', 'dropped'))
+    for name, entry in report['states'].items():
+        lines.append('%-14s %7d %7d  %s' % (name, entry['frames'], entry['dropped'],
+                                             '/'.join('%.2f' % x for x in entry['total_ms'])))
+    for drop in report['dropped'][:max_dropped]:
+        worst = ', '.join('%s %.2f ms' % c for c in drop['callbacks'][:3]) or 'no callbacks'
+        lines.append('dropped %d at frame %d (%s, trial %d, cpu %.2f ms): %s' %
+                     (drop['missed'], drop['frame'], drop['state'], drop['trial'],
+                      drop['cpu_ms'], worst))
+    if len(report['dropped']) > max_dropped:
+        lines.append('... and %d more' % (len(report['dropped']) - max_dropped))
+    return '\n'.join(lines)
@@ -0,0 +1,99 @@
+"""
+Timing in whole frames of the display's measured refresh period.
+
+Everything the experiment schedules (target onset, switch, end of the response window,
+feedback, inter-trial interval) is a time after some flip. `FrameTiming` rounds it to a
+number of frames. `FlipCounter` numbers the flips; when a trial starts, each event
+becomes the flip count at which it is drawn (the frame *before* it should appear), so
+that the per-frame checks are one integer comparison. A late flip counts for every
+refresh period since the previous one, so a dropped frame doesn't push the rest of
+the trial back.
+
+    python frame_timing.py data/001/id_001_block1_120000_timing.csv  # requested vs realized
+"""
+import csv
+import sys
+
+import numpy as np
+
+
+class FrameTiming(object):
+
+    def __init__(self, frame_period):
+        self.frame_period = frame_period
+
+    def frames(self, seconds):
+        # nearest whole number of frames (works on arrays too)
+        return np.rint(np.asarray(seconds) / self.frame_period).astype(int)
+
+    def quantize(self, seconds):
+        # time of the predicted flip nearest to `seconds`
+        return self.frames(seconds) * self.frame_period
+
+
+class FlipCounter(object):
+    """
+    Counts flips of `win` (see `install`). `count` is the number of refresh periods
+    since the counter was made, as of the last flip: a flip more than half a frame late
+    adds the frames that were dropped, i.e. the count falls back to the wall clock.
+    """
+
+    def __init__(self, win, frame_period):
+        self.win = win
+        self.frame_period = frame_period
+        self.count = 0
+        self.last_flip = win.lastFrameT
+
+    def install(self):
+        flip = self.win.flip
+
+        def counted_flip(*args, **kwargs):
+            out = flip(*args, **kwargs)
+            self.count = self.current()
+            self.last_flip = self.win.lastFrameT
+            return out
+
+        self.win.flip = counted_flip
+
+    def current(self):
+        # count of the flip in progress, for functions passed to win.callOnFlip
+        n = int(round((self.win.lastFrameT - self.last_flip) / self.frame_period))
+        return self.count + (n if n > 1 else 1)
+
+
+def measure_frame_period(win, n_frames=120):
+    # measured by flipping; monitorFramePeriod is only what the driver claims
+    rate = win.getActualFrameRate(nIdentical=20, nMaxFrames=n_frames, nWarmUpFrames=20, threshold=1)
+    return 1.0 / rate if rate else win.monitorFramePeriod
+
+
+def timing_report(file_name):
+    """
+    Summary of a `<summary>_timing.csv`: for each event, the realized - requested
+    error over trials (ms), and how many trials were off by at least one frame.
+    """
+    with open(file_name, 'r') as f:
+        rows = list(csv.DictReader(f))
+    if not rows:
+        return {}
+    frame_period = float(rows[0]['frame_period'])
+    events = [k[:-len('_requested')] for k in rows[0] if k.endswith('_requested')]
+    report = {'frame_period_ms': frame_period * 1000, 'trials': len(rows), 'events': {}}
+    for event in events:
+        requested = np.array([float(r[event + '_requested'] or 'nan') for r in rows])
+        realized = np.array([float(r[event + '_realized'] or 'nan') for r in rows])
+        error = (realized - requested)[~np.isnan(realized - requested)]
+        if not error.size:
+            continue
+        report['events'][event] = {'mean_ms': float(error.mean() * 1000),
+                                   'max_abs_ms': float(np.abs(error).max() * 1000),
+                                   'frames_off': int((np.abs(error) >= frame_period / 2).sum())}
+    return report
+
+
+if __name__ == '__main__':
+    report = timing_report(sys.argv[1])
+    print('%d trials, frame period %.3f ms' % (report['trials'], report['frame_period_ms']))
+    for event, entry in report['events'].items():
+        print('%-14s mean error %7.3f ms, max |error| %7.3f ms, %d trials off by a frame or more' %
+              (event, entry['mean_ms'], entry['max_abs_ms'], entry['frames_off']))
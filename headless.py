@@ -0,0 +1,417 @@
+"""
+Run TwoChoice/MultiChoice without a display, sound card or keyboard.
+
+Everything the experiment gets from psychopy/toon is swapped for a simulated stand-in
+(see the `setup_` methods on TwoChoice): a virtual clock that only moves when the
+window flips, a null window, stub stimuli/sounds and a simulated responder that plays
+the part of `MultiprocessInput(Keyboard, ...)`. A whole trial table runs as fast as
+the state machine can step.
+
+    python headless.py tables/test.csv -n 1000 --adaptive
+
+"""
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from multi_choice_imp import MultiChoice
+from session import BlockQueue, split_tables
+from target_array import TargetArray
+from two_choice_imp import TwoChoice
+
+
+class VirtualClock(object):
+    # drop-in for toon's mono_clock
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def getTime(self):
+        return self.time
+
+    def set(self, t):
+        self.time = t
+
+    def advance(self, dt):
+        self.time += dt
+
+
+class NullWindow(object):
+    """
+    Stands in for a psychopy Window. Each `flip` moves the clock to the next frame,
+    and occasionally (`drop_prob`) skips one to mimic a dropped frame.
+    """
+
+    def __init__(self, clock, refresh_rate=60.0, drop_prob=0.0, seed=None):
+        self.clock = clock
+        self.monitorFramePeriod = 1.0 / refresh_rate
+        self.drop_prob = drop_prob
+        self.rng = np.random.default_rng(seed)
+        self.recordFrameIntervals = False
+        self.frameIntervals = []
+        self.lastFrameT = clock.getTime()
+        self.frames = 0
+        self._to_call = []
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._to_call.append((function, args, kwargs))
+
+    def flip(self, clearBuffer=True):
+        n = 1
+        if self.drop_prob and self.rng.random() < self.drop_prob:
+            n = 2
+        t = self.lastFrameT + n * self.monitorFramePeriod
+        self.clock.set(t)
+        if self.recordFrameIntervals:
+            self.frameIntervals.append(t - self.lastFrameT)
+        self.lastFrameT = t
+        self.frames += n
+        to_call, self._to_call = self._to_call, []
+        for function, args, kwargs in to_call:
+            function(*args, **kwargs)
+        return t
+
+    def close(self):
+        pass
+
+
+class StubStim(object):
+    # accepts anything a psychopy stimulus would; `set<Attr>(x)` just stores x
+    def __init__(self, name=''):
+        self.name = name
+        self.autoDraw = False
+
+    def setAutoDraw(self, value):
+        self.autoDraw = value
+
+    def draw(self):
+        pass
+
+    def __getattr__(self, attr):
+        if attr.startswith('set') and len(attr) > 3:
+            key = attr[3].lower() + attr[4:]
+            return lambda value, *args, **kwargs: setattr(self, key, value)
+        raise AttributeError(attr)
+
+
+class _Stream(object):
+    latency = 0.0
+
+
+class StubSound(object):
+    stream = _Stream()
+
+    def __init__(self):
+        self.plays = 0
+
+    def play(self):
+        self.plays += 1
+
+    def stop(self):
+        pass
+
+    def seek(self, t):
+        pass
+
+
+class Keyboard(object):
+    # TwoChoice.input() dispatches on `device.device.__name__`
+    pass
+
+
+class ForceTransducers(object):
+    # likewise for the force board
+    pass
+
+
+class SimulatedResponder(object):
+    """
+    Plays the part of `MultiprocessInput(Keyboard, ...)`.
+
+    When a trial starts, `response` is asked for (time from trial start, finger) of the
+    press; the press is released `hold` seconds later. Whenever the experiment waits for
+    a press to continue (`wait`, or `post_trial` after a missed response) one is made
+    after `continue_delay`. `read` returns every event up to the current (virtual) time,
+    in the same format as the real device.
+    """
+    device = Keyboard
+
+    def __init__(self, hold=0.15, continue_delay=0.3, continue_key=0):
+        self.hold = hold
+        self.continue_delay = continue_delay
+        self.continue_key = continue_key
+        self.experiment = None
+        self.pending = []  # (time, key, state), sorted by time
+        self._trial_start = None
+
+    def attach(self, experiment):
+        self.experiment = experiment
+
+    def response(self, trial, trial_index):
+        raise NotImplementedError
+
+    def press(self, t, key):
+        self.pending.append((t, key, True))
+        self.pending.append((t + self.hold, key, False))
+        self.pending.sort()
+
+    def schedule(self, now):
+        # decide on new presses, if the experiment is waiting for one
+        exp = self.experiment
+        if exp.trial_start != self._trial_start and exp.state in ('enter_trial', 'first_target'):
+            self._trial_start = exp.trial_start
+            resp = self.response(exp.trial_plan[exp.trial_counter], exp.trial_counter)
+            if resp is not None:
+                self.press(exp.trial_start + resp[0], resp[1])
+        elif not self.pending and exp.state in ('wait', 'post_trial') and np.isnan(exp.first_press):
+            self.press(now + self.continue_delay, self.continue_key)
+
+    def read(self):
+        now = self.experiment.global_clock.getTime()
+        self.schedule(now)
+        n = 0
+        while n < len(self.pending) and self.pending[n][0] <= now:
+            n += 1
+        if n == 0:
+            return None, None
+        events, self.pending = self.pending[:n], self.pending[n:]
+        times = np.array([e[0] for e in events])
+        keys = np.array([[e[1]] for e in events])
+        states = np.array([[e[2]] for e in events])
+        return times, (states, keys)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class ScriptedResponder(SimulatedResponder):
+    # `responses[i]` is (time from trial start, finger) for trial i, or None for no press
+    def __init__(self, responses, **kwargs):
+        super(ScriptedResponder, self).__init__(**kwargs)
+        self.responses = responses
+
+    def response(self, trial, trial_index):
+        if trial_index < len(self.responses):
+            return self.responses[trial_index]
+        return None
+
+
+class StochasticResponder(SimulatedResponder):
+    """
+    Aims for the last beep (normal timing error, sd `timing_sd`). On switch trials, the
+    probability of pressing the second target grows logistically with the time between
+    the switch and the press (midpoint `threshold`, scale `slope`); otherwise the first
+    target is pressed. With probability `lapse` either target is pressed at random.
+    """
+
+    def __init__(self, threshold=0.25, slope=0.03, lapse=0.02, timing_sd=0.05,
+                 seed=None, **kwargs):
+        super(StochasticResponder, self).__init__(**kwargs)
+        self.threshold = threshold
+        self.slope = slope
+        self.lapse = lapse
+        self.timing_sd = timing_sd
+        self.rng = np.random.default_rng(seed)
+
+    def response(self, trial, trial_index):
+        last_beep = self.experiment.last_beep_time
+        t = last_beep + self.rng.normal(0, self.timing_sd)
+        if self.rng.random() < self.lapse:
+            return t, trial.first if self.rng.random() < 0.5 else trial.second
+        p = 1.0
+        if trial.is_switch:
+            prep = t - (last_beep - trial.switch_time)
+            p = 1.0 / (1.0 + np.exp(-(prep - self.threshold) / self.slope))
+        return t, trial.second if self.rng.random() < p else trial.first
+
+
+class BurstResponder(StochasticResponder):
+    # every press comes with `burst` taps of other keys within `spread` seconds
+    def __init__(self, burst=8, spread=0.01, **kwargs):
+        super(BurstResponder, self).__init__(**kwargs)
+        self.burst = burst
+        self.spread = spread
+
+    def press(self, t, key):
+        others = [k for k in range(10) if k != key]
+        for k in self.rng.choice(others, self.burst):
+            dt = self.rng.uniform(0, self.spread)
+            self.pending.append((t + dt, int(k), True))
+            self.pending.append((t + 2 * dt, int(k), False))
+        super(BurstResponder, self).press(t, key)
+
+
+class SimulatedForces(StochasticResponder):
+    """
+    Plays the part of `MultiprocessInput(ForceTransducers, ...)`, pressing like a
+    StochasticResponder. `read` returns every sample (at `rate` Hz) up to the current time:
+    `baseline` plus noise on all 10 channels, and a press ramps the finger's channel
+    up by `force` over `rise` seconds and back down after `hold`.
+    """
+    device = ForceTransducers
+
+    def __init__(self, rate=1000.0, baseline=3.0, force=8.0, noise=0.1, rise=0.02, **kwargs):
+        super(SimulatedForces, self).__init__(**kwargs)
+        self.rate = rate
+        self.baseline = baseline
+        self.force = force
+        self.noise = noise
+        self.rise = rise
+        self.next_sample = None
+
+    def press(self, t, key):
+        self.pending.append((t, t + self.hold, key))
+
+    def read(self):
+        now = self.experiment.global_clock.getTime()
+        self.schedule(now)
+        if self.next_sample is None:
+            self.next_sample = now
+        n = int(np.floor((now - self.next_sample) * self.rate)) + 1
+        if n <= 0:
+            return None, None
+        times = self.next_sample + np.arange(n) / self.rate
+        self.next_sample = times[-1] + 1.0 / self.rate
+        data = self.baseline + self.rng.normal(0, self.noise, (n, 10))
+        for on, off, key in self.pending:
+            data[:, key] += self.force * np.clip((times - on) / self.rise, 0, 1) * \
+                np.clip((off + self.rise - times) / self.rise, 0, 1)
+        self.pending = [p for p in self.pending if p[1] + self.rise > times[-1]]
+        return times, data
+
+
+class HeadlessMixin(object):
+    num_targets = 2
+
+    def setup_clocks(self):
+        self.global_clock = VirtualClock()
+
+    def setup_window(self, settings):
+        self.win = NullWindow(self.global_clock,
+                              refresh_rate=settings.get('refresh_rate', 60.0),
+                              drop_prob=settings.get('drop_prob', 0.0),
+                              seed=settings.get('seed'))
+
+    def measure_frame_period(self):
+        return self.win.monitorFramePeriod
+
+    def setup_visuals(self):
+        self.targets = [StubStim('target' + str(i)) for i in range(self.num_targets)]
+        self.background = StubStim('background')
+        self.push_feedback = StubStim('push_feedback')
+        self.fixation = StubStim('fixation')
+        self.wait_text = StubStim('wait_text')
+        self.wait_text.autoDraw = True
+        self.good = StubStim('good_text')
+        self.too_slow = StubStim('slow_text')
+        self.too_fast = StubStim('fast_text')
+
+    def setup_audio(self):
+        self.beep = StubSound()
+        self.coin = StubSound()
+
+    def setup_device(self, settings):
+        self.device = settings.get('responder') or StochasticResponder(seed=settings.get('seed'))
+        self.device.attach(self)
+
+
+class HeadlessTwoChoice(HeadlessMixin, TwoChoice):
+    pass
+
+
+class HeadlessMultiChoice(HeadlessMixin, MultiChoice):
+    num_targets = 10
+
+    def setup_visuals(self):
+        HeadlessMixin.setup_visuals(self)
+        self.target_stim = StubStim('targets')
+        self.targets = TargetArray(self.target_stim, self.num_targets, (0.3, -0.2, -0.2))
+        self.backgrounds = {None: self.background, self.good: StubStim('background_good'),
+                            self.too_slow: StubStim('background_slow'),
+                            self.too_fast: StubStim('background_fast')}
+        self.shown_background = None
+
+
+def run(experiment, max_frames=1000000, blocks=None):
+    # the exp.py main loop, minus the mouse (`blocks`: a session.BlockQueue of the blocks after this one)
+    frames = 0
+    with experiment.device:
+        while True:
+            while experiment.state != 'cleanup':
+                experiment.input()
+                experiment.draw_input()
+                experiment.step()
+                experiment.win.flip()
+                frames += 1
+                if frames >= max_frames:
+                    experiment.to_cleanup()
+            if frames >= max_frames or blocks is None or not blocks.advance():
+                break
+    if blocks is not None:
+        blocks.close()
+    experiment.win.close()
+    return frames
+
+
+def simulate_session(settings, responder=None, max_frames=1000000):
+    # settings['trial_table'] can be several tables (see session.py)
+    tables = split_tables(settings['trial_table'])
+    settings = dict(settings, responder=responder, trial_table=tables[0])
+    cls = HeadlessTwoChoice if settings.get('twochoice', True) else HeadlessMultiChoice
+    experiment = cls(settings=settings)
+    blocks = BlockQueue(experiment, tables[1:]) if len(tables) > 1 else None
+    t0 = time.perf_counter()
+    frames = run(experiment, max_frames, blocks)
+    return {'subject': settings['subject'],
+            'summary_file_name': experiment.summary_file_name,
+            'summary_file_names': experiment.summary_file_names,
+            'trials': experiment.trial_counter,
+            'frames': frames,
+            'sim_time': experiment.global_clock.getTime(),
+            'wall_time': time.perf_counter() - t0}
+
+
+def _simulate_one(job):
+    seed, settings, responder_kwargs = job
+    settings = dict(settings, subject='sim%05d' % seed, seed=seed)
+    responder = StochasticResponder(seed=seed, **responder_kwargs)
+    return simulate_session(settings, responder)
+
+
+def simulate_sessions(n, settings, responder_kwargs=None, processes=None, first_seed=0):
+    # one StochasticResponder per session, seeded by session number
+    jobs = [(first_seed + i, settings, responder_kwargs or {}) for i in range(n)]
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(_simulate_one, jobs, chunksize=max(1, n // 64)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate sessions without a display.')
+    parser.add_argument('trial_table')
+    parser.add_argument('-n', '--sessions', type=int, default=1)
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    parser.add_argument('--data-dir', default='data_sim')
+    parser.add_argument('--adaptive', action='store_true')
+    parser.add_argument('--multi', action='store_true')
+    parser.add_argument('--refresh-rate', type=float, default=60.0)
+    parser.add_argument('--drop-prob', type=float, default=0.0)
+    args = parser.parse_args()
+
+    settings = {'fullscreen': False,
+                'forceboard': False,
+                'twochoice': not args.multi,
+                'trial_table': args.trial_table,
+                'adaptive': args.adaptive,
+                'data_dir': args.data_dir,
+                'refresh_rate': args.refresh_rate,
+                'drop_prob': args.drop_prob}
+    t0 = time.perf_counter()
+    results = simulate_sessions(args.sessions, settings, processes=args.processes)
+    wall = time.perf_counter() - t0
+    frames = sum(r['frames'] for r in results)
+    print('%d sessions, %d trials, %d frames in %.2f s (%.0f frames/s)' %
+          (len(results), sum(r['trials'] for r in results), frames, wall, frames / wall))
@@ -0,0 +1,186 @@
+"""
+Several input devices in one session, each in its own process, merged into one stream.
+
+Every device process writes what it reads into a single ring buffer in shared memory
+(one row per sample/event: time, source, data), so the experiment's `read` is one
+slice of that buffer per frame whatever the number of devices, and nothing is pickled
+after the processes start. Timestamps are all on the parent's clock (`mono_clock`),
+whatever process they are taken in.
+
+    hub = InputHub([HubDevice(ForceTransducers, 10, pack_samples),
+                    HubDevice(Keyboard, 2, pack_keyboard, keys=list('awefvbhuil'))],
+                   clock=mono_clock)
+    with hub:
+        times, (sources, rows) = hub.read()  # time-ordered, rows padded with nan
+
+The device classes follow the toon device protocol (what `MultiprocessInput` runs):
+made with a `clock=` argument in the child process, used as a context manager, and
+`read()` returns `(timestamp(s), data)` or `(None, None)`.
+"""
+import multiprocessing as mp
+import time
+
+import numpy as np
+
+
+def pack_samples(data, channels):
+    # (n, channels) samples, e.g. forces
+    return np.asarray(data, dtype=np.float64).reshape(-1, channels)
+
+
+def pack_keyboard(data, channels):
+    # keyboard reads are (states, keys), one row per event -> [state, key]
+    return np.column_stack((np.asarray(data[0], dtype=np.float64),
+                            np.asarray(data[1], dtype=np.float64)))
+
+
+class HubDevice(object):
+    """
+    How to run one device: its class and keyword arguments (made in the child process,
+    so they need to be picklable), how many values one row has, and `pack(data, channels)`
+    turning a read into (n, channels) rows.
+    """
+
+    def __init__(self, device, channels, pack=pack_samples, poll=0.0005, **kwargs):
+        self.device = device
+        self.channels = channels
+        self.pack = pack
+        self.poll = poll  # sleep between reads that return nothing
+        self.kwargs = kwargs
+
+    @property
+    def name(self):
+        return self.device.__name__
+
+
+class SharedRing(object):
+    """
+    Rows of (time, source, values...) in shared memory. Writers (any process) take
+    `lock` for each write and bump `count` (rows ever written) once the rows are in
+    place; the one reader keeps its own position and never takes the lock.
+    """
+
+    def __init__(self, capacity, width, arrays=None):
+        self.capacity = capacity
+        self.width = width
+        if arrays is None:
+            arrays = (mp.RawArray('d', capacity * (2 + width)), mp.RawValue('q', 0), mp.Lock())
+        self.arrays = arrays  # what a child process needs to attach
+        buf, self._count, self.lock = arrays
+        self.rows = np.frombuffer(buf, dtype=np.float64).reshape(capacity, 2 + width)
+        self.read_count = 0
+        self.dropped = 0  # rows overwritten before they were read
+
+    @property
+    def count(self):
+        return self._count.value
+
+    def write(self, source, timestamps, values):
+        n, c = values.shape
+        with self.lock:
+            start = self._count.value
+            idx = np.arange(start, start + n) % self.capacity
+            self.rows[idx, 0] = timestamps
+            self.rows[idx, 1] = source
+            self.rows[idx, 2:2 + c] = values
+            self.rows[idx, 2 + c:] = np.nan
+            self._count.value = start + n
+
+    def read(self):
+        # (n, 2 + width) copy of every row since the last read
+        end = self._count.value
+        start = self.read_count
+        if end - start > self.capacity:
+            self.dropped += end - start - self.capacity
+            start = end - self.capacity
+        self.read_count = end
+        if start == end:
+            return None
+        s, e = start % self.capacity, end % self.capacity
+        if s < e:
+            return self.rows[s:e].copy()
+        return np.concatenate((self.rows[s:], self.rows[:e]))
+
+
+class _Clock(object):
+    # the parent's clock, from perf_counter (system-wide) and the offset between the two
+    def __init__(self, offset):
+        self.offset = offset
+
+    def getTime(self):
+        return time.perf_counter() - self.offset
+
+
+def _device_loop(spec, source, arrays, capacity, width, offset, ready, stop):
+    ring = SharedRing(capacity, width, arrays)
+    clock = _Clock(offset)
+    device = spec.device(clock=clock.getTime, **spec.kwargs)
+    with device:
+        ready.set()
+        while not stop.is_set():
+            timestamp, data = device.read()
+            if timestamp is None:
+                time.sleep(spec.poll)
+                continue
+            values = spec.pack(data, spec.channels)
+            timestamps = np.broadcast_to(np.asarray(timestamp, dtype=np.float64).reshape(-1),
+                                         (values.shape[0],))
+            ring.write(source, timestamps, values)
+
+
+class InputHub(object):
+    """
+    Runs one process per `HubDevice` (from `__enter__` to `__exit__`). `read` returns
+    `(times, (sources, rows))` for everything since the last read, sorted by time (ties
+    keep arrival order), or `(None, None)`. `sources` indexes into `devices`, `rows` is
+    (n, max channels) with unused columns nan. `clock` is the clock timestamps are on
+    (an object with getTime, e.g. toon's mono_clock).
+    """
+
+    def __init__(self, devices, clock, capacity=1 << 16):
+        self.devices = list(devices)
+        self.device = type(self)  # like MultiprocessInput.device, for code that checks the name
+        self.names = [d.name for d in self.devices]
+        self.clock = clock
+        self.width = max(d.channels for d in self.devices)
+        self.ring = SharedRing(capacity, self.width)
+        self.processes = []
+        self._stop = None
+
+    def __enter__(self):
+        self._stop = mp.Event()
+        offset = time.perf_counter() - self.clock.getTime()
+        readies = []
+        for source, spec in enumerate(self.devices):
+            ready = mp.Event()
+            process = mp.Process(target=_device_loop, name='InputHub-' + spec.name,
+                                 args=(spec, source, self.ring.arrays, self.ring.capacity,
+                                       self.width, offset, ready, self._stop), daemon=True)
+            process.start()
+            self.processes.append(process)
+            readies.append(ready)
+        for ready, process in zip(readies, self.processes):
+            while not ready.wait(0.1):
+                if not process.is_alive():
+                    self.__exit__()
+                    raise RuntimeError('%s exited during startup' % process.name)
+        return self
+
+    def __exit__(self, *args):
+        if self._stop is not None:
+            self._stop.set()
+        for process in self.processes:
+            process.join(1.0)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+    def read(self):
+        rows = self.ring.read()
+        if rows is None:
+            return None, None
+        times = rows[:, 0]
+        if rows.shape[0] > 1 and (times[1:] < times[:-1]).any():
+            rows = rows[np.argsort(times, kind='stable')]
+            times = rows[:, 0]
+        return times, (rows[:, 1].astype(np.intp), rows[:, 2:])
@@ -0,0 +1,170 @@
+"""
+Every raw sample of a session in a memory-mapped file, with markers (trial starts and
+state changes) that index into it.
+
+    <base>_stream.bin         samples: time (f8) + one column per channel
+    <base>_stream_marks.bin   markers: sample index, time, trial, code
+    <base>_stream.json        layouts, sample/marker counts, marker code names
+
+Both files are preallocated and grown in chunks, so recording one read is a slice copy.
+Offline, `load_stream` maps them (nothing is read until sliced) and `trial_samples`
+gives one trial's samples:
+
+    stream = load_stream('data/001/id_001_block1_120000')
+    t, forces = trial_samples(stream, 12)
+"""
+import json
+import os.path as op
+
+import numpy as np
+
+# marker codes >= 0 are indices into the state list saved with the stream
+TRIAL_START = -1
+
+
+class MappedArray(object):
+    """
+    A 1D structured array backed by a file that grows by `chunk` rows when full.
+    Rows past `count` are unused; `close` truncates the file to `count` rows.
+    """
+
+    def __init__(self, file_name, dtype, chunk):
+        self.file_name = file_name
+        self.dtype = np.dtype(dtype)
+        self.chunk = chunk
+        self.count = 0
+        self.closed = False
+        open(file_name, 'wb').close()
+        self._map(chunk)
+
+    def _map(self, rows):
+        with open(self.file_name, 'r+b') as f:
+            f.truncate(rows * self.dtype.itemsize)
+        self.rows = np.memmap(self.file_name, dtype=self.dtype, mode='r+', shape=(rows,))
+
+    def reserve(self, n):
+        # room for `n` more rows, as a view to write into
+        if self.count + n > self.rows.shape[0]:
+            size = self.rows.shape[0]
+            self.rows.flush()
+            del self.rows
+            self._map(size + self.chunk * (1 + n // self.chunk))
+        out = self.rows[self.count:self.count + n]
+        self.count += n
+        return out
+
+    def flush(self):
+        self.rows.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.rows.flush()
+        del self.rows
+        with open(self.file_name, 'r+b') as f:
+            f.truncate(self.count * self.dtype.itemsize)
+
+
+class InputStream(object):
+    """
+    Records the raw samples of a device for a whole session, see the module docstring.
+
+    `extend` takes a read as returned by the device (timestamps, (n, channels) data);
+    `mark` records the current sample count with a time, trial and code. Both do nothing
+    once the stream is closed.
+    """
+
+    def __init__(self, base_name, channels, state_names=(), chunk=60 * 1000, dtype='f8'):
+        self.base_name = base_name
+        self.channels = channels
+        self.state_names = list(state_names)
+        self.samples = MappedArray(base_name + '_stream.bin',
+                                   [('time', 'f8'), ('data', dtype, (channels,))], chunk)
+        self.marks = MappedArray(base_name + '_stream_marks.bin',
+                                 [('sample', 'i8'), ('time', 'f8'), ('trial', 'i4'), ('code', 'i2')],
+                                 1024)
+        self._write_layout()
+
+    @property
+    def count(self):
+        return self.samples.count
+
+    def extend(self, timestamps, data):
+        if self.samples.closed:
+            return
+        data = np.asarray(data).reshape(-1, self.channels)
+        rows = self.samples.reserve(data.shape[0])
+        rows['time'] = timestamps
+        rows['data'] = data
+
+    def mark(self, time, trial, code):
+        if self.samples.closed:  # e.g. the change into cleanup, which closes the stream
+            return
+        row = self.marks.reserve(1)
+        row['sample'] = self.samples.count
+        row['time'] = time
+        row['trial'] = trial
+        row['code'] = code
+
+    def close(self):
+        if self.samples.closed:
+            return
+        self.samples.close()
+        self.marks.close()
+        self._write_layout()
+
+    def _write_layout(self):
+        layout = {'samples': self.samples.dtype.descr, 'marks': self.marks.dtype.descr,
+                  'sample_count': self.samples.count, 'mark_count': self.marks.count,
+                  'codes': {str(TRIAL_START): 'trial_start'}}
+        layout['codes'].update({str(i): s for i, s in enumerate(self.state_names)})
+        with open(self.base_name + '_stream.json', 'w') as f:
+            json.dump(layout, f)
+
+
+def _load_rows(file_name, descr):
+    dtype = np.dtype([tuple(d) for d in descr])
+    n = op.getsize(file_name) // dtype.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(file_name, dtype=dtype, mode='r', shape=(n,))
+
+
+def _trim(rows):
+    used = np.flatnonzero(rows['time'] != 0)
+    return rows[:used[-1] + 1 if used.size else 0]
+
+
+def load_stream(base_name):
+    """
+    Memory-mapped 'samples' and 'marks', plus the 'codes' of the markers.
+
+    If the session did not close cleanly, the files still have their unused
+    preallocated rows; those are dropped using the timestamps (unused rows are zero).
+    """
+    with open(base_name + '_stream.json', 'r') as f:
+        layout = json.load(f)
+    samples = _load_rows(base_name + '_stream.bin', layout['samples'])
+    marks = _load_rows(base_name + '_stream_marks.bin', layout['marks'])
+    if samples.shape[0] > layout['sample_count'] or marks.shape[0] > layout['mark_count']:
+        samples, marks = _trim(samples), _trim(marks)
+    return {'samples': samples, 'marks': marks,
+            'codes': {int(k): v for k, v in layout['codes'].items()}}
+
+
+def trial_bounds(stream):
+    # (trial, trial start time, first sample, end sample) for every trial start marker
+    marks = stream['marks']
+    starts = marks[marks['code'] == TRIAL_START]
+    ends = np.append(starts['sample'][1:], stream['samples'].shape[0])
+    return np.rec.fromarrays((starts['trial'], starts['time'], starts['sample'], ends),
+                             names=('trial', 'time', 'start', 'stop'))
+
+
+def trial_samples(stream, trial):
+    # timestamps and (n, channels) data of one trial, as views into the mapped file
+    bounds = trial_bounds(stream)
+    row = bounds[bounds['trial'] == trial][-1]
+    rows = stream['samples'][row['start']:row['stop']]
+    return rows['time'], rows['data']
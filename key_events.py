@@ -0,0 +1,80 @@
+import numpy as np
+
+
+class KeyEventLog(object):
+    """
+    Every press/release since the last `clear`, plus the current key state as a bitmask.
+
+    `extend` takes a whole read from the keyboard at once (timestamps, states, keys, in
+    the order they happened) and only does a fixed number of vectorized operations on it,
+    so a read with many events costs about the same as a read with one. Events are kept
+    in preallocated arrays that grow (by doubling) only if a trial has more than
+    `capacity` of them.
+    """
+
+    def __init__(self, num_keys=10, capacity=256):
+        self.num_keys = num_keys
+        self.time = np.full(capacity, np.nan)
+        self.key = np.zeros(capacity, dtype=np.int8)
+        self.state = np.zeros(capacity, dtype=bool)
+        self.count = 0  # events since the last clear
+        self.mask = 0  # bit k is set while key k is down
+        self._bits = 1 << np.arange(num_keys)
+        self._last = np.empty(num_keys, dtype=np.intp)
+
+    def clear(self):
+        # forget the events, but not which keys are still down
+        self.count = 0
+
+    def reset(self):
+        # forget the events and the key state
+        self.count = 0
+        self.mask = 0
+
+    def extend(self, timestamps, states, keys):
+        """
+        Append one read. Returns the index (into this read) of the first press,
+        or -1 if the read had no presses.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64).reshape(-1)
+        states = np.asarray(states, dtype=bool).reshape(-1)
+        keys = np.asarray(keys).reshape(-1)
+        n = keys.shape[0]
+        if self.count + n > self.time.shape[0]:
+            self._grow(self.count + n)
+        sl = slice(self.count, self.count + n)
+        self.time[sl] = timestamps
+        self.key[sl] = keys
+        self.state[sl] = states
+        self.count += n
+
+        # the last event for each key decides its state
+        last = self._last
+        last.fill(-1)
+        np.maximum.at(last, keys, np.arange(n))
+        touched = last >= 0
+        down = np.zeros(self.num_keys, dtype=bool)
+        down[touched] = states[last[touched]]
+        self.mask = (self.mask & ~int(self._bits[touched].sum())) | int(self._bits[down].sum())
+
+        if not states.any():
+            return -1
+        return int(states.argmax())
+
+    def _grow(self, n):
+        size = self.time.shape[0]
+        while size < n:
+            size *= 2
+        for name in ('time', 'key', 'state'):
+            old = getattr(self, name)
+            new = np.zeros(size, dtype=old.dtype)
+            new[:old.shape[0]] = old
+            setattr(self, name, new)
+
+    def is_down(self, key):
+        return bool(self.mask >> key & 1)
+
+    def events(self):
+        # (time, key, state) of every event since the last clear (views, copy to keep)
+        n = self.count
+        return self.time[:n], self.key[:n], self.state[:n]
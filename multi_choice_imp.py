@@ -1,20 +1,17 @@
-from psychopy import prefs
+from target_array import TargetArray
 from two_choice_imp import TwoChoice
 
-# we need to set prefs *before* setting the other stuff
-prefs.general['audioLib'] = ['sounddevice']
-from psychopy import visual
-
 class MultiChoice(TwoChoice):
     def __init__(self, settings=None):
         super(MultiChoice, self).__init__(settings=settings)
 
     def setup_visuals(self):
+        from psychopy import visual
         right_hand = visual.ImageStim(self.win, image='media/hand.png', size=(0.4, 0.4), 
                                       pos=(0.3, 0), ori=-90)
         left_hand = visual.ImageStim(self.win, image='media/hand.png', size=(0.4, 0.4), 
                                      pos=(-0.3, 0), ori=90, flipHoriz=True)
-        self.background = visual.BufferImageStim(self.win, stim=[left_hand, right_hand])
+        self.background = visual.BufferImageStim(self.win, stim=[left_hand, right_hand], autoLog=False)
         # self.background.autoDraw = True
         # thumb, index, middle, ring, pinky
         pos_r = [[0.3075, -0.1525], [0.1775, -0.06125], [0.14375, 0.02375], [0.1775, 0.0925], [0.2475, 0.1525]]
@@ -23,43 +20,75 @@ class MultiChoice(TwoChoice):
         pos_l.reverse()
         pos_l.extend(pos_r)
 
-        self.targets = [visual.Circle(self.win, fillColor=(0.3, -0.2, -0.2), pos=x, 
-                                      size=0.05, opacity=1.0) 
-                        for x in pos_l]
-        
+        # all targets are one stimulus (see target_array.py), drawn from remove_text on
+        self.target_stim = visual.ElementArrayStim(self.win, nElements=len(pos_l), xys=pos_l, sizes=0.05,
+                                                   elementTex=None, elementMask='circle', colorSpace='rgb',
+                                                   colors=(0.3, -0.2, -0.2), opacities=0.0,
+                                                   autoLog=False, name='targets')
+        self.targets = TargetArray(self.target_stim, len(pos_l), (0.3, -0.2, -0.2))
+
         # push feedback
         self.push_feedback = visual.Circle(self.win, size=0.1, fillColor=[-1, -1, -1], pos=(0, 0),
                                            autoDraw=False, autoLog=False, name='push_feedback')
         # fixation
         self.fixation = visual.Circle(self.win, size=0.05, fillColor=[1, 1, 1], pos=(0, 0),
-                                      autoDraw=False, name='fixation')
+                                      autoDraw=False, autoLog=False, name='fixation')
 
         # text
-        self.wait_text = visual.TextStim(self.win, text='Press a key to start.', pos=(0, 0),
+        self.wait_text = visual.TextStim(self.win, text=self.wait_message(), pos=(0, 0),
                                          units='norm', color=(1, 1, 1), height=0.2,
                                          alignHoriz='center', alignVert='center', name='wait_text',
                                          autoLog=False, wrapWidth=2)
         self.wait_text.autoDraw = True
         self.good = visual.TextStim(self.win, text=u'Good timing!', pos=(0, 0.4),
                                     units='norm', color=(-1, 1, 0.2), height=0.1,
-                                    alignHoriz='center', alignVert='center', autoLog=True, name='good_text')
+                                    alignHoriz='center', alignVert='center', autoLog=False, name='good_text')
         self.too_slow = visual.TextStim(self.win, text=u'Too slow.', pos=(0, 0.4),
                                         units='norm', color=(1, -1, -1), height=0.1,
-                                        alignHoriz='center', alignVert='center', autoLog=True, name='slow_text')
+                                        alignHoriz='center', alignVert='center', autoLog=False, name='slow_text')
         self.too_fast = visual.TextStim(self.win, text=u'Too fast.', pos=(0, 0.4),
                                         units='norm', color=(1, -1, -1), height=0.1,
-                                        alignHoriz='center', alignVert='center', autoLog=True, name='fast_text')
-    
+                                        alignHoriz='center', alignVert='center', autoLog=False, name='fast_text')
+        # the feedback texts are rendered once, into copies of the background: showing one
+        # is swapping which background is drawn (depth 1 keeps it behind everything else)
+        self.backgrounds = {None: self.background}
+        for text in (self.good, self.too_slow, self.too_fast):
+            self.backgrounds[text] = visual.BufferImageStim(self.win, stim=[left_hand, right_hand, text],
+                                                              autoLog=False)
+        for background in self.backgrounds.values():
+            background.depth = 1
+        self.shown_background = None
+
+    def wait_message(self):
+        return 'Press a key to start.'
+
+    def target_index(self, targets, table):
+        # one target per finger
+        return targets
+
     def remove_text(self):
         self.wait_text.autoDraw = False
         self.background.autoDraw = True
+        self.target_stim.autoDraw = True
         self.push_feedback.autoDraw = True
         self.fixation.autoDraw = True
-    
-    def show_first_target(self):
-        self.targets[int(self.trial_table['first'][self.trial_counter])].autoDraw = True
-    
-    def show_second_target(self):
-        self.targets[int(self.trial_table['first'][self.trial_counter])].autoDraw = False
-        self.targets[int(self.trial_table['second'][self.trial_counter])].autoDraw = True
-        self.win.callOnFlip(self.log_switch_time)
+        self.log_stims(('wait_text', False), ('background', True), ('push_feedback', True),
+                       ('fixation', True))
+
+    def show_background(self, text):
+        if text is not self.shown_background:
+            self.backgrounds[self.shown_background].autoDraw = False
+            self.backgrounds[text].autoDraw = True
+            self.shown_background = text
+
+    def show_feedback_text(self, text):
+        self.show_background(text)
+
+    def hide_feedback_text(self):
+        self.show_background(None)
+
+    def fill_targets(self, color):
+        self.targets.fill(color)
+
+    def hide_targets(self):
+        self.targets.hide()
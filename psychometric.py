@@ -0,0 +1,215 @@
+"""
+Psychometric fits for every subject x condition (fixed/adaptive) x task (two/multi) in
+the store (see aggregate.py), with bootstrap confidence intervals.
+
+The model is the one Quest uses (adaptive.py), with the lapse rate fitted as well:
+
+    p(correct | prep) = guess + (1 - guess - lapse) / (1 + exp(-(prep - threshold) / slope))
+
+`guess` is chance (1 / number of targets), not fitted. Switch trials with a response
+are binned by realized prep time (`bin_width`), so a group is a few dozen
+(correct, total) counts, and the log-likelihood of every point of a threshold x slope x
+lapse grid is two matrix products. The fit is the maximum of a coarse grid, refined on
+a finer one (see PsychometricGrid).
+
+A bootstrap resample of a group is a multinomial draw of its trials over the
+(bin, correct) cells. Thousands of them are drawn at once and fitted in one batch, and
+the batches of every group are spread over a process pool:
+
+    python psychometric.py data/_store --boot 2000 -j 8 --out fits.csv
+"""
+import argparse
+import csv
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from aggregate import load_store
+
+fit_columns = ['subject', 'condition', 'task', 'trials', 'guess', 'threshold', 'slope', 'lapse',
+               'threshold_lo', 'threshold_hi', 'slope_lo', 'slope_hi', 'lapse_lo', 'lapse_hi']
+
+
+class PsychometricGrid(object):
+    """
+    Maximum likelihood by grid search. `fit` evaluates a coarse grid (every combination of
+    `thresholds`, `slopes` and `lapses`) for a batch of data sets, then a finer grid
+    (`fine` points per parameter) over the box that the batch's coarse maxima span, one
+    coarse step wider on each side (but not past the coarse grid). Each stage is two matrix products of the counts with
+    tables of log p.
+    """
+
+    def __init__(self, thresholds=None, slopes=None, lapses=None, fine=(16, 12, 6)):
+        self.thresholds = np.linspace(0.0, 0.7, 15) if thresholds is None else np.asarray(thresholds)
+        self.slopes = np.geomspace(0.005, 0.2, 8) if slopes is None else np.asarray(slopes)
+        self.lapses = np.linspace(0.0, 0.1, 4) if lapses is None else np.asarray(lapses)
+        self.fine = fine
+        self.points = self.combine(self.thresholds, self.slopes, self.lapses)
+        # coarse steps (slopes are spaced in log)
+        self.steps = np.array([np.diff(self.thresholds).max(), np.diff(np.log(self.slopes)).max(),
+                               np.diff(self.lapses).max()])
+        self.bounds = np.array([[self.thresholds.min(), np.log(self.slopes.min()), self.lapses.min()],
+                                [self.thresholds.max(), np.log(self.slopes.max()), self.lapses.max()]])
+
+    @staticmethod
+    def combine(thresholds, slopes, lapses):
+        t, s, l = np.meshgrid(thresholds, slopes, lapses, indexing='ij')
+        return np.stack((t.ravel(), s.ravel(), l.ravel()), axis=1)  # (n, 3)
+
+    @staticmethod
+    def log_p(points, prep, guess):
+        # log p(correct) and log p(error) at each point (rows) and prep time (columns)
+        t, s, l = (points[:, j, None] for j in range(3))
+        p = guess + (1 - guess - l) / (1 + np.exp((t - prep[None, :]) / s))
+        p = np.clip(p, 1e-12, 1 - 1e-12)
+        return np.log(p), np.log1p(-p)
+
+    @classmethod
+    def best(cls, points, prep, hits, wrong, guess):
+        # the point with the highest likelihood, for each row of `hits`/`wrong`
+        log_hit, log_miss = cls.log_p(points, prep, guess)
+        ll = hits.dot(log_hit.T) + wrong.dot(log_miss.T)  # (n, points)
+        return points[ll.argmax(axis=1)]
+
+    def fit(self, prep, hits, total, guess):
+        """
+        (threshold, slope, lapse) for each row of `hits` and `total` (counts per prep time
+        bin `prep`, (n, bins) or (bins,)), as (n, 3).
+        """
+        hits = np.atleast_2d(hits).astype(np.float64)
+        wrong = np.atleast_2d(total).astype(np.float64) - hits
+        coarse = self.best(self.points, prep, hits, wrong, guess)
+        coarse[:, 1] = np.log(coarse[:, 1])
+        # (within the coarse grid's range)
+        lo = np.maximum(coarse.min(axis=0) - self.steps, self.bounds[0])
+        hi = np.minimum(coarse.max(axis=0) + self.steps, self.bounds[1])
+        axes = [np.linspace(a, b, n) for a, b, n in zip(lo, hi, self.fine)]
+        points = self.combine(axes[0], np.exp(axes[1]), axes[2])
+        return self.best(points, prep, hits, wrong, guess)
+
+
+def bin_trials(prep, correct, bin_width=0.01):
+    # (bin centres, correct counts, totals) over the bins that have trials
+    bins = np.round(np.asarray(prep) / bin_width).astype(np.int64)
+    uniques, inverse = np.unique(bins, return_inverse=True)
+    total = np.bincount(inverse, minlength=uniques.size)
+    hits = np.bincount(inverse, weights=np.asarray(correct, dtype=np.float64), minlength=uniques.size)
+    return uniques * bin_width, hits, total
+
+
+def bootstrap_counts(hits, total, n_boot, rng):
+    # `n_boot` resamples of the trials, as (n_boot, bins) correct counts and totals
+    cells = np.concatenate((hits, total - hits)).astype(np.float64)
+    draws = rng.multinomial(int(total.sum()), cells / cells.sum(), size=n_boot)
+    k = hits.shape[0]
+    boot_hits = draws[:, :k]
+    return boot_hits, boot_hits + draws[:, k:]
+
+
+def _fit_batch(job):
+    # one batch of bootstrap fits of one group (runs in a worker process)
+    prep, hits, total, guess, grid, n_boot, seed, batch = job
+    rng = np.random.default_rng(seed)
+    fits = []
+    for start in range(0, n_boot, batch):
+        boot_hits, boot_total = bootstrap_counts(hits, total, min(batch, n_boot - start), rng)
+        fits.append(grid.fit(prep, boot_hits, boot_total, guess))
+    return np.concatenate(fits)
+
+
+def switch_trials(store):
+    # switch trials with a response and a prep time
+    return store['valid'] & (store['first_target'] != store['second_target']) & \
+        (store['correct'] >= 0) & np.isfinite(store['prep_time'])
+
+
+def groups(store, mask=None):
+    """
+    (subject, condition, task) codes -> row indices, for the rows in `mask` (default:
+    `switch_trials`).
+    """
+    mask = switch_trials(store) if mask is None else mask
+    rows = np.flatnonzero(mask)
+    keys = np.stack((store['subject'][rows], store['condition'][rows], store['task'][rows]), axis=1)
+    uniques, inverse = np.unique(keys, axis=0, return_inverse=True)
+    order = np.argsort(inverse.ravel(), kind='stable')
+    splits = np.cumsum(np.bincount(inverse.ravel(), minlength=len(uniques)))[:-1]
+    return [(tuple(int(k) for k in key), idx) for key, idx in zip(uniques, np.split(rows[order], splits))]
+
+
+def fit_cohort(store, grid=None, n_boot=2000, bin_width=0.01, processes=None, seed=0,
+               batch=250, shards=4, ci=95):
+    """
+    Fit every group of `groups(store)`. Returns one dict per group with `fit_columns`
+    (labels for subject/condition/task, the fit, and the `ci` percentile
+    interval of the bootstrap fits). `n_boot` resamples per group are drawn and fitted
+    `batch` at a time, split into `shards` jobs for the process pool (`processes`, None
+    for one per CPU; 0 fits in this process).
+    """
+    grid = PsychometricGrid() if grid is None else grid
+    categories = store['categories']
+    seeds = np.random.SeedSequence(seed)
+    jobs, fits = [], []
+    for (subject, condition, task), idx in groups(store):
+        prep, hits, total = bin_trials(store['prep_time'][idx], store['correct'][idx], bin_width)
+        targets = np.unique(np.concatenate((store['first_target'][idx], store['second_target'][idx])))
+        guess = 1.0 / max(2, targets.size)
+        best = grid.fit(prep, hits, total, guess)[0]
+        fits.append({'subject': categories['subject'][subject],
+                     'condition': categories['condition'][condition],
+                     'task': categories['task'][task], 'trials': int(total.sum()), 'guess': guess,
+                     'threshold': best[0], 'slope': best[1], 'lapse': best[2]})
+        per_shard = -(-n_boot // shards)
+        for shard, shard_seed in enumerate(seeds.spawn(shards)):
+            n = min(per_shard, n_boot - shard * per_shard)
+            if n > 0:
+                jobs.append((len(fits) - 1, (prep, hits, total, guess, grid, n, shard_seed, batch)))
+
+    if processes == 0:
+        results = [_fit_batch(job) for _, job in jobs]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(_fit_batch, [job for _, job in jobs]))
+    boots = [[] for _ in fits]
+    for (i, _), best in zip(jobs, results):
+        boots[i].append(best)
+    tails = [(100 - ci) / 2.0, 100 - (100 - ci) / 2.0]
+    for fit, best in zip(fits, boots):
+        if not best:
+            continue
+        points = np.concatenate(best)
+        for j, name in enumerate(('threshold', 'slope', 'lapse')):
+            fit[name + '_lo'], fit[name + '_hi'] = np.percentile(points[:, j], tails)
+    return fits
+
+
+def save_fits(fits, file_name):
+    with open(file_name, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(fit_columns)
+        writer.writerows([fit.get(k, '') for k in fit_columns] for fit in fits)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Psychometric fits per subject x condition x task.')
+    parser.add_argument('store', nargs='?', default='data/_store')
+    parser.add_argument('--boot', type=int, default=2000)
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='also write the fits here (csv)')
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    fits = fit_cohort(load_store(args.store), n_boot=args.boot, processes=args.processes, seed=args.seed)
+    print('%-10s %-9s %-5s %6s  %-22s %-22s %s' % ('subject', 'condition', 'task', 'trials',
+                                                 'threshold (95% ci)', 'slope', 'lapse'))
+    for fit in fits:
+        print('%-10s %-9s %-5s %6d  %.3f (%.3f-%.3f)    %.3f (%.3f-%.3f)    %.3f (%.3f-%.3f)' %
+              (fit['subject'], fit['condition'], fit['task'], fit['trials'],
+               fit['threshold'], fit.get('threshold_lo', np.nan), fit.get('threshold_hi', np.nan),
+               fit['slope'], fit.get('slope_lo', np.nan), fit.get('slope_hi', np.nan),
+               fit['lapse'], fit.get('lapse_lo', np.nan), fit.get('lapse_hi', np.nan)))
+    print('%d groups, %d bootstrap fits each, in %.2f s' % (len(fits), args.boot, time.perf_counter() - t0))
+    if args.out:
+        save_fits(fits, args.out)
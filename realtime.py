@@ -0,0 +1,199 @@
+"""
+Opt-in real-time mode (settings['realtime']).
+
+- The cyclic garbage collector is off from trial entry until the first frame of
+  `post_trial`, where it does a full collection; nothing it does can land mid-trial.
+  Everything allocated during setup is frozen first (Python 3.7+), so those collections
+  only walk what the session allocated since.
+- The render process and the device's child process (`MultiprocessInput`) are pinned
+  to separate cores, and the render process asks for a higher scheduling priority.
+  Whatever the OS doesn't permit is skipped, see `status`. Affinity is per thread on
+  Linux and inherited by threads started later, so `close` puts the render thread's
+  affinity and priority back before the next block starts its background threads.
+- Per trial, `<summary>_gc.csv` gets the allocations while the collector was off, how
+  long the collection took, and any collections that ran anyway (outside a trial).
+
+Affinity uses os.sched_setaffinity (Linux) or psutil, priority psutil or os.nice;
+psutil is optional.
+"""
+import gc
+import multiprocessing
+import os
+import sys
+import time
+
+try:
+    import psutil
+    _psutil_errors = (psutil.Error,)
+except ImportError:
+    psutil = None
+    _psutil_errors = ()
+
+
+def _available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def get_affinity(pid):
+    # the cores `pid` may run on, or None if unknown
+    try:
+        if hasattr(os, 'sched_getaffinity'):
+            return sorted(os.sched_getaffinity(pid))
+        if psutil is not None:
+            return psutil.Process(pid).cpu_affinity()
+    except (OSError,) + _psutil_errors:
+        pass
+    return None
+
+
+def set_affinity(pid, cores):
+    # True if it took
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(pid, set(cores))
+        elif psutil is not None:
+            psutil.Process(pid).cpu_affinity(list(cores))
+        else:
+            return False
+        return True
+    except (OSError,) + _psutil_errors:
+        return False
+
+
+def get_priority():
+    # psutil's nice value (the priority class on Windows), os.nice's, or None
+    try:
+        if psutil is not None:
+            return psutil.Process().nice()
+        if hasattr(os, 'nice'):
+            return os.nice(0)
+    except (OSError,) + _psutil_errors:
+        pass
+    return None
+
+
+def set_priority(value):
+    # back to a value from get_priority; True if it took
+    try:
+        if psutil is not None:
+            psutil.Process().nice(value)
+        elif hasattr(os, 'nice'):
+            os.nice(value - os.nice(0))
+        else:
+            return False
+        return True
+    except (OSError,) + _psutil_errors:
+        return False
+
+
+def raise_priority(nice=-10):
+    # True if it took (usually needs admin rights, or CAP_SYS_NICE on Linux)
+    try:
+        if psutil is not None:
+            psutil.Process().nice(psutil.HIGH_PRIORITY_CLASS if os.name == 'nt' else nice)
+        elif hasattr(os, 'nice'):
+            os.nice(nice - os.nice(0))
+        else:
+            return False
+        return True
+    except (OSError,) + _psutil_errors:
+        return False
+
+
+class RealtimeMode(object):
+    """
+    `start` once the experiment is set up (and `writer` is a TrialWriter with `header`
+    as its fields), `pin_device` once the device's process is running, then `hold` at
+    trial entry and `release` at the first flip of post_trial. `close` undoes what
+    `start` did (collector, render thread affinity and priority), so a session of several
+    blocks starts/closes per block, and each block's writer and worker threads are
+    started unpinned. Both are called from the render thread.
+    """
+    header = ['index', 'held_allocations', 'held_blocks', 'collect_ms', 'collected',
+              'other_collections', 'other_ms']
+
+    def __init__(self, render_core=None, device_core=None, priority=True):
+        self.writer = None
+        cores = _available_cores()
+        self.render_core = cores[-1] if render_core is None else render_core
+        self.device_core = (cores[-2] if len(cores) > 1 else None) if device_core is None else device_core
+        self.priority = priority
+        self.status = {}
+        self.row = dict.fromkeys(self.header, 0)
+        self.held = False
+        self._gc_start = 0.0
+        # collections the collector started by itself (i.e. outside hold/release)
+        self.collections = 0
+        self.pause = 0.0
+        self._affinity = None
+        self._priority = None
+
+    def start(self):
+        if hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+        gc.callbacks.append(self._on_gc)
+        self._affinity = get_affinity(0)
+        self._priority = get_priority()
+        self.status['render_core'] = self.render_core if set_affinity(0, [self.render_core]) else None
+        self.status['priority'] = raise_priority() if self.priority else False
+        return self.status
+
+    def pin_device(self):
+        # the device's process is one of ours (multiprocessing), once it has been started
+        children = multiprocessing.active_children()
+        if self.device_core is None or not children:
+            self.status['device_core'] = None
+            return self.status
+        ok = all(set_affinity(child.pid, [self.device_core]) for child in children)
+        self.status['device_core'] = self.device_core if ok else None
+        return self.status
+
+    def _on_gc(self, phase, info):
+        if phase == 'start':
+            self._gc_start = time.perf_counter()
+        elif not self.held:
+            self.collections += 1
+            self.pause += time.perf_counter() - self._gc_start
+
+    def hold(self):
+        gc.disable()
+        self.held = True
+        self._count = gc.get_count()[0]
+        self._blocks = sys.getallocatedblocks()
+
+    def release(self, trial):
+        if not self.held:
+            return
+        row = self.row
+        row['index'] = trial
+        # container objects (gen 0 count) and memory blocks, net of what was freed
+        row['held_allocations'] = gc.get_count()[0] - self._count
+        row['held_blocks'] = sys.getallocatedblocks() - self._blocks
+        row['other_collections'] = self.collections
+        row['other_ms'] = self.pause * 1000
+        t0 = time.perf_counter()
+        row['collected'] = gc.collect()
+        row['collect_ms'] = (time.perf_counter() - t0) * 1000
+        self.held = False
+        gc.enable()
+        self.collections = 0
+        self.pause = 0.0
+        self.writer.write(row)
+
+    def close(self):
+        self.held = False
+        gc.enable()
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+        if self._affinity is not None and self.status.get('render_core') is not None:
+            set_affinity(0, self._affinity)
+        if self._priority is not None and self.status.get('priority'):
+            set_priority(self._priority)
+        self._affinity = self._priority = None
+        if self.writer is not None:
+            self.writer.close()
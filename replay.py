@@ -0,0 +1,277 @@
+"""
+Record a session's input and frame timing, and play it back without a display.
+
+With `settings['record']`, every `device.read()` result is kept together with the clock
+time of the read, plus the time of every flip, and saved as `<summary>_replay.npz`
+when the session closes. `replay_session` runs the same experiment headless (see
+headless.py) on a virtual clock that is moved to the recorded times, with a device that
+returns the recorded reads. Nothing else in the experiment is random, so it takes the
+same path and writes the same summary file, as fast as the state machine can step.
+
+    python replay.py data/ --out data_replay/ -j 8  # replay every recording under data/
+
+For each recording this reports whether the summary file matches the original and the
+per-frame cost (FrameProfiler) of the replay, per state.
+"""
+import argparse
+import glob
+import json
+import os
+import os.path as op
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from frame_profiler import FrameProfiler
+from headless import HeadlessMixin, HeadlessMultiChoice, HeadlessTwoChoice, NullWindow, VirtualClock, run
+
+# settings that describe the original session, not the replay
+_replay_ignores = ('record', 'profile', 'responder', 'data_dir', 'replay')
+
+
+class SessionRecorder(object):
+    """
+    Wraps `device.read` and `win.flip` of an experiment. Reads are kept as they come
+    (a few list appends per frame) and only packed into arrays by `save`.
+    """
+
+    def __init__(self, experiment, settings):
+        self.experiment = experiment
+        self.settings = {k: v for k, v in settings.items()
+                         if k not in _replay_ignores and isinstance(v, (str, int, float, bool, type(None)))}
+        self.device_name = experiment.device.device.__name__
+        self.device_names = getattr(experiment.device, 'names', [self.device_name])  # InputHub
+        self.reset(self.settings['trial_table'])
+        self.frame_period = experiment.frame_period  # as measured at startup
+
+    def reset(self, table_file, initial_state='wait'):
+        # start a new recording, e.g. for the next block of a session (see session.py)
+        self.settings['trial_table'] = table_file
+        self.initial_state = initial_state  # the state the block starts in
+        self.read_time = []
+        self.read_frame = []
+        self.reads = []  # (timestamps, data) or None
+        self.flip_time = []
+        self.start_clock = self.experiment.global_clock.getTime()
+        self.start_flip = self.experiment.win.lastFrameT
+
+    def install(self):
+        exp = self.experiment
+        read, flip = exp.device.read, exp.win.flip
+        clock = exp.global_clock
+
+        def recorded_read():
+            self.read_time.append(clock.getTime())
+            self.read_frame.append(len(self.flip_time))
+            timestamp, data = read()
+            self.reads.append(None if timestamp is None else (np.array(timestamp), data))
+            return timestamp, data
+
+        def recorded_flip(*args, **kwargs):
+            out = flip(*args, **kwargs)
+            self.flip_time.append(exp.win.lastFrameT)
+            return out
+
+        exp.device.read = recorded_read
+        exp.win.flip = recorded_flip
+
+    def save(self, file_name):
+        sizes = np.array([-1 if r is None else len(r[0]) for r in self.reads], dtype=np.int64)
+        present = [r for r in self.reads if r is not None]
+        # keyboard reads are (states, keys), force reads a single array
+        n_parts = 0
+        is_tuple = bool(present) and isinstance(present[0][1], tuple)
+        if present:
+            n_parts = len(present[0][1]) if is_tuple else 1
+        parts = {}
+        for j in range(n_parts):
+            chunks = [np.asarray(r[1][j] if isinstance(r[1], tuple) else r[1]) for r in present]
+            parts['part%d' % j] = np.concatenate(chunks)
+        with open(self.settings['trial_table'], 'r') as f:
+            table = f.read()
+        np.savez(file_name, settings=json.dumps(self.settings), device=self.device_name,
+                 device_names=np.array(self.device_names), is_tuple=is_tuple,
+                 trial_table=table, start_clock=self.start_clock, start_flip=self.start_flip,
+                 frame_period=self.frame_period, initial_state=self.initial_state,
+                 read_time=np.array(self.read_time), read_frame=np.array(self.read_frame, dtype=np.int64),
+                 read_size=sizes, flip_time=np.array(self.flip_time), n_parts=n_parts,
+                 times=np.concatenate([r[0] for r in present]) if present else np.zeros(0),
+                 **parts)
+
+
+def load_recording(file_name):
+    with np.load(file_name) as f:
+        rec = {k: f[k] for k in f.files}
+    rec['settings'] = json.loads(str(rec['settings']))
+    rec['device'] = str(rec['device'])
+    rec['trial_table'] = str(rec['trial_table'])
+    return rec
+
+
+class ReplayDevice(object):
+    """Returns the recorded reads in order, moving the clock to the time of each read."""
+
+    def __init__(self, recording):
+        self.device = type(recording['device'], (object,), {})
+        self.names = [str(n) for n in recording.get('device_names', [recording['device']])]
+        self.read_time = recording['read_time']
+        sizes = recording['read_size']
+        ends = np.cumsum(np.maximum(sizes, 0))
+        self.bounds = np.stack((ends - np.maximum(sizes, 0), ends), axis=1)
+        self.present = sizes >= 0
+        self.times = recording['times']
+        self.parts = [recording['part%d' % j] for j in range(int(recording['n_parts']))]
+        self.is_tuple = bool(recording.get('is_tuple', recording['device'] == 'Keyboard'))
+        self.index = 0
+        self.experiment = None
+
+    def attach(self, experiment):
+        self.experiment = experiment
+
+    def read(self):
+        i = self.index
+        if i >= len(self.read_time):
+            return None, None
+        self.index += 1
+        self.experiment.global_clock.set(self.read_time[i])
+        if not self.present[i]:
+            return None, None
+        a, b = self.bounds[i]
+        data = [p[a:b] for p in self.parts]
+        return self.times[a:b], (tuple(data) if self.is_tuple else data[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class ReplayWindow(NullWindow):
+    # flips happen at the recorded times (dropped frames included)
+    def __init__(self, clock, flip_time, start_flip, frame_period):
+        super(ReplayWindow, self).__init__(clock, 1.0 / frame_period)
+        self.monitorFramePeriod = frame_period  # exactly as measured
+        self.flip_time = flip_time
+        self.lastFrameT = start_flip
+        self.flips = 0
+
+    def flip(self, clearBuffer=True):
+        if self.flips >= len(self.flip_time):
+            return super(ReplayWindow, self).flip(clearBuffer)
+        t = self.flip_time[self.flips]
+        self.flips += 1
+        self.clock.set(t)
+        if self.recordFrameIntervals:
+            self.frameIntervals.append(t - self.lastFrameT)
+        self.lastFrameT = t
+        self.frames += 1
+        to_call, self._to_call = self._to_call, []
+        for function, args, kwargs in to_call:
+            function(*args, **kwargs)
+        return t
+
+
+class ReplayMixin(HeadlessMixin):
+
+    def setup_clocks(self):
+        # settings aren't passed to setup_clocks; the recording is stashed on the class
+        self.global_clock = VirtualClock(float(self.recording['start_clock']))
+
+    def setup_window(self, settings):
+        rec = self.recording
+        self.win = ReplayWindow(self.global_clock, rec['flip_time'], float(rec['start_flip']),
+                                float(rec['frame_period']))
+
+    def measure_frame_period(self):
+        return float(self.recording['frame_period'])
+
+    def setup_device(self, settings):
+        self.device = ReplayDevice(self.recording)
+        self.device.attach(self)
+
+
+def _replay_class(recording):
+    # the headless classes have the stimulus stubs each task needs (e.g. MultiChoice's TargetArray)
+    base = HeadlessTwoChoice if recording['settings'].get('twochoice', True) else HeadlessMultiChoice
+    return type(base.__name__.replace('Headless', 'Replay'), (ReplayMixin, base), {'recording': recording})
+
+
+def replay_session(file_name, data_dir='data_replay', profile=True):
+    """
+    Replay one `<summary>_replay.npz`. The summary file is written under `data_dir`
+    and compared with the original (the CSV next to the recording), if that exists.
+    """
+    rec = load_recording(file_name)
+    settings = dict(rec['settings'], data_dir=data_dir)
+    # the table as it was, under its original name
+    table_dir = op.join(data_dir, '_tables')
+    if not op.exists(table_dir):
+        os.makedirs(table_dir)
+    settings['trial_table'] = op.join(table_dir, op.basename(settings['trial_table']))
+    with open(settings['trial_table'], 'w') as f:
+        f.write(rec['trial_table'])
+
+    experiment = _replay_class(rec)(settings=settings)
+    initial_state = str(rec.get('initial_state', 'wait'))
+    if initial_state != 'wait':
+        # a later block of a session (session.py), which went straight into its first trial
+        experiment.remove_text()
+        getattr(experiment, 'to_' + initial_state)()
+    profiler = None
+    if profile:
+        profiler = FrameProfiler(experiment, frames=len(rec['flip_time']) + 2)
+        profiler.install()
+    t0 = time.perf_counter()
+    frames = run(experiment)
+    wall = time.perf_counter() - t0
+
+    original = file_name[:-len('_replay.npz')] + '.csv'
+    identical = None
+    if op.exists(original):
+        with open(original, 'rb') as a, open(experiment.summary_file_name, 'rb') as b:
+            identical = a.read() == b.read()
+    result = {'recording': file_name, 'summary_file_name': experiment.summary_file_name,
+              'identical': identical, 'frames': frames, 'recorded_frames': len(rec['flip_time']),
+              'wall_time': wall}
+    if profiler is not None:
+        report = profiler.report(experiment.frame_period)
+        result['states'] = {name: entry['total_ms'] for name, entry in report['states'].items()}
+    return result
+
+
+def _replay_one(job):
+    return replay_session(*job)
+
+
+def replay_archive(root, data_dir='data_replay', processes=None, profile=True):
+    # every <summary>_replay.npz under `root`, one process per recording
+    files = sorted(glob.glob(op.join(root, '**', '*_replay.npz'), recursive=True))
+    jobs = [(f, op.join(data_dir, '%04d' % i), profile) for i, f in enumerate(files)]
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(_replay_one, jobs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded sessions without a display.')
+    parser.add_argument('path', help='a *_replay.npz file, or a folder to search for them')
+    parser.add_argument('--out', default='data_replay')
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    parser.add_argument('--json', default=None, help='also write the results here')
+    args = parser.parse_args()
+
+    if args.path.endswith('.npz'):
+        results = [replay_session(args.path, args.out)]
+    else:
+        results = replay_archive(args.path, args.out, args.processes)
+    for r in results:
+        status = {True: 'same', False: 'DIFFERENT', None: 'no original'}[r['identical']]
+        worst = max((ms[-2], name) for name, ms in r.get('states', {}).items()) if r.get('states') else (np.nan, '')
+        print('%-9s %s (%d frames in %.2f s, worst p99 %.3f ms in %s)' %
+              (status, r['recording'], r['frames'], r['wall_time'], worst[0], worst[1]))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    n_bad = sum(r['identical'] is False for r in results)
+    print('%d replayed, %d different' % (len(results), n_bad))
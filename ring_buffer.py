@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class RingBuffer(object):
+    """
+    Preallocated sample buffer with a write cursor and O(1) bulk appends.
+
+    Every sample is written twice (at `i` and `i + capacity`), so any run of up to
+    `capacity` recent samples is a single contiguous slice and can be handed out as
+    a view without copying.
+    """
+
+    def __init__(self, capacity, channels, dtype=np.float64):
+        self.capacity = capacity
+        self.channels = channels
+        self.data = np.full((2 * capacity, channels), np.nan, dtype=dtype)
+        self.time = np.full(2 * capacity, np.nan)
+        self.count = 0  # total number of samples ever written
+        self.wraps = 0  # number of times the cursor went past the end
+        self.mark_count = 0  # value of `count` at the last call to `mark`
+
+    @property
+    def cursor(self):
+        return self.count % self.capacity
+
+    @property
+    def dropped(self):
+        # samples since the last mark that have already been overwritten
+        return max(0, self.count - self.mark_count - self.capacity)
+
+    def extend(self, timestamps, data):
+        data = np.asarray(data).reshape(-1, self.channels)
+        timestamps = np.asarray(timestamps, dtype=np.float64).reshape(-1)
+        n = data.shape[0]
+        if timestamps.shape[0] != n:
+            timestamps = np.broadcast_to(timestamps, (n,))
+        if n > self.capacity:
+            # only the newest `capacity` samples can survive anyway
+            skip = n - self.capacity
+            self.wraps += (self.cursor + skip) // self.capacity
+            self.count += skip
+            data = data[skip:]
+            timestamps = timestamps[skip:]
+            n = self.capacity
+        cap = self.capacity
+        start = self.cursor
+        first = min(n, cap - start)
+        rest = n - first
+        self.data[start:start + first] = data[:first]
+        self.data[start + cap:start + cap + first] = data[:first]
+        self.time[start:start + first] = timestamps[:first]
+        self.time[start + cap:start + cap + first] = timestamps[:first]
+        if rest:
+            self.data[:rest] = data[first:]
+            self.data[cap:cap + rest] = data[first:]
+            self.time[:rest] = timestamps[first:]
+            self.time[cap:cap + rest] = timestamps[first:]
+        self.wraps += (start + n) // cap
+        self.count += n
+
+    def mark(self):
+        # start a new window (e.g. at trial start)
+        self.mark_count = self.count
+
+    def latest(self, n):
+        # views of the `n` newest samples, oldest first
+        n = min(n, self.count, self.capacity)
+        end = self.cursor + self.capacity
+        return self.time[end - n:end], self.data[end - n:end]
+
+    def window(self):
+        # views of everything written since the last `mark`
+        return self.latest(self.count - self.mark_count)
@@ -1,18 +1,15 @@
-import pandas as pd
 import matplotlib.pyplot as plt
 
-x1 = pd.read_csv('data/001/id_001_block1_105628.csv')
-x2 = pd.read_csv('data/001/id_001_block2_112027.csv')
+from aggregate import code, load_store, update_store
 
-y1 = pd.read_csv('data/001/id_001_block1_adapt_104935.csv')
-y2 = pd.read_csv('data/001/id_001_block2_adapt_111200.csv')
+# pick up any new sessions, then look at subject 001 across all of them
+update_store('data')
+store = load_store('data/_store')
 
-x = pd.concat([x1, x2])
-y = pd.concat([y1, y2])
-x = x[x['first_target'] != x['second_target']]
-y = y[y['first_target'] != y['second_target']]
-x = x.sort_values('prep_time')
-y = y.sort_values('prep_time')
-plt.plot(x['prep_time'], x['correct'], 'ro', alpha=0.6)
-plt.plot(y['prep_time'], y['correct'] + 0.01, 'go', alpha=0.6)
+switch = store['valid'] & (store['first_target'] != store['second_target']) & \
+    (store['subject'] == code(store, 'subject', '001'))
+x = switch & (store['condition'] == code(store, 'condition', 'fixed'))
+y = switch & (store['condition'] == code(store, 'condition', 'adaptive'))
+plt.plot(store['prep_time'][x], store['correct'][x], 'ro', alpha=0.6)
+plt.plot(store['prep_time'][y], store['correct'][y] + 0.01, 'go', alpha=0.6)
 plt.show()
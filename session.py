@@ -0,0 +1,59 @@
+"""
+Several blocks (trial tables) in one session, on the same window, sounds and device.
+
+Every block after the first is loaded and compiled on a background thread while the
+block before it runs, and when a block reaches cleanup the experiment starts the next
+one in place (`TwoChoice.next_block`): new data files, a fresh adaptive procedure and
+trial counter, everything else kept. Without `wait`, the next block's first trial
+follows the last one's inter-trial interval like any other trial.
+
+In exp.py, give several tables separated by commas:
+
+    tables/multiblock0_demo.csv, tables/multiblock1.csv, tables/multiblock2.csv
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+
+def split_tables(trial_table):
+    # 'a.csv, b.csv' or ['a.csv', 'b.csv'] -> ['a.csv', 'b.csv']
+    if isinstance(trial_table, str):
+        trial_table = trial_table.split(',')
+    return [t.strip() for t in trial_table if t.strip()]
+
+
+class BlockQueue(object):
+    """
+    The blocks after the current one. The next is always being prepared in the
+    background; `advance` (once the experiment is in cleanup) starts it, or returns
+    False when there are no more.
+    """
+
+    def __init__(self, experiment, table_files, wait=False):
+        self.experiment = experiment
+        self.pending = list(table_files)
+        self.wait = wait
+        self.pool = ThreadPoolExecutor(1)
+        self.next = None
+        self._prefetch()
+
+    def _prefetch(self):
+        self.next = self.pool.submit(self.experiment.prepare_block, self.pending.pop(0)) if self.pending else None
+
+    def __len__(self):
+        return len(self.pending) + (self.next is not None)
+
+    def advance(self):
+        if self.next is None:
+            self.pool.shutdown()
+            return False
+        block = self.next.result()  # normally long done
+        self._prefetch()
+        self.experiment.next_block(*block, wait=self.wait)
+        return True
+
+    def close(self):
+        self.pending = []
+        if self.next is not None:
+            self.next.cancel()
+            self.next = None
+        self.pool.shutdown()
@@ -0,0 +1,136 @@
+"""
+Monte Carlo evaluation of the adaptive staircase (adaptive.Staircase) on real trial tables.
+
+Many simulated observers run through a table in lockstep: every trial is one vectorized
+step over all of them, with the same rule the experiment uses (`staircase_step`).
+Observers press like headless.StochasticResponder: aiming for the last beep (timing
+error sd `timing_sd`), pressing the second target of a switch trial with a probability
+that grows logistically with the realized prep time (`threshold`, `slope`), and pressing
+either target at random with probability `lapse`. Thresholds, slopes and lapse rates can
+differ per observer.
+
+A 1-up/1-down staircase tracks the prep time at which half the switch trials are
+correct, which for these observers is `threshold`. Per table this reports the bias and
+spread of the estimate (the mean proposal over the last `tail` switch trials) and the
+switch trials until the proposal stays within `tolerance` of the threshold.
+
+    python staircase_sim.py tables/test_long.csv --observers 100000 --threshold 0.15 0.35
+    python staircase_sim.py tables/test_long.csv --start 0.3 --bounds 0.05 0.5
+"""
+import argparse
+import time
+
+import numpy as np
+
+from adaptive import Staircase, staircase_step
+from frame_timing import FrameTiming
+from startup import load_trial_table
+
+# as in TwoChoice
+last_beep_time = round(0.1 + (0.4 * 3), 2)
+
+
+def simulate_staircase(table, n=100000, threshold=0.25, slope=0.03, lapse=0.02, timing_sd=0.05,
+                       frame_period=1/60, seed=None, **staircase):
+    """
+    Run `n` observers through `table` (a trial table, see startup.load_trial_table) with
+    a Staircase(frame_period=frame_period, **staircase) each. `threshold`, `slope` and
+    `lapse` are scalars or arrays of length `n`.
+
+    Returns (proposals, correct, threshold): the proposed prep time of every switch
+    trial, (switch trials, n); whether every trial was correct, (trials, n); and the
+    observers' thresholds, (n,).
+    """
+    rng = np.random.default_rng(seed)
+    timing = FrameTiming(frame_period)
+    proto = Staircase(frame_period=frame_period, **staircase)
+    threshold, slope, lapse = (np.broadcast_to(np.asarray(x, dtype=np.float64), (n,))
+                               for x in (threshold, slope, lapse))
+    is_switch = table['first'] != table['second']
+
+    frames = np.full(n, proto.frames)
+    switches = np.zeros(n, dtype=int)
+    prev_sign = np.zeros(n, dtype=int)
+    last_correct = np.zeros(n, dtype=bool)
+    proposals = np.empty((int(is_switch.sum()), n))
+    correct = np.empty((len(is_switch), n), dtype=bool)
+    k = 0
+    for i, switch in enumerate(is_switch):
+        if switch:
+            # calc_adapt: propose, then the switch is drawn at the nearest frame
+            frames, switches, prev_sign = staircase_step(i, last_correct, frames, switches, prev_sign,
+                                                         proto.first_steps, proto.step, frame_period,
+                                                         proto.frame_bounds)
+            proposals[k] = frames * frame_period
+            k += 1
+            onset = timing.quantize(last_beep_time - frames * frame_period)
+            press = last_beep_time + rng.normal(0, timing_sd, n)
+            p = 1.0 / (1.0 + np.exp(-(press - onset - threshold) / slope))
+            right = rng.random(n) < p
+            lapsed = rng.random(n) < lapse
+            right[lapsed] = rng.random(int(lapsed.sum())) < 0.5
+        else:
+            right = np.ones(n, dtype=bool)  # both targets are the same
+        correct[i] = right
+        last_correct = right  # update_adapt: the most recent trial, switch or not
+    return proposals, correct, np.array(threshold)
+
+
+def evaluate(proposals, threshold, tail=10, tolerance=0.05):
+    """
+    Bias and sd (across observers) of the estimate, the mean of the last `tail`
+    proposals; and per observer the number of switch trials until the proposals stay
+    within `tolerance` of the threshold (nan if they don't by the end).
+    """
+    estimate = proposals[-tail:].mean(axis=0)
+    error = estimate - threshold
+    outside = np.abs(proposals - threshold[None, :]) > tolerance
+    # index of the last proposal outside the tolerance, + 1
+    last_out = np.where(outside.any(axis=0),
+                        outside.shape[0] - np.argmax(outside[::-1], axis=0), 0)
+    converged = last_out < outside.shape[0]
+    trials = np.where(converged, last_out + 1, np.nan)
+    return {'observers': int(threshold.size), 'switch_trials': int(proposals.shape[0]),
+            'bias': float(error.mean()), 'sd': float(error.std()),
+            'rmse': float(np.sqrt((error ** 2).mean())),
+            'converged': float(converged.mean()),
+            'trials_to_converge': np.nanpercentile(trials, [25, 50, 75]).tolist() if converged.any() else [np.nan] * 3}
+
+
+def _range(values, n, rng):
+    # one value, or (low, high) drawn uniformly per observer
+    if len(values) == 1:
+        return values[0]
+    return rng.uniform(values[0], values[1], n)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Monte Carlo evaluation of the adaptive staircase.')
+    parser.add_argument('tables', nargs='+', help='trial tables (csv)')
+    parser.add_argument('--observers', type=int, default=100000)
+    parser.add_argument('--threshold', type=float, nargs='+', default=[0.25], help='value or low high')
+    parser.add_argument('--slope', type=float, nargs='+', default=[0.03], help='value or low high')
+    parser.add_argument('--lapse', type=float, nargs='+', default=[0.02], help='value or low high')
+    parser.add_argument('--timing-sd', type=float, default=0.05)
+    parser.add_argument('--rate', type=float, default=60.0, help='refresh rate (Hz)')
+    parser.add_argument('--start', type=float, default=0.5)
+    parser.add_argument('--bounds', type=float, nargs=2, default=[0.05, 0.6])
+    parser.add_argument('--tail', type=int, default=10)
+    parser.add_argument('--tolerance', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    n = args.observers
+    observers = {name: _range(getattr(args, name), n, rng) for name in ('threshold', 'slope', 'lapse')}
+    print('%-28s %8s %8s %8s %8s %9s  %s' % ('table', 'switches', 'bias', 'sd', 'rmse', 'converged',
+                                             'trials to converge (25/50/75%)'))
+    for table_file in args.tables:
+        t0 = time.perf_counter()
+        proposals, correct, threshold = simulate_staircase(
+            load_trial_table(table_file), n, timing_sd=args.timing_sd, frame_period=1.0 / args.rate,
+            seed=rng.integers(1 << 32), start=args.start, bounds=tuple(args.bounds), **observers)
+        r = evaluate(proposals, threshold, args.tail, args.tolerance)
+        print('%-28s %8d %8.4f %8.4f %8.4f %8.1f%%  %s  (%.2f s)' %
+              (table_file, r['switch_trials'], r['bias'], r['sd'], r['rmse'], 100 * r['converged'],
+               '/'.join('%g' % x for x in r['trials_to_converge']), time.perf_counter() - t0))
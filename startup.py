@@ -0,0 +1,167 @@
+"""
+Startup helpers: caches for things that are slow to rebuild at every launch, and an
+optional profile of where launch time goes.
+
+Caches live in `.cache/` (safe to delete at any time). Several processes may share them
+(e.g. `headless.py -j`): a cache file is written under a temporary name and renamed
+into place, and one that can't be loaded is rebuilt.
+"""
+import builtins
+import contextlib
+import csv
+import hashlib
+import os
+import os.path as op
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+cache_dir = '.cache'
+
+
+def _cache_path(kind, name):
+    path = op.join(cache_dir, kind)
+    os.makedirs(path, exist_ok=True)
+    return op.join(path, name)
+
+
+def _read_cache(path, load):
+    # load(path), or None if it isn't cached (or the file is unreadable, e.g. truncated)
+    if not op.exists(path):
+        return None
+    try:
+        return load(path)
+    except Exception:
+        return None
+
+
+def _write_cache(path, save):
+    # save(file) to a temporary file next to `path`, then rename it over `path` (atomic),
+    # so other processes never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=op.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            save(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _load_npz(path):
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+
+def load_trial_table(file_name):
+    """
+    Trial table as a dict of numpy columns ({'first': ..., 'second': ..., 'switch_time': ...}).
+
+    Parsed tables are cached in binary form, keyed by the hash and mtime of the CSV.
+    Raises FileNotFoundError like pandas.read_csv would.
+    """
+    with open(file_name, 'rb') as f:
+        raw = f.read()
+    key = hashlib.sha1(raw).hexdigest()[:16] + '_%d' % os.stat(file_name).st_mtime_ns
+    cached = _cache_path('tables', op.splitext(op.basename(file_name))[0] + '_' + key + '.npz')
+    table = _read_cache(cached, _load_npz)
+    if table is not None:
+        return table
+    rows = list(csv.reader(raw.decode('utf-8').splitlines()))
+    header, rows = rows[0], [r for r in rows[1:] if r]
+    table = {name: np.array([float(r[i]) for r in rows]) for i, name in enumerate(header)}
+    _write_cache(cached, lambda f: np.savez(f, **table))
+    return table
+
+
+def cached_beep_sequence(**kwargs):
+    # toon.audio.beep_sequence, cached by its parameters
+    key = hashlib.sha1(repr(sorted(kwargs.items())).encode('utf-8')).hexdigest()[:16]
+    cached = _cache_path('audio', 'beep_' + key + '.npy')
+    buf = _read_cache(cached, np.load)
+    if buf is not None:
+        return buf
+    from toon.audio import beep_sequence
+    buf = beep_sequence(**kwargs)
+    _write_cache(cached, lambda f: np.save(f, buf))
+    return buf
+
+
+class StartupProfile(object):
+    """
+    Times named phases of startup and, once `install`ed, every first-time import
+    (inclusive of the imports it triggers). Does nothing unless enabled.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []  # (name, seconds, depth)
+        self.imports = []  # (module, seconds, depth)
+        self._depth = 0
+        self._import_depth = 0
+        self._t0 = time.perf_counter()
+
+    def enable(self):
+        # start timing now, including imports from here on
+        self.enabled = True
+        self._t0 = time.perf_counter()
+        self.install()
+
+    def install(self):
+        if not self.enabled:
+            return
+        original = builtins.__import__
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if level:
+                return original(name, globals, locals, fromlist, level)
+            key = name
+            if name in sys.modules:
+                # `from package import submodule` only shows up as a fromlist entry
+                module = sys.modules[name]
+                missing = [f for f in fromlist or () if f != '*' and not hasattr(module, f)]
+                if not missing:
+                    return original(name, globals, locals, fromlist, level)
+                key = name + '.' + ','.join(missing)
+            self._import_depth += 1
+            t0 = time.perf_counter()
+            try:
+                return original(name, globals, locals, fromlist, level)
+            finally:
+                self._import_depth -= 1
+                self.imports.append((key, time.perf_counter() - t0, self._import_depth))
+        builtins.__import__ = timed_import
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        index = len(self.phases)
+        self.phases.append((name, 0.0, self._depth))
+        self._depth += 1
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            self.phases[index] = (name, time.perf_counter() - t0, self._depth)
+
+    def report(self, top=15):
+        if not self.enabled:
+            return ''
+        lines = ['startup: %.3f s total' % (time.perf_counter() - self._t0)]
+        for name, seconds, depth in self.phases:
+            lines.append('%s%-30s %8.1f ms' % ('  ' * depth, name, seconds * 1000))
+        top_level = sorted((i for i in self.imports if i[2] == 0), key=lambda i: -i[1])
+        if top_level:
+            lines.append('slowest imports (inclusive):')
+            for name, seconds, _ in top_level[:top]:
+                lines.append('  %-28s %8.1f ms' % (name, seconds * 1000))
+        return '\n'.join(lines)
+
+
+# shared by exp.py and the experiment classes; enabled by `python exp.py --profile-startup`
+profile = StartupProfile()
@@ -0,0 +1,194 @@
+"""
+A small stand-in for `transitions.Machine`, for state machines that are stepped every
+frame.
+
+It takes the same `states`/`transitions` declarations (the subset used in state_dec:
+string or dict states with `on_enter`/`on_exit`, transitions with `source`, `trigger`,
+`conditions`, `unless`, `before`, `after` and `dest`, plus `to_<state>()` and
+`after_state_change`). At construction each trigger is compiled into a per-state
+tuple of (bound conditions, bound callbacks, dest), so a trigger that does nothing
+costs a dict lookup and the condition calls.
+
+Semantics follow `transitions`: transitions are tried in declaration order, the first
+one whose conditions all pass runs before -> on_exit -> state change -> on_enter ->
+after -> after_state_change, and the trigger returns whether a transition happened.
+
+Callbacks are bound at compile time. If callbacks are replaced on the instance later
+(e.g. by FrameProfiler), call `compile()` again.
+
+    python state_engine.py  # equivalence check against transitions + step() benchmark
+"""
+
+
+class MachineError(Exception):
+    pass
+
+
+def _listify(x):
+    if x is None:
+        return []
+    if isinstance(x, (list, tuple)):
+        return list(x)
+    return [x]
+
+
+class CompiledMachine(object):
+
+    def __init__(self, states, transitions, initial, auto_transitions=True,
+                 after_state_change=None):
+        self.state_list = states
+        self.transition_table = transitions
+        self.states = [s['name'] if isinstance(s, dict) else s for s in states]
+        self.state = self.states[self.states.index(initial)]
+        self.auto_transitions = auto_transitions
+        self.after_state_change_names = _listify(after_state_change)
+        self._tables = {}  # trigger -> {state: ((conditions, callbacks, dest), ...)}
+        self.compile()
+
+        for trigger, table in self._tables.items():
+            setattr(self, trigger, self._make_trigger(table))
+        if auto_transitions:
+            for dest in self.states:
+                setattr(self, 'to_' + dest, self._make_auto_transition(dest))
+
+    def compile(self):
+        # (re)bind every callback named in the declarations
+        def bind(names):
+            return tuple(getattr(self, n) if isinstance(n, str) else n for n in _listify(names))
+
+        self._on_enter = {}
+        self._on_exit = {}
+        for s in self.state_list:
+            if isinstance(s, dict):
+                self._on_enter[s['name']] = bind(s.get('on_enter'))
+                self._on_exit[s['name']] = bind(s.get('on_exit'))
+        self._after_state_change = bind(self.after_state_change_names)
+
+        for table in self._tables.values():
+            table.clear()
+        for t in self.transition_table:
+            table = self._tables.setdefault(t['trigger'], {})
+            conditions = bind(t.get('conditions'))
+            for unless in bind(t.get('unless')):
+                conditions += (lambda f=unless: not f(),)
+            callbacks = (bind(t.get('before')), bind(t.get('after')))
+            dest = self.states[self.states.index(t['dest'])]
+            source = t['source']
+            sources = self.states if source == '*' else _listify(source)
+            for s in sources:
+                table[s] = table.get(s, ()) + ((conditions, callbacks, dest),)
+
+    def _change_state(self, dest, before=()):
+        for f in before:
+            f()
+        for f in self._on_exit.get(self.state, ()):
+            f()
+        self.state = dest
+        for f in self._on_enter.get(dest, ()):
+            f()
+
+    def _make_trigger(self, table):
+        def trigger():
+            try:
+                candidates = table[self.state]
+            except KeyError:
+                raise MachineError("Can't trigger event from state %s!" % self.state)
+            for conditions, (before, after), dest in candidates:
+                for c in conditions:
+                    if not c():
+                        break
+                else:
+                    self._change_state(dest, before)
+                    for f in after:
+                        f()
+                    for f in self._after_state_change:
+                        f()
+                    return True
+            return False
+        return trigger
+
+    def _make_auto_transition(self, dest):
+        def to_state():
+            self._change_state(dest)
+            for f in self._after_state_change:
+                f()
+            return True
+        return to_state
+
+
+if __name__ == '__main__':
+    import copy
+    import random
+    import timeit
+
+    import state_dec
+
+    class Model(object):
+        # conditions pass with probability `p`; every other callback logs its name
+        def __init__(self, seed, p=0.3):
+            self.rng = random.Random(seed)
+            self.p = p
+            self.log = []
+            for t in state_dec.transitions:
+                for name in _listify(t.get('conditions')):
+                    setattr(self, name, lambda: self.rng.random() < self.p)
+                for name in _listify(t.get('after')):
+                    setattr(self, name, lambda name=name: self.log.append(name))
+            for s in state_dec.states:
+                if isinstance(s, dict):
+                    for name in _listify(s.get('on_enter')) + _listify(s.get('on_exit')):
+                        setattr(self, name, lambda name=name: self.log.append(name))
+
+    class CompiledModel(Model, CompiledMachine):
+        def __init__(self, seed, p=0.3):
+            Model.__init__(self, seed, p)
+            CompiledMachine.__init__(self, states=state_dec.states,
+                                     transitions=state_dec.transitions, initial='wait')
+
+    def reference(seed, p=0.3):
+        from transitions import Machine
+        model = Model(seed, p)
+        Machine(model=model, states=copy.deepcopy(state_dec.states),
+                transitions=copy.deepcopy(state_dec.transitions), initial='wait')
+        return model
+
+    def run(model, n):
+        states = []
+        for i in range(n):
+            if i % 5000 == 4999:
+                model.to_cleanup()  # exercise auto transitions + on_enter
+            if model.state == 'cleanup':
+                model.to_wait()
+            model.step()
+            states.append(model.state)
+        return states
+
+    try:
+        import transitions
+    except ImportError:
+        transitions = None
+
+    models = [('compiled', CompiledModel)]
+    if transitions is not None:
+        for seed in range(5):
+            a, b = CompiledModel(seed), reference(seed)
+            assert run(a, 20000) == run(b, 20000), 'state sequences differ (seed %d)' % seed
+            assert a.log == b.log, 'callback order differs (seed %d)' % seed
+        print('compiled engine matches transitions %s (5 x 20000 random steps)' % transitions.__version__)
+        models.append(('transitions', reference))
+    else:
+        print('transitions not installed, skipping equivalence check')
+
+    # cost of a step() where no condition passes, i.e. almost every frame
+    print('%-14s' % 'state' + ''.join('%14s' % name for name, _ in models))
+    for state in state_dec.states:
+        state = state['name'] if isinstance(state, dict) else state
+        row = '%-14s' % state
+        if state == 'cleanup':
+            continue
+        for name, make in models:
+            m = make(0, p=0.0)
+            m.state = state
+            t = min(timeit.repeat(m.step, number=20000, repeat=5)) / 20000
+            row += '%11.2f us' % (t * 1e6)
+        print(row)
@@ -0,0 +1,238 @@
+"""
+Generate the trial tables for a whole cohort at once.
+
+All subjects x blocks go into one archive (.npz); per-block CSVs (same format as
+mkblocks/mkmultiblocks) are only written when asked for.
+
+    python tables/cohort.py generate cohort.npz --subjects 200 --seed 1 --counterbalance --max-run 4
+    python tables/cohort.py generate multi.npz --multi --subjects 200 --seed 2
+    python tables/cohort.py export cohort.npz --subject 017 --out data/017/
+
+Each subject gets its own `Generator` (spawned from `--seed`), so regenerating one
+subject, or the cohort with more subjects, leaves the others unchanged. Within a
+subject all blocks are shuffled and have their switch times drawn in one go.
+"""
+import argparse
+import itertools
+import os
+import os.path as op
+
+import numpy as np
+
+
+def balanced_latin_square(n):
+    # rows are orders of range(n); each item precedes every other equally often
+    s = [0] + [(j + 1) // 2 if j % 2 else n - j // 2 for j in range(1, n)]
+    square = (np.arange(n)[:, None] + np.array(s)[None, :]) % n
+    if n % 2:
+        square = np.vstack((square, square[:, ::-1]))
+    return square
+
+
+def max_run_length(codes):
+    # longest run of identical values in each row of a 2D array
+    n_rows, n = codes.shape
+    idx = np.broadcast_to(np.arange(n), codes.shape)
+    starts = np.where(np.concatenate((np.ones((n_rows, 1), bool),
+                                      codes[:, 1:] != codes[:, :-1]), axis=1), idx, 0)
+    return (idx - np.maximum.accumulate(starts, axis=1) + 1).max(axis=1)
+
+
+def shuffle_blocks(rng, pairs, counts, min_max_frames, max_run=None, max_tries=1000, prefix=None):
+    """
+    `pairs` is (blocks, n_pairs, 2) and `counts` (n_pairs,) says how many trials each pair
+    gets (the same in every block). Returns first/second (blocks, trials) and
+    switch frames (zero on non-switch trials). `prefix` (indices into `pairs`, the same
+    for every block) are the trials that will go before each block (e.g. practice);
+    `max_run` holds across them too.
+    """
+    n_blocks = pairs.shape[0]
+    codes = np.repeat(np.arange(len(counts)), counts)
+    order = codes[rng.random((n_blocks, codes.size)).argsort(axis=1)]
+    if max_run is not None:
+        lead = np.tile(np.asarray([] if prefix is None else prefix, dtype=codes.dtype), (n_blocks, 1))
+        # reshuffle only the blocks that break the constraint
+        for _ in range(max_tries):
+            bad = np.flatnonzero(max_run_length(np.concatenate((lead, order), axis=1)) > max_run)
+            if not bad.size:
+                break
+            order[bad] = codes[rng.random((bad.size, codes.size)).argsort(axis=1)]
+        else:
+            raise ValueError('Could not satisfy max_run=%d in %d tries.' % (max_run, max_tries))
+    trials = pairs[np.arange(n_blocks)[:, None], order]
+    first, second = trials[..., 0], trials[..., 1]
+    frames = rng.integers(min_max_frames[0], min_max_frames[1] + 1, size=first.shape)
+    frames[first == second] = 0
+    return first, second, frames
+
+
+def _counts(is_switch, num_trials, prop_switch):
+    num_switch = int(num_trials * prop_switch)
+    num_other = int(num_trials - num_switch)
+    n_switch_pairs = int(is_switch.sum())
+    n_other_pairs = int((~is_switch).sum())
+    if n_switch_pairs and num_switch % n_switch_pairs != 0:
+        raise ValueError('Make sure all selections are sampled evenly.')
+    return np.where(is_switch, num_switch // max(n_switch_pairs, 1), num_other // n_other_pairs)
+
+
+def two_choice_subject(rng, fingers, blocks_per_pair, pair_order=None, num_trials=80, demo_trials=40,
+                       prop_switch=0.3, min_max_frames=(6, 27), max_run=None):
+    # mkblocks.mk_blocks for one subject: a demo block, then `blocks_per_pair` blocks per pair
+    pairs = np.array([[a, b] for a in fingers for b in fingers if b < a])
+    if pair_order is None:
+        pair_order = rng.permutation(len(pairs))
+    pairs = np.repeat(pairs[pair_order], blocks_per_pair, axis=0)
+    a, b = pairs[:, 0], pairs[:, 1]
+    # (blocks, 4, 2): switch a->b, switch b->a, stay a, stay b
+    block_pairs = np.stack((np.stack((a, b), 1), np.stack((b, a), 1),
+                            np.stack((a, a), 1), np.stack((b, b), 1)), axis=1)
+    is_switch = np.array([True, True, False, False])
+    practice_codes = [2, 3, 2, 3]  # 4 practice trials
+    practice = block_pairs[:, practice_codes]
+
+    demo = shuffle_blocks(rng, block_pairs[:1], _counts(is_switch, demo_trials, 0),
+                          min_max_frames, max_run, prefix=practice_codes)
+    main = shuffle_blocks(rng, block_pairs, _counts(is_switch, num_trials, prop_switch),
+                          min_max_frames, max_run, prefix=practice_codes)
+    blocks = [tuple(x[0] for x in _with_practice(practice[:1], demo))]
+    first, second, frames = _with_practice(practice, main)
+    blocks.extend(zip(first, second, frames))
+    names = ['block0_demo'] + ['block%d' % (i + 1) for i in range(len(pairs))]
+    return names, blocks
+
+
+def multi_choice_subject(rng, fingers, n_blocks, num_trials=80, demo_trials=50,
+                         prop_switch=0.3, min_max_frames=(6, 27), max_run=None):
+    # mkmultiblocks.mk_multi_blocks for one subject
+    pairs = np.array(list(itertools.product(fingers, fingers)))
+    is_switch = pairs[:, 0] != pairs[:, 1]
+    practice = np.stack((fingers, fingers), 1)[None]
+    # the practice trials as indices into `pairs`
+    practice_codes = [int(np.flatnonzero((pairs == p).all(axis=1))[0]) for p in practice[0]]
+
+    demo = shuffle_blocks(rng, pairs[None], _counts(is_switch, demo_trials, 0),
+                          min_max_frames, max_run, prefix=practice_codes)
+    main = shuffle_blocks(rng, np.repeat(pairs[None], n_blocks - 1, axis=0),
+                          _counts(is_switch, num_trials, prop_switch), min_max_frames, max_run,
+                          prefix=practice_codes)
+    blocks = [tuple(x[0] for x in _with_practice(practice, demo))]
+    first, second, frames = _with_practice(np.repeat(practice, n_blocks - 1, axis=0), main)
+    blocks.extend(zip(first, second, frames))
+    names = ['multiblock0_demo'] + ['multiblock%d' % (i + 1) for i in range(n_blocks - 1)]
+    return names, blocks
+
+
+def _with_practice(practice, blocks):
+    first, second, frames = blocks
+    n = practice.shape[0]
+    return (np.concatenate((practice[..., 0], first), axis=1),
+            np.concatenate((practice[..., 1], second), axis=1),
+            np.concatenate((np.zeros((n, practice.shape[1]), frames.dtype), frames), axis=1))
+
+
+def generate_cohort(file_name, n_subjects, seed, multi=False, fingers=(0, 4, 5, 9),
+                    blocks_per_pair=2, n_blocks=8, counterbalance=False, max_run=None,
+                    min_max_time=(0.1, 0.45), frame_rate=60):
+    fingers = np.array(fingers)
+    min_max_frames = (int(min_max_time[0] * frame_rate), int(min_max_time[1] * frame_rate))
+    n_pairs = len(fingers) * (len(fingers) - 1) // 2
+    square = balanced_latin_square(n_pairs)
+    generators = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n_subjects)]
+
+    subjects = ['%03d' % (i + 1) for i in range(n_subjects)]
+    first, second, frames, index = [], [], [], []
+    start = 0
+    for i, rng in enumerate(generators):
+        if multi:
+            names, blocks = multi_choice_subject(rng, fingers, n_blocks, min_max_frames=min_max_frames,
+                                                 max_run=max_run)
+        else:
+            order = square[i % len(square)] if counterbalance else None
+            names, blocks = two_choice_subject(rng, fingers, blocks_per_pair, order,
+                                               min_max_frames=min_max_frames, max_run=max_run)
+        for b, (name, (f, s, sw)) in enumerate(zip(names, blocks)):
+            first.append(f)
+            second.append(s)
+            frames.append(sw)
+            index.append((i, b, name, start, start + f.size))
+            start += f.size
+
+    index = np.array(index, dtype=[('subject', 'i4'), ('block', 'i2'), ('name', 'U24'),
+                                   ('start', 'i8'), ('stop', 'i8')])
+    np.savez_compressed(file_name,
+                        first=np.concatenate(first).astype(np.int8),
+                        second=np.concatenate(second).astype(np.int8),
+                        switch_frames=np.concatenate(frames).astype(np.int16),
+                        index=index, subjects=np.array(subjects),
+                        frame_rate=frame_rate, seed=seed, multi=multi)
+    return index
+
+
+def load_cohort(file_name):
+    with np.load(file_name) as f:
+        return {k: f[k] for k in f.files}
+
+
+def get_block(cohort, subject, block):
+    # first, second, switch_time (s) for one subject ('017') and block number
+    s = int(np.flatnonzero(cohort['subjects'] == subject)[0])
+    idx = cohort['index']
+    row = idx[(idx['subject'] == s) & (idx['block'] == block)][0]
+    sl = slice(row['start'], row['stop'])
+    return (cohort['first'][sl], cohort['second'][sl],
+            cohort['switch_frames'][sl] / float(cohort['frame_rate'])), row['name']
+
+
+def export_csv(cohort, subject, block, file_name=None):
+    (first, second, switch_time), name = get_block(cohort, subject, block)
+    file_name = file_name or name + '.csv'
+    with open(file_name, 'w') as f:
+        f.write('first,second,switch_time\n')
+        for row in zip(first.tolist(), second.tolist(), switch_time.tolist()):
+            f.write('%d,%d,%.4f\n' % row)
+    return file_name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cohort-scale trial table generation.')
+    sub = parser.add_subparsers(dest='command')
+    gen = sub.add_parser('generate')
+    gen.add_argument('archive')
+    gen.add_argument('--subjects', type=int, default=1)
+    gen.add_argument('--seed', type=int, required=True)
+    gen.add_argument('--multi', action='store_true')
+    gen.add_argument('--fingers', type=int, nargs='+', default=[0, 4, 5, 9])
+    gen.add_argument('--blocks-per-pair', type=int, default=2)
+    gen.add_argument('--blocks', type=int, default=8, help='multi-choice only')
+    gen.add_argument('--counterbalance', action='store_true',
+                     help='pair order from a balanced Latin square across subjects')
+    gen.add_argument('--max-run', type=int, default=None,
+                     help='longest allowed run of identical first/second pairs')
+    gen.add_argument('--frame-rate', type=float, default=60)
+    exp = sub.add_parser('export')
+    exp.add_argument('archive')
+    exp.add_argument('--subject', required=True)
+    exp.add_argument('--block', type=int, default=None, help='default: all blocks')
+    exp.add_argument('--out', default='.')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        index = generate_cohort(args.archive, args.subjects, args.seed, multi=args.multi,
+                                fingers=args.fingers, blocks_per_pair=args.blocks_per_pair,
+                                n_blocks=args.blocks, counterbalance=args.counterbalance,
+                                max_run=args.max_run, frame_rate=args.frame_rate)
+        print('%d subjects, %d blocks, %d trials -> %s' %
+              (args.subjects, len(index), index['stop'][-1], args.archive))
+    elif args.command == 'export':
+        cohort = load_cohort(args.archive)
+        if not op.exists(args.out):
+            os.makedirs(args.out)
+        idx = cohort['index']
+        s = int(np.flatnonzero(cohort['subjects'] == args.subject)[0])
+        blocks = idx['block'][idx['subject'] == s] if args.block is None else [args.block]
+        for b in blocks:
+            name = get_block(cohort, args.subject, b)[1]
+            print(export_csv(cohort, args.subject, b, op.join(args.out, name + '.csv')))
+    else:
+        parser.print_help()
@@ -1,3 +1,5 @@
+import sys
+
 import numpy as np
 import pandas as pd
 # header: first, second, switch_time
@@ -12,7 +14,7 @@ def mk_block(name='testx.csv', pair=[0, 4], num_trials=80,
     if num_switch_trials % 2 != 0:
         raise ValueError('Make sure both directions are sampled evenly.')
 
-    min_frames = int(min_max_time[0] * frame_rate)  # assume 60 fps
+    min_frames = int(min_max_time[0] * frame_rate)
     max_frames = int(min_max_time[1] * frame_rate)
 
     switch_times = np.random.randint(
@@ -51,13 +53,17 @@ def mk_block(name='testx.csv', pair=[0, 4], num_trials=80,
     pair_frame.to_csv(name, index=False, float_format='%.4f')
 
 
-def mk_blocks(fingers=[0, 4, 5, 9], blocks_per_pair=2):
+def mk_blocks(fingers=[0, 4, 5, 9], blocks_per_pair=2, frame_rate=60):
     pairs = [[a, b] for a in fingers for b in fingers if (a != b & b < a)]
     np.random.shuffle(pairs)
     pairs = np.repeat(pairs, blocks_per_pair, 0)
-    mk_block('block0_demo.csv', pair=pairs[0], num_trials=40, prop_switch=0)
+    mk_block('block0_demo.csv', pair=pairs[0], num_trials=40, prop_switch=0, frame_rate=frame_rate)
     for i, pair in enumerate(pairs):
-        mk_block('block' + str(i + 1) + '.csv', pair=pair)
+        mk_block('block' + str(i + 1) + '.csv', pair=pair, frame_rate=frame_rate)
 
 
-mk_blocks()
+# see cohort.py for seeded, cohort-scale generation
+# switch times are whole frames at `frame_rate` (the display's, e.g. `python mkblocks.py 144`);
+# the experiment rounds them to its measured frame period either way
+if __name__ == '__main__':
+    mk_blocks(frame_rate=float(sys.argv[1]) if len(sys.argv) > 1 else 60)
@@ -1,4 +1,5 @@
 import itertools
+import sys
 
 import numpy as np
 import pandas as pd
@@ -43,11 +44,14 @@ def mk_multi_block(name='testy.csv', combo=[0, 4, 5, 9], num_trials=80,
     pair_frame.to_csv(name, index=False, float_format='%.4f')
 
 
-def mk_multi_blocks(fingers=[0, 4, 5, 9], blocks=8):
+def mk_multi_blocks(fingers=[0, 4, 5, 9], blocks=8, frame_rate=60):
     mk_multi_block('multiblock0_demo.csv', combo=fingers,
-                   num_trials=50, prop_switch=0)
+                   num_trials=50, prop_switch=0, frame_rate=frame_rate)
     for i in range(blocks - 1):
-        mk_multi_block('multiblock' + str(i + 1) + '.csv', combo=fingers)
+        mk_multi_block('multiblock' + str(i + 1) + '.csv', combo=fingers, frame_rate=frame_rate)
 
 
-mk_multi_blocks()
+# see cohort.py for seeded, cohort-scale generation
+# switch times are whole frames at `frame_rate` (see mkblocks.py)
+if __name__ == '__main__':
+    mk_multi_blocks(frame_rate=float(sys.argv[1]) if len(sys.argv) > 1 else 60)
@@ -0,0 +1,64 @@
+import numpy as np
+
+
+class _Target(object):
+    # one element of a TargetArray, with the two calls TwoChoice makes on a target stimulus
+    __slots__ = ('array', 'index')
+
+    def __init__(self, array, index):
+        self.array = array
+        self.index = index
+
+    def setAutoDraw(self, value):
+        self.array.set_visible(self.index, value)
+
+    def setFillColor(self, color):
+        self.array.set_color(self.index, color)
+
+
+class TargetArray(object):
+    """
+    Targets drawn as the elements of one `visual.ElementArrayStim` (`stim`), so all of
+    them are a single draw call however many there are; a hidden target is an element
+    with opacity 0.
+
+    Visibility and colour live in numpy arrays here, and the stimulus is only told when
+    they change (one `setOpacities`/`setColors` per change, for all elements at once).
+    Indexing/iterating gives per-target handles with `setAutoDraw`/`setFillColor`.
+    """
+
+    def __init__(self, stim, n, color):
+        self.stim = stim
+        self.opacities = np.zeros(n)
+        self.colors = np.tile(np.asarray(color, dtype=np.float64), (n, 1))
+        self._targets = [_Target(self, i) for i in range(n)]
+
+    def __getitem__(self, index):
+        return self._targets[index]
+
+    def __iter__(self):
+        return iter(self._targets)
+
+    def __len__(self):
+        return len(self._targets)
+
+    def set_visible(self, index, visible):
+        value = 1.0 if visible else 0.0
+        if self.opacities[index] != value:
+            self.opacities[index] = value
+            self.stim.setOpacities(self.opacities.copy(), log=False)
+
+    def hide(self):
+        if self.opacities.any():
+            self.opacities[:] = 0.0
+            self.stim.setOpacities(self.opacities.copy(), log=False)
+
+    def set_color(self, index, color):
+        if (self.colors[index] != color).any():
+            self.colors[index] = color
+            self.stim.setColors(self.colors.copy(), log=False)
+
+    def fill(self, color):
+        if (self.colors != np.asarray(color, dtype=np.float64)).any():
+            self.colors[:] = color
+            self.stim.setColors(self.colors.copy(), log=False)
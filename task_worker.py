@@ -0,0 +1,105 @@
+import json
+import queue
+import sys
+import threading
+import time
+import traceback
+
+import numpy as np
+
+# lower runs first; tasks of equal priority run in the order they were submitted
+HIGH = 0  # e.g. sounds, which are late the longer they wait
+NORMAL = 1  # state that has to be in place before the next trial
+LOW = 2  # logging, printing
+
+
+class TaskWorker(object):
+    """
+    Runs deferred work from state machine callbacks on a background thread.
+
+    `submit` puts a function call on a priority queue and returns at once; `wait`
+    blocks until everything submitted so far has run. TwoChoice waits between trials
+    (post_trial to pretrial, where nothing is timed), so whatever a trial leaves behind
+    (e.g. its event rows) has landed before the next one draws anything. Stimuli are only touched on the render thread.
+
+    Every task's queueing delay and run time is kept by name, see `report`. A task that
+    raises doesn't stop the worker; the first error is raised again by `wait`/`close`.
+    """
+
+    def __init__(self, name='TaskWorker'):
+        self.closed = False
+        self._queue = queue.PriorityQueue()
+        self._seq = 0
+        self._error = None
+        # name -> [queue delay (s)], [run time (s)], appended by the worker thread only
+        self.timings = {}
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        # `priority` and `name` (default: the function's) are taken from kwargs
+        priority = kwargs.pop('priority', NORMAL)
+        name = kwargs.pop('name', None) or getattr(function, '__name__', repr(function))
+        self._seq += 1
+        self._queue.put((priority, self._seq, name, time.perf_counter(), function, args, kwargs))
+
+    def wait(self):
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.put((sys.maxsize, 0, None, 0.0, None, (), {}))
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            priority, _, name, submitted, function, args, kwargs = self._queue.get()
+            if function is None:
+                self._queue.task_done()
+                return
+            t0 = time.perf_counter()
+            try:
+                function(*args, **kwargs)
+            except Exception as e:
+                traceback.print_exc()
+                if self._error is None:
+                    self._error = e
+            t1 = time.perf_counter()
+            delays, runs = self.timings.setdefault(name, ([], []))
+            delays.append(t0 - submitted)
+            runs.append(t1 - t0)
+            self._queue.task_done()
+
+    def report(self):
+        # per task name: count, total and p50/p99/max run time, p50/max queueing delay (ms)
+        out = {}
+        for name, (delays, runs) in sorted(self.timings.items()):
+            runs = np.array(runs) * 1000
+            delays = np.array(delays) * 1000
+            out[name] = {'count': int(runs.size), 'total_ms': float(runs.sum()),
+                         'run_ms': np.percentile(runs, [50, 99, 100]).tolist(),
+                         'delay_ms': np.percentile(delays, [50, 100]).tolist()}
+        return out
+
+    def save(self, base_name):
+        # `<base_name>_tasks.json`
+        report = self.report()
+        with open(base_name + '_tasks.json', 'w') as f:
+            json.dump(report, f, indent=1)
+        return report
+
+
+def format_tasks(report):
+    lines = ['%-22s %6s %9s  run ms p50/p99/max   delay ms p50/max' % ('task', 'count', 'total ms')]
+    for name, entry in report.items():
+        lines.append('%-22s %6d %9.2f  %-20s %s' % (name, entry['count'], entry['total_ms'],
+                                                     '/'.join('%.3f' % x for x in entry['run_ms']),
+                                                     '/'.join('%.3f' % x for x in entry['delay_ms'])))
+    return '\n'.join(lines)
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+class Trial(object):
+    """One row of the trial table, plus values derived from it at load time."""
+    __slots__ = ('first', 'second', 'switch_time', 'first_index', 'second_index',
+                 'is_switch', 'switch_onset', 'switch_frame')
+
+
+class TrialPlan(list):
+    """
+    The trial table compiled into a list of `Trial`s, so the per-frame callbacks do a
+    list index + attribute load instead of a pandas lookup.
+
+    `switch_time` is how long before the last beep the second target appears (as in the
+    table); `switch_onset` is when that is after trial start, rounded to whole frames,
+    and `switch_frame` the same in frames (see frame_timing.py).
+    """
+
+    def __init__(self, trials, timing, last_beep_time):
+        super(TrialPlan, self).__init__(trials)
+        self.timing = timing
+        self.last_beep_time = last_beep_time
+
+    def set_switch_time(self, index, switch_time):
+        # used by the adaptive procedure; keeps the derived values in sync
+        trial = self[index]
+        trial.switch_time = float(switch_time)
+        onset = self.last_beep_time - trial.switch_time
+        trial.switch_onset = float(self.timing.quantize(onset))
+        trial.switch_frame = int(self.timing.frames(onset))
+
+
+def compile_trial_plan(table, target_index, timing, last_beep_time):
+    # `target_index` maps an array of table values (e.g. finger numbers) to indices into `targets`
+    first = np.asarray(table['first']).astype(int)
+    second = np.asarray(table['second']).astype(int)
+    switch_time = np.asarray(table['switch_time'], dtype=float)
+    first_index = np.asarray(target_index(first)).astype(int)
+    second_index = np.asarray(target_index(second)).astype(int)
+    is_switch = first != second
+    onset = last_beep_time - switch_time
+    switch_onset = timing.quantize(onset).astype(float)
+    switch_frame = timing.frames(onset)
+
+    trials = []
+    for row in zip(first.tolist(), second.tolist(), switch_time.tolist(), first_index.tolist(),
+                   second_index.tolist(), is_switch.tolist(), switch_onset.tolist(), switch_frame.tolist()):
+        trial = Trial()
+        (trial.first, trial.second, trial.switch_time, trial.first_index,
+         trial.second_index, trial.is_switch, trial.switch_onset, trial.switch_frame) = row
+        trials.append(trial)
+    return TrialPlan(trials, timing, last_beep_time)
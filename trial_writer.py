@@ -0,0 +1,124 @@
+import atexit
+import csv
+import json
+import os
+import os.path as op
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+
+
+class TrialWriter(object):
+    """
+    Appends rows to a CSV file from a background thread.
+
+    `write` only copies the row into a queue, so it is safe to call from state machine
+    callbacks on the render thread. The thread drains the queue in batches, flushes
+    after every batch (so rows survive a crash of the experiment) and fsyncs every
+    `fsync_interval` seconds and on `close` (so rows survive losing the machine).
+    If `dtype` is given, every row is also appended to a binary sidecar
+    (`<name>.bin`, layout in `<name>.bin.json`), see `load_sidecar`; strings are stored
+    UTF-8 encoded. If a batch can't be converted to `dtype`, the error is printed, kept
+    in `sidecar_error` and the sidecar stops there; the CSV carries on.
+    """
+
+    def __init__(self, file_name, fieldnames, dtype=None, fsync_interval=1.0):
+        self.file_name = file_name
+        self.fieldnames = list(fieldnames)
+        self.fsync_interval = fsync_interval
+        self.closed = False
+        self._queue = queue.Queue()
+        self._csv_file = open(file_name, 'w')
+        self._csv = csv.writer(self._csv_file, lineterminator='\n')
+        self._csv.writerow(self.fieldnames)
+        self._csv_file.flush()
+
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.sidecar_name = None
+        self._bin_file = None
+        self.sidecar_error = None
+        if self.dtype is not None:
+            self.sidecar_name = op.splitext(file_name)[0] + '.bin'
+            with open(self.sidecar_name + '.json', 'w') as f:
+                json.dump(self.dtype.descr, f)
+            self._bin_file = open(self.sidecar_name, 'wb')
+
+        self._thread = threading.Thread(target=self._run, name='TrialWriter', daemon=True)
+        self._thread.start()
+        # daemon threads are not joined at exit, so flush whatever is queued ourselves
+        atexit.register(self.close)
+
+    def write(self, row):
+        # copy now; callers are free to reuse `row` afterwards
+        self._queue.put([row.get(k, '') for k in self.fieldnames])
+
+    def extend(self, rows):
+        # several rows at once, each a sequence of values in `fieldnames` order
+        for row in rows:
+            self._queue.put(list(row))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.put(None)
+        self._thread.join()
+        # (the hook would keep the writer alive until exit)
+        atexit.unregister(self.close)
+
+    def _run(self):
+        last_sync = time.monotonic()
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+            if batch:
+                self._write_batch(batch)
+            now = time.monotonic()
+            if done or now - last_sync >= self.fsync_interval:
+                self._sync()
+                last_sync = now
+        self._csv_file.close()
+        if self._bin_file is not None:
+            self._bin_file.close()
+
+    def _write_batch(self, batch):
+        self._csv.writerows(batch)
+        self._csv_file.flush()
+        if self._bin_file is not None:
+            try:
+                rows = [tuple(v.encode('utf-8') if isinstance(v, str) else v for v in r) for r in batch]
+                np.array(rows, dtype=self.dtype).tofile(self._bin_file)
+                self._bin_file.flush()
+            except Exception as e:
+                # (a dead thread would lose every later CSV row too)
+                traceback.print_exc()
+                self.sidecar_error = e
+                self._bin_file.close()
+                self._bin_file = None
+
+    def _sync(self):
+        os.fsync(self._csv_file.fileno())
+        if self._bin_file is not None:
+            os.fsync(self._bin_file.fileno())
+
+
+def load_sidecar(file_name, mmap=False):
+    # `file_name` is either the CSV or the .bin sidecar next to it
+    if not file_name.endswith('.bin'):
+        file_name = op.splitext(file_name)[0] + '.bin'
+    with open(file_name + '.json', 'r') as f:
+        dtype = np.dtype([tuple(d) for d in json.load(f)])
+    if mmap:
+        return np.memmap(file_name, dtype=dtype, mode='r')
+    return np.fromfile(file_name, dtype=dtype)
@@ -1,25 +1,26 @@
-import csv
 import os
 import os.path as op
 import shutil
 from datetime import datetime as dt
+from datetime import timedelta
 
 import numpy as np
-import pandas as pd
-from psychopy import prefs
-# we need to set prefs *before* setting the other stuff
-prefs.general['audioLib'] = ['sounddevice']
-from psychopy import clock, core, sound, visual, logging
-from scipy import signal as sg
 
+from adaptive import make_procedure
+from event_log import EventLog
+from frame_profiler import FrameProfiler, format_report
+from frame_timing import FlipCounter, FrameTiming, measure_frame_period
+from input_stream import TRIAL_START, InputStream
+from key_events import KeyEventLog
+from ring_buffer import RingBuffer
+from startup import cached_beep_sequence, load_trial_table, profile
 from state_dec import StateMachine
-from toon.audio import beep_sequence
-from toon.input import MultiprocessInput
-from toon.input.force_transducers import ForceTransducers
-from toon.input.keyboard import Keyboard
-from toon.input.clock import mono_clock
+from task_worker import HIGH, LOW, TaskWorker, format_tasks
+from trial_plan import compile_trial_plan
+from trial_writer import TrialWriter
 
-logging.setDefaultClock(mono_clock)
+# psychopy, toon (and pandas/scipy) are imported where they are used, so that
+# startup only pays for what the chosen settings need (see `python exp.py --profile-startup`)
 
 
 class TwoChoice(StateMachine):
@@ -32,21 +33,216 @@ class TwoChoice(StateMachine):
     def __init__(self, settings=None):
 
         super(TwoChoice, self).__init__()
-        # clocks and timers
+        with profile.phase('clocks'):
+            self.setup_clocks()
+
+        # trial table (dict of numpy columns, cached across launches)
+        with profile.phase('trial table'):
+            try:
+                self.trial_table = load_trial_table(settings['trial_table'])
+            except FileNotFoundError:
+                from psychopy import core
+                core.quit()
+
+        with profile.phase('window'):
+            self.setup_window(settings)
+        with profile.phase('visuals'):
+            self.setup_visuals()  # decouple for the sake of the other exp
+        self.last_beep_time = round(0.1 + (0.4 * 3), 2)
+        with profile.phase('audio'):
+            self.setup_audio()
+        with profile.phase('device'):
+            self.setup_device(settings)
+        # what to do with a read is decided once, not every frame
+        names = getattr(self.device, 'names', [self.device.device.__name__])  # an InputHub has several
+        self.has_forces = any(name != 'Keyboard' for name in names)
+        if self.device.device.__name__ == 'InputHub':
+            self.decode_input = self.decode_hub
+            self.hub_decoders = [(source, self.decode_keyboard_rows if name == 'Keyboard' else self.decode_force_rows)
+                                 for source, name in enumerate(names)]
+        elif names[0] == 'Keyboard':
+            self.decode_input = self.decode_keyboard
+        else:
+            self.decode_input = self.decode_forces
+        self.settings = settings
+        self.csv_header = ['index', 'subject', 'first_target', 'second_target',
+                           'real_switch_time', 'first_press', 'first_press_time', 'correct', 'prep_time']
+        # typed columns for the binary sidecar (same order as the header); the subject is
+        # stored UTF-8 encoded, in a field as wide as it is
+        subject_bytes = max(1, len(settings['subject'].encode('utf-8')))
+        self.csv_dtype = [('index', 'i4'), ('subject', 'S%d' % subject_bytes), ('first_target', 'i1'),
+                          ('second_target', 'i1'), ('real_switch_time', 'f8'), ('first_press', 'f4'),
+                          ('first_press_time', 'f8'), ('correct', 'i1'), ('prep_time', 'f8')]
+        # requested vs realized onsets (after trial start, see frame_timing.py)
+        self.timing_header = ['index', 'frame_period', 'first_requested', 'first_realized',
+                              'switch_requested', 'switch_realized', 'feedback_requested',
+                              'feedback_realized', 'feedback_end_requested', 'feedback_end_realized']
+
+        self.trial_data = {'index': np.nan, 'subject': settings['subject'], 'first_target': np.nan,
+                           'second_target': np.nan, 'real_switch_time': np.nan,
+                           'first_press': np.nan, 'first_press_time': np.nan,
+                           'correct': np.nan, 'prep_time': np.nan}
+
+        # extras
+        with profile.phase('frame period'):
+            self.frame_period = self.measure_frame_period()
+        # everything is scheduled in whole frames
+        self.timing = FrameTiming(self.frame_period)
+        self.trial_length = self.last_beep_time + 0.2  # trial ends 200 ms after last beep
+        self.first_onset = 0.1
+        self.feedback_duration = 0.3
+        self.post_duration = 0.1
+        # frames from the trial start flip to each event (the switch is per trial)
+        self.first_frames = int(self.timing.frames(self.first_onset))
+        self.response_frames = int(self.timing.frames(self.trial_length))
+        self.feedback_end_frames = self.response_frames + int(self.timing.frames(self.feedback_duration))
+        self.post_end_frames = self.feedback_end_frames + int(self.timing.frames(self.post_duration))
+        # this trial's events as flip counts, set at the trial start flip (plan_timeline)
+        self.flips = FlipCounter(self.win, self.frame_period)
+        self.flips.install()
+        self.first_flip = self.switch_flip = self.response_end_flip = 0
+        self.feedback_end_flip = self.post_end_flip = 0
+        self.trial_start = 0
+        # ~4 s of force data at 1 kHz; the window since trial start is a view into it
+        self.trial_input_buffer = RingBuffer(4096, 10)
+        # presses from the raw forces (see force_onset.py)
+        self.onset_detector = None
+        if self.has_forces:
+            from force_onset import OnsetDetector
+            self.onset_detector = OnsetDetector(10)
+        self.first_press = np.nan
+        self.first_press_time = np.nan
+        self.key_events = KeyEventLog(10)  # key state (bitmask) + this trial's events
+        self.device_on = False
+        self.shown_on = False  # what push_feedback currently shows
+        self.correct_answer = False
+        self.shown_text = None  # name of the feedback text on screen
+        self.adaptive = settings['adaptive']
+        self.trial_counter = 0
+
+        # per-frame timing of the main loop (settings['profile'])
+        self.profiler = None
+        if settings.get('profile', False):
+            self.profiler = FrameProfiler(self)
+            self.profiler.install()
+
+        # every device read and flip time, for replay.py (settings['record'])
+        self.recorder = None
+        if settings.get('record', False):
+            from replay import SessionRecorder
+            self.recorder = SessionRecorder(self, settings)
+            self.recorder.install()
+
+        # no GC mid-trial, pinned cores, higher priority (settings['realtime'], see realtime.py)
+        self.realtime = None
+        if settings.get('realtime', False):
+            from realtime import RealtimeMode
+            self.realtime = RealtimeMode()
+
+        self.block_open = False
+        self.summary_file_names = []  # one per block
+        self.start_block(settings['trial_table'], self.trial_table, self.compile_plan(self.trial_table))
+
+    # everything above lasts the whole session; a block (one trial table) starts here,
+    # see session.py for running several in one session
+    def compile_plan(self, table):
+        # everything the per-frame callbacks need, looked up once
+        return compile_trial_plan(table, lambda values: self.target_index(values, table), self.timing,
+                                  self.last_beep_time)
+
+    def prepare_block(self, table_file):
+        # touches nothing in use, so the next block can be prepared on another thread
+        table = load_trial_table(table_file)
+        return table_file, table, self.compile_plan(table)
+
+    def start_block(self, table_file, table, plan, initial_state='wait'):
+        settings = self.settings
+        self.trial_table = table
+        self.trial_plan = plan
+        self.trial_counter = 0  # start at zero b/c zero indexing
+        # input state starts over with each block, as it does in a replay of the block
+        self.key_events.reset()
+        self.events_index = -1  # trial the logged key events go under (see write_pending_events)
+        self.events_written = 0  # key events already handed to event_writer
+        self.trial_start = self.global_clock.getTime()  # time base of events before the first trial
+        self.device_on = False
+        if self.onset_detector is not None:
+            self.onset_detector.reset()
+        # by-trial data
+        data_path = settings.get('data_dir', 'data') + '/' + settings['subject'] + '/'
+        if not op.exists(data_path):
+            os.makedirs(data_path)
+        # copy the trial table to the data folder
+        adaptstring = '_adapt' if settings['adaptive'] else ''
+        shutil.copyfile(table_file, data_path + op.basename(table_file))
+        # (a block of the same table started within the same second takes the next second)
+        now = dt.now()
+        while True:
+            self.summary_file_name = data_path + 'id_' + settings['subject'] + '_' + \
+                op.splitext(op.basename(table_file))[0] + \
+                adaptstring + now.strftime('_%H%M%S') + '.csv'
+            if not op.exists(self.summary_file_name):
+                break
+            now += timedelta(seconds=1)
+        self.summary_file_names.append(self.summary_file_name)
+        base_name = op.splitext(self.summary_file_name)[0]
+        # rows are written from a background thread, so record_data never touches the disk
+        self.writer = TrialWriter(self.summary_file_name, self.csv_header,
+                                  dtype=self.csv_dtype if settings.get('binary_sidecar', True) else None)
+        # every key press/release, one row per event (time is relative to trial start); events
+        # between trials go under the trial before (index -1 and block start before the first)
+        self.events_file_name = base_name + '_events.csv'
+        self.event_writer = TrialWriter(self.events_file_name, ['index', 'time', 'key', 'state'],
+                                        dtype=[('index', 'i4'), ('time', 'f8'), ('key', 'i1'), ('state', 'i1')]
+                                        if settings.get('binary_sidecar', True) else None)
+        self.timing_writer = TrialWriter(base_name + '_timing.csv', self.timing_header)
+        self.timing_data = dict.fromkeys(self.timing_header, np.nan)
+        self.timing_data['frame_period'] = self.frame_period
+        # callbacks hand work that needn't happen within the frame to this thread (task_worker.py)
+        self.tasks = TaskWorker()
+        # ... and every sample of the block, on disk (see input_stream.py)
+        self.input_stream = None
+        if self.has_forces and settings.get('stream', True):
+            self.input_stream = InputStream(base_name, 10, self.states)
+        # stimulus, state and input events as binary records (see event_log.py)
+        self.event_log = EventLog(base_name, self.win, self.states)
+        self.event_log.state = self.states.index(initial_state)
+        if initial_state == 'wait':
+            self.event_log.stim('wait_text', True)
+
+        # things related to the adaptive version (see adaptive.py)
+        n_choices = np.unique(np.concatenate((table['first'], table['second']))).size
+        self.procedure = make_procedure(settings.get('procedure', 'staircase'), n_choices=n_choices,
+                                        frame_period=self.frame_period)
+        if self.realtime is not None:
+            self.realtime.writer = TrialWriter(base_name + '_gc.csv', self.realtime.header)
+            print('realtime: %s' % self.realtime.start())
+        if self.profiler is not None:
+            self.profiler.reset()
+        if self.recorder is not None:
+            self.recorder.reset(table_file, initial_state)
+        self.block_open = True
+
+    def next_block(self, table_file, table, plan, wait=False):
+        # after cleanup: start the next block in place, straight into its first trial unless `wait`
+        self.start_block(table_file, table, plan, 'wait' if wait else 'pretrial')
+        if wait:
+            self.wait_text.text = self.wait_message()
+            self.wait_text.autoDraw = True
+            self.to_wait()
+        else:
+            self.to_pretrial()
+
+    # the setup_ methods are the only places that talk to psychopy/toon directly,
+    # see headless.py for the simulated versions
+    def setup_clocks(self):
+        from toon.input.clock import mono_clock
+        # trial events are counted in flips (see plan_timeline), this is for timestamps
         self.global_clock = mono_clock
-        # gives us the time until the end of the trial (counts down)
-        self.trial_timer = core.CountdownTimer()
-        # gives time that feedback shows (counts down)
-        self.feedback_timer = core.CountdownTimer()
-        # gives time between trials (counts down)
-        self.post_timer = core.CountdownTimer()
-
-        # trial table
-        try:
-            self.trial_table = pd.read_csv(settings['trial_table'])
-        except FileNotFoundError:
-            core.quit()
 
+    def setup_window(self, settings):
+        from psychopy import logging, visual
+        logging.setDefaultClock(self.global_clock)
         self.win = visual.Window(size=(800, 800),
                                  pos=(0, 0),
                                  fullscr=settings['fullscreen'],
@@ -57,116 +253,103 @@ class TwoChoice(StateMachine):
                                  color=(-1, -1, -1))
         self.win.recordFrameIntervals = True
 
-        self.setup_visuals()  # decouple for the sake of the other exp
-        # audio
-        tmp = beep_sequence(click_freq=(523.251, 659.255, 783.991, 1046.5),
-                            inter_click_interval=0.4,
-                            num_clicks=4,
-                            dur_clicks=0.04)
-        self.last_beep_time = round(0.1 + (0.4 * 3), 2)
-
+    def setup_audio(self):
+        from psychopy import prefs
+        # we need to set prefs *before* importing sound
+        prefs.general['audioLib'] = ['sounddevice']
+        from psychopy import sound
+        tmp = cached_beep_sequence(click_freq=(523.251, 659.255, 783.991, 1046.5),
+                                   inter_click_interval=0.4,
+                                   num_clicks=4,
+                                   dur_clicks=0.04)
         self.beep = sound.Sound(tmp, blockSize=16, hamming=False)
         # TODO: check bug in auto-config of sounddevice (stereo = -1)
         self.coin = sound.Sound('media/coin.wav', stereo=True)
-        # Input device
-        if settings['forceboard']:
+
+    def measure_frame_period(self):
+        return measure_frame_period(self.win)
+
+    def setup_device(self, settings):
+        from toon.input import MultiprocessInput
+        if settings.get('hub', False):
+            # forces and keyboard in the same session, see input_hub.py
+            from toon.input.force_transducers import ForceTransducers
+            from toon.input.keyboard import Keyboard
+            from input_hub import HubDevice, InputHub, pack_keyboard, pack_samples
+            self.device = InputHub([HubDevice(ForceTransducers, 10, pack_samples),
+                                    HubDevice(Keyboard, 2, pack_keyboard, keys=list('awefvbhuil'))],
+                                   clock=self.global_clock)
+        elif settings['forceboard']:
+            from toon.input.force_transducers import ForceTransducers
             self.device = MultiprocessInput(
                 ForceTransducers, clock=self.global_clock.getTime)
         else:
+            from toon.input.keyboard import Keyboard
             keys = 'awefvbhuil'
             self.device = MultiprocessInput(Keyboard, keys=list(
                 keys), clock=self.global_clock.getTime)
-            self.keyboard_state = [False] * 10
-        # by-trial data
-        data_path = 'data/' + settings['subject'] + '/'
-        if not op.exists(data_path):
-            os.makedirs(data_path)
-        # copy the trial table to the data folder
-        adaptstring = '_adapt' if settings['adaptive'] else ''
-        shutil.copyfile(settings['trial_table'], data_path +
-                        op.basename(settings['trial_table']))
-        self.summary_file_name = data_path + 'id_' + settings['subject'] + '_' + \
-            op.splitext(op.basename(settings['trial_table']))[0] + \
-            adaptstring + dt.now().strftime('_%H%M%S') + '.csv'
-        self.csv_header = ['index', 'subject', 'first_target', 'second_target',
-                           'real_switch_time', 'first_press', 'first_press_time', 'correct', 'prep_time']
-        with open(self.summary_file_name, 'w') as f:
-            writer = csv.DictWriter(
-                f, fieldnames=self.csv_header, lineterminator='\n')
-            writer.writeheader()
-
-        self.trial_data = {'index': np.nan, 'subject': settings['subject'], 'first_target': np.nan,
-                           'second_target': np.nan, 'real_switch_time': np.nan,
-                           'first_press': np.nan, 'first_press_time': np.nan,
-                           'correct': np.nan, 'prep_time': np.nan}
-
-        # extras
-        self.frame_period = self.win.monitorFramePeriod
-        self.trial_start = 0
-        self.trial_counter = 0  # start at zero b/c zero indexing
-        self.trial_input_buffer = np.full((600, 10), np.nan)
-        self.trial_input_time_buffer = np.full((600, 1), np.nan)
-        self.first_press = np.nan
-        self.first_press_time = np.nan
-        self.left_val = self.trial_table[['first', 'second']].min(axis=0).min()
-        self.right_val = self.trial_table[['first', 'second']].max(axis=0).max()
-        self.device_on = False
-        self.correct_answer = False
-        
-        # things related to the adaptive version
-        self.adaptive = settings['adaptive']
-        self.sign_switch_count = 0 # number of times the correctness switched
-        self.curr_sign = False
-        self.prev_sign = False
-        self.curr_prep_time = 0.5 # start at 500ms
-
 
     def setup_visuals(self):
+        from psychopy import visual
         # visually-related things
         # targets
         poses = [(-0.6, 0), (0.6, 0)]  # vary just on x-axis
         names = ['left_target', 'right_target']
-        self.targets = [visual.Rect(self.win, width=0.5, height=0.5, fillColor=[0, 0, 0], pos=p, lineWidth=0, name=n)
+        self.targets = [visual.Rect(self.win, width=0.5, height=0.5, fillColor=[0, 0, 0], pos=p, lineWidth=0,
+                                    autoLog=False, name=n)
                         for p, n in zip(poses, names)]
 
-        fingers = ['pinky', 'ring', 'middle', 'index', 'thumb']
-        left_hand = ['left ' + f for f in fingers]
-        fingers.reverse()
-        right_hand = ['right ' + f for f in fingers]
-        both_hands = left_hand + right_hand
-        uniques = pd.unique(self.trial_table['first']).astype(int)
-        unique_finger_names = [both_hands[i] for i in uniques]
-        unique_str = ", ".join(unique_finger_names)  # gives something like "left pinky, left thumb"
-
-
         # push feedback
         self.push_feedback = visual.Circle(self.win, size=0.1, fillColor=[-1, -1, -1], pos=(0, 0),
                                            autoDraw=False, autoLog=False, name='push_feedback')
         # fixation
         self.fixation = visual.Circle(self.win, size=0.05, fillColor=[1, 1, 1], pos=(0, 0),
-                                      autoDraw=False, name='fixation')
+                                      autoDraw=False, autoLog=False, name='fixation')
 
         # text
-        self.wait_text = visual.TextStim(self.win, text='Press a key to start.\nKeys are:\n' + unique_str, pos=(0, 0),
+        self.wait_text = visual.TextStim(self.win, text=self.wait_message(), pos=(0, 0),
                                          units='norm', color=(1, 1, 1), height=0.1,
                                          alignHoriz='center', alignVert='center', name='wait_text',
                                          autoLog=False, wrapWidth=2)
         self.wait_text.autoDraw = True
         self.good = visual.TextStim(self.win, text=u'Good timing!', pos=(0, 0.4),
                                     units='norm', color=(-1, 1, 0.2), height=0.1,
-                                    alignHoriz='center', alignVert='center', autoLog=True, name='good_text')
+                                    alignHoriz='center', alignVert='center', autoLog=False, name='good_text')
         self.too_slow = visual.TextStim(self.win, text=u'Too slow.', pos=(0, 0.4),
                                         units='norm', color=(1, -1, -1), height=0.1,
-                                        alignHoriz='center', alignVert='center', autoLog=True, name='slow_text')
+                                        alignHoriz='center', alignVert='center', autoLog=False, name='slow_text')
         self.too_fast = visual.TextStim(self.win, text=u'Too fast.', pos=(0, 0.4),
                                         units='norm', color=(1, -1, -1), height=0.1,
-                                        alignHoriz='center', alignVert='center', autoLog=True, name='fast_text')
+                                        alignHoriz='center', alignVert='center', autoLog=False, name='fast_text')
+
+    def wait_message(self):
+        # the current block's fingers
+        fingers = ['pinky', 'ring', 'middle', 'index', 'thumb']
+        left_hand = ['left ' + f for f in fingers]
+        fingers.reverse()
+        right_hand = ['right ' + f for f in fingers]
+        both_hands = left_hand + right_hand
+        firsts = self.trial_table['first']
+        uniques = firsts[np.sort(np.unique(firsts, return_index=True)[1])].astype(int)  # in order of appearance
+        unique_finger_names = [both_hands[i] for i in uniques]
+        unique_str = ", ".join(unique_finger_names)  # gives something like "left pinky, left thumb"
+        return 'Press a key to start.\nKeys are:\n' + unique_str
+
+    def target_index(self, targets, table):
+        # This is tricky -- if the condition evaluates to false, use the left target
+        return targets == max(table['first'].max(), table['second'].max())
 
     # wait functions
     def remove_text(self):
         self.wait_text.autoDraw = False
         self.push_feedback.autoDraw = True
         self.fixation.autoDraw = True
+        self.log_stims(('wait_text', False), ('push_feedback', True), ('fixation', True))
+
+    def log_stims(self, *changes):
+        # (name, on) pairs, all shown from the next flip
+        for name, on in changes:
+            self.event_log.stim(name, on)
 
     # pretrial functions
     def wait_for_release(self):
@@ -177,172 +360,305 @@ class TwoChoice(StateMachine):
         self.beep.seek(self.beep.stream.latency)  # 100ms of silence is built into the click train, so we can seek in without affecting the actual stimulus
         self.win.callOnFlip(self.beep.play)
 
-    def sched_trial_timer_reset(self):
-        # trial ends 200 ms after last beep
-        self.win.callOnFlip(self.trial_timer.reset, self.last_beep_time + 0.2 - self.frame_period)
-
     def sched_record_trial_start(self):
         self.win.callOnFlip(self._get_trial_start)
 
     def _get_trial_start(self):
         self.trial_start = self.win.lastFrameT
+        self.event_log.start_trial(self.trial_start)
+        self.plan_timeline()
+        self.trial_input_buffer.mark()
+        if self.input_stream is not None:
+            self.input_stream.mark(self.trial_start, self.trial_counter, TRIAL_START)
+
+    def plan_timeline(self):
+        # each event is drawn at the flip before it should appear, so at count start + frames - 1
+        start = self.flips.current() - 1
+        self.first_flip = start + self.first_frames
+        self.switch_flip = start + self.trial_plan[self.trial_counter].switch_frame
+        self.response_end_flip = start + self.response_frames
+        self.feedback_end_flip = start + self.feedback_end_frames
+        self.post_end_flip = start + self.post_end_frames
+
+    def mark_state(self):
+        # after every state change (after_state_change in state_dec)
+        state = self.states.index(self.state)
+        now = self.global_clock.getTime()
+        self.event_log.enter_state(now, self.trial_counter, state)
+        if self.input_stream is not None:
+            self.input_stream.mark(now, self.trial_counter, state)
+
+    def wait_tasks(self):
+        # whatever the last trial handed to the task worker lands before the next one starts;
+        # on the way to pretrial, so a slow write can't delay the trial start
+        self.tasks.wait()
+
+    def hold_gc(self):
+        if self.realtime is not None:
+            self.realtime.hold()
+
+    def sched_release_gc(self):
+        # collect right after the flip that ends feedback, i.e. in the first post_trial frame
+        if self.realtime is not None:
+            self.win.callOnFlip(self.realtime.release, self.trial_counter)
 
     def first_press_reset(self):
         self.first_press = np.nan
         self.first_press_time = np.nan
+        self.write_pending_events()
+        self.key_events.clear()
+        self.events_index = self.trial_counter
+        self.events_written = 0
+
+    def write_pending_events(self):
+        # key events since the last write (e.g. during the inter-trial interval), copied
+        # since the log is about to be cleared
+        times, keys, states = self.key_events.events()
+        n = self.events_written
+        if times.shape[0] > n:
+            self.tasks.submit(self.write_events, self.events_index, self.trial_start, times[n:].copy(),
+                              keys[n:].copy(), states[n:].copy(), priority=LOW)
+        self.events_written = times.shape[0]
 
     # enter_trial functions
-    def trial_timer_passed_first(self):
-        # determine if 100 ms has elapsed
-        # The timer is started at last_beep_time + 0.2
-        # TODO: Think about this one
-        return (self.last_beep_time + 0.2 - self.trial_timer.getTime() + self.frame_period) >= 0.1
+    def passed_first(self):
+        # first target appears 100 ms after trial start
+        return self.flips.count >= self.first_flip
 
     def show_first_target(self):
-        # This is tricky -- if the condition evaluates to false, draw the left target
-        self.targets[int(self.trial_table['first'][self.trial_counter] == self.right_val)].setAutoDraw(True)
+        index = self.trial_plan[self.trial_counter].first_index
+        self.targets[index].setAutoDraw(True)
+        self.event_log.stim('target', True, index)
+        self.win.callOnFlip(self.log_flip, 'first_realized')
+
+    def log_flip(self, name):
+        self.timing_data[name] = self.win.lastFrameT - self.trial_start
 
     # first_target functions
-    def trial_timer_passed_second(self):
-        # this timer is the other way around
-        return ((self.trial_timer.getTime() - 0.2 - self.frame_period) <= self.trial_table['switch_time'][self.trial_counter])
+    def passed_switch(self):
+        return self.flips.count >= self.switch_flip
 
     def show_second_target(self):
-        self.targets[int(self.trial_table['first'][self.trial_counter] == self.right_val)].setAutoDraw(False)
-        self.targets[int(self.trial_table['second'][self.trial_counter] == self.right_val)].setAutoDraw(True)
+        trial = self.trial_plan[self.trial_counter]
+        self.targets[trial.first_index].setAutoDraw(False)
+        self.targets[trial.second_index].setAutoDraw(True)
+        self.event_log.stim('target', False, trial.first_index)
+        self.event_log.stim('target', True, trial.second_index)
         self.win.callOnFlip(self.log_switch_time)
 
     def log_switch_time(self):
         self.trial_data['real_switch_time'] = self.win.lastFrameT - self.trial_start
+        self.timing_data['switch_realized'] = self.trial_data['real_switch_time']
         # print(self.trial_table['switch_time'][self.trial_counter])
         # print(self.last_beep_time - self.trial_data['real_switch_time'])
 
     # second_target functions
-    def trial_timer_elapsed(self):
-        return self.trial_timer.getTime() <= 0
+    def response_window_over(self):
+        return self.flips.count >= self.response_end_flip
 
     def record_data(self):
+        trial = self.trial_plan[self.trial_counter]
         self.trial_data['index'] = self.trial_counter
-        self.trial_data['first_target'] = int(self.trial_table['first'][self.trial_counter])
-        self.trial_data['second_target'] = int(self.trial_table['second'][self.trial_counter])
+        self.trial_data['first_target'] = trial.first
+        self.trial_data['second_target'] = trial.second
         # real_switch_time logged in log_switch_time
         self.trial_data['first_press'] = self.first_press
         self.trial_data['first_press_time'] = self.first_press_time
         self.trial_data['correct'] = int(self.correct_answer)
         self.trial_data['prep_time'] = self.first_press_time - self.trial_data['real_switch_time']
-        # now write data
-        with open(self.summary_file_name, 'a') as f:
-            writer = csv.DictWriter(f, fieldnames=self.csv_header, lineterminator='\n')
-            writer.writerow(self.trial_data)
+        # now write data (queued, the writer thread does the I/O)
+        self.writer.write(self.trial_data)
+        # the views stay valid until the next trial clears the log, after wait_tasks
+        times, keys, states = self.key_events.events()
+        self.tasks.submit(self.write_events, self.trial_counter, self.trial_start, times, keys, states,
+                          priority=LOW)
+        self.events_written = times.shape[0]
+        # this trial's records so far (copied now, written by the task worker)
+        self.tasks.submit(self.event_log.write, self.event_log.take(), priority=LOW, name='write_log')
+        # the end of feedback is only realized at the next flip
+        feedback = self.timing.quantize(self.trial_length)
+        self.timing_data.update({'index': self.trial_counter,
+                                 'first_requested': self.timing.quantize(self.first_onset),
+                                 'switch_requested': trial.switch_onset,
+                                 'feedback_requested': feedback,
+                                 'feedback_end_requested': feedback + self.timing.quantize(self.feedback_duration)})
+        self.win.callOnFlip(self.record_timing)
 
         self.trial_data.update({'index': np.nan, 'first_target': np.nan, 'second_target': np.nan,
                                 'real_switch_time': np.nan, 'first_press': np.nan,
                                 'first_press_time': np.nan, 'correct': np.nan, 'prep_time': np.nan})
 
+    def write_events(self, index, trial_start, times, keys, states):
+        self.event_writer.extend(zip([index] * len(keys), (times - trial_start).tolist(),
+                                     keys.tolist(), states.astype(int).tolist()))
+
+    def record_timing(self):
+        self.timing_writer.write(self.timing_data)
+        self.timing_data.update({k: np.nan for k in self.timing_header if k.endswith('_realized')})
+
     def check_answer(self):
-        correct_answer = self.trial_table['second'][self.trial_counter] == self.first_press
+        correct_answer = self.trial_plan[self.trial_counter].second == self.first_press
         delta = self.first_press_time - self.last_beep_time
         good_timing = False
         if delta > 0.075:
-            self.too_slow.autoDraw = True
+            text = self.too_slow
         elif delta < -0.075:
-            self.too_fast.autoDraw = True
+            text = self.too_fast
         elif np.isnan(self.first_press):
-            self.too_slow.autoDraw = True
+            text = self.too_slow
         else:
             good_timing = True
-            self.good.autoDraw = True
+            text = self.good
+        self.show_feedback_text(text)
+        self.shown_text = text.name
+        self.event_log.stim(text.name, True)
 
         self.correct_answer = correct_answer
         if correct_answer and good_timing:
-            self.coin.play()
+            self.tasks.submit(self.coin.play, priority=HIGH)
+
+    def show_feedback_text(self, text):
+        text.autoDraw = True
+
+    def hide_feedback_text(self):
+        self.good.autoDraw = False
+        self.too_fast.autoDraw = False
+        self.too_slow.autoDraw = False
+
+    def fill_targets(self, color):
+        [t.setFillColor(color) for t in self.targets]
+
+    def hide_targets(self):
+        [t.setAutoDraw(False) for t in self.targets]
 
     def draw_feedback(self):
         # text for timing, correctness
-        [t.setFillColor((-0.3, 0.7, -0.3) if self.correct_answer else (0.7, -0.3, -0.3))
-         for t in self.targets]
+        self.fill_targets((-0.3, 0.7, -0.3) if self.correct_answer else (0.7, -0.3, -0.3))
 
-    def sched_feedback_timer_reset(self):
-        self.win.callOnFlip(self.feedback_timer.reset, 0.3 -
-                            self.frame_period)  # 300 ms feedback?
+    def sched_log_feedback(self):
+        self.win.callOnFlip(self.log_flip, 'feedback_realized')
 
     # feedback functions
-    def feedback_timer_elapsed(self):
-        return self.feedback_timer.getTime() <= 0
+    def feedback_over(self):
+        return self.flips.count >= self.feedback_end_flip
 
     def remove_feedback(self):
-        # remove targets, make sure everything is proper colour
-        [t.setAutoDraw(False) for t in self.targets]
-        [t.setFillColor([0, 0, 0]) for t in self.targets]
-        self.good.autoDraw = False
-        self.too_fast.autoDraw = False
-        self.too_slow.autoDraw = False
+        # remove targets; their colour is reset on the way to the next trial (reset_colours)
+        self.hide_targets()
+        self.hide_feedback_text()
+        self.event_log.stim('target', False, self.trial_plan[self.trial_counter].second_index)
+        self.event_log.stim(self.shown_text, False)
+        self.win.callOnFlip(self.log_flip, 'feedback_end_realized')
+
+    def reset_colours(self):
+        self.fill_targets([0, 0, 0])
 
     def increment_trial_counter(self):
         self.trial_counter += 1
 
-    def sched_post_timer_reset(self):
-        self.win.callOnFlip(self.post_timer.reset, 0.1 - self.frame_period)
-
     # post_trial functions
-    def post_timer_elapsed(self):
-        return self.post_timer.getTime() <= 0
+    def post_over(self):
+        return self.flips.count >= self.post_end_flip
 
     def trial_counter_exceed_table(self):
-        return self.trial_counter >= len(self.trial_table.index)
+        return self.trial_counter >= len(self.trial_plan)
 
     def wait_for_press(self):
         return not np.isnan(self.first_press)
 
     def calc_adapt(self):
-        if self.adaptive and self.trial_table['first'][self.trial_counter] != self.trial_table['second'][self.trial_counter]:
-            #self.prev_sign = self.correct_answer
-            if self.trial_counter == 0:
-                pass # initial point, 500 ms
-            elif self.trial_counter == 1:
-                self.curr_sign = -1.0 if self.correct_answer else 1.0  # shrink if right, grow if wrong
-                self.curr_prep_time += (16/60) * self.curr_sign
-                self.prev_sign = self.curr_sign
-            elif self.trial_counter == 2:
-                self.curr_sign = -1.0 if self.correct_answer else 1.0  # shrink if right, grow if wrong
-                self.sign_switch_count += 1 if self.curr_sign != self.prev_sign else 0
-                self.curr_prep_time += (8/60) * self.curr_sign
-                self.prev_sign = self.curr_sign
-            else:
-                self.curr_sign = -1.0 if self.correct_answer else 1.0
-                self.sign_switch_count += 1 if self.curr_sign != self.prev_sign else 0
-                self.curr_prep_time += max(1/60, (2 ** (3 - self.sign_switch_count)/60)) * self.curr_sign
-            # apply bounds
-            self.curr_prep_time = min(0.6, self.curr_prep_time)
-            self.curr_prep_time = max(0.05, self.curr_prep_time)
-            self.trial_table.loc[self.trial_counter, 'switch_time'] = self.curr_prep_time
-            print('Trial: ' + str(self.trial_counter) + ', prep: ' + str(self.curr_prep_time))
+        if self.adaptive and self.trial_plan[self.trial_counter].is_switch:
+            prep_time = self.procedure.propose(self.trial_counter)
+            self.trial_plan.set_switch_time(self.trial_counter, prep_time)
+            self.tasks.submit(print, 'Trial: ' + str(self.trial_counter) + ', prep: ' + str(prep_time),
+                              priority=LOW)
+
+    def update_adapt(self):
+        # runs before record_data, while this trial's data is still around
+        if self.adaptive:
+            trial = self.trial_plan[self.trial_counter]
+            self.procedure.observe(self.trial_counter, trial.is_switch, trial.switch_time,
+                                   self.first_press_time - self.trial_data['real_switch_time'],
+                                   bool(self.correct_answer))
 
     # cleanup functions
     def close_n_such(self):
-        pass
+        # end of a block (cleanup may be entered again, e.g. aborting from cleanup)
+        if not self.block_open:
+            return
+        self.block_open = False
+        self.write_pending_events()
+        # finish deferred work (it may queue rows), then flush + fsync any queued rows, even
+        # if a task failed (its error is raised again after)
+        try:
+            self.tasks.close()
+        finally:
+            self.writer.close()
+            self.event_writer.close()
+            self.timing_writer.close()
+            self.event_log.close()
+            if self.input_stream is not None:
+                self.input_stream.close()
+        if self.adaptive:
+            self.procedure.save(op.splitext(self.summary_file_name)[0] + '_procedure.npz')
+        if self.realtime is not None:
+            self.realtime.close()
+        if self.recorder is not None:
+            self.recorder.save(op.splitext(self.summary_file_name)[0] + '_replay.npz')
+        tasks = self.tasks.save(op.splitext(self.summary_file_name)[0])
+        if self.profiler is not None:
+            report = self.profiler.save(op.splitext(self.summary_file_name)[0], self.frame_period)
+            print(format_report(report))
+            print(format_tasks(tasks))
 
     def input(self):
         # collect input
         timestamp, data = self.device.read()  # need to correct timestamp
         if timestamp is not None:
-            if self.device.device.__name__ is 'Keyboard':
-                for i, j in zip(data[0], data[1]):
-                    self.keyboard_state[j[0]] = i[0]
-                # colour in if any buttons pressed
-                self.device_on = any(self.keyboard_state)
-                if np.isnan(self.first_press) and self.device_on:
-                    self.first_press = data[1][0][0]
-                    self.first_press_time = (timestamp - self.trial_start)[0]
-
-            elif self.device.device.__name__ is 'ForceTransducers':
-                # see sg.medfilt(trial_input_buffer, kernel_size=(odd, 1))
-                pass
-                current_nans = np.isnan(self.trial_input_buffer)
-                if current_nans.any():
-                    next_index = np.where(current_nans)[0][0]
-                    self.trial_input_buffer[next_index, :] = data
-                    self.trial_input_time_buffer[next_index, :] = timestamp
+            self.decode_input(timestamp, data)
+
+    def decode_keyboard(self, timestamp, data):
+        # data is (states, keys), one row per event, oldest first
+        first = self.key_events.extend(timestamp, data[0], data[1])
+        self.event_log.inputs(timestamp, data[0], data[1])
+        # colour in if any buttons pressed
+        self.device_on = self.key_events.mask != 0
+        if first >= 0 and np.isnan(self.first_press):
+            self.first_press = int(self.key_events.key[self.key_events.count - len(timestamp) + first])
+            self.first_press_time = timestamp[first] - self.trial_start
+
+    def decode_forces(self, timestamp, data):
+        # every sample from this read goes in at once
+        self.trial_input_buffer.extend(timestamp, data)
+        if self.input_stream is not None:
+            self.input_stream.extend(timestamp, data)
+        channels, times, onsets = self.onset_detector.update(timestamp, data)
+        if channels.size:
+            # presses/releases are logged like key events (channel = finger)
+            first = self.key_events.extend(times, onsets, channels)
+            self.event_log.inputs(times, onsets, channels)
+            self.device_on = self.key_events.mask != 0
+            if first >= 0 and np.isnan(self.first_press):
+                self.first_press = int(channels[first])
+                self.first_press_time = times[first] - self.trial_start
+
+    def decode_hub(self, timestamp, data):
+        # one time-ordered batch from every device (input_hub.py); each goes to its decoder
+        sources, rows = data
+        for source, decode in self.hub_decoders:
+            mask = sources == source
+            if mask.any():
+                decode(timestamp[mask], rows[mask])
+
+    def decode_keyboard_rows(self, timestamp, rows):
+        self.decode_keyboard(timestamp, (rows[:, 0] != 0, rows[:, 1].astype(int)))
+
+    def decode_force_rows(self, timestamp, rows):
+        self.decode_forces(timestamp, rows[:, :10])
 
     def draw_input(self):
-        self.push_feedback.setFillColor([0, 0, 0] if self.device_on else [-1, -1, -1])
+        # only when it changes
+        if self.device_on != self.shown_on:
+            self.shown_on = self.device_on
+            self.push_feedback.setFillColor([0, 0, 0] if self.device_on else [-1, -1, -1])
+            self.event_log.stim('push_on', self.device_on)